@@ -0,0 +1,314 @@
+# app/cache.py
+import hashlib
+import json
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from app.config import (
+    EMBED_CACHE_SIZE,
+    EMBED_CACHE_TTL,
+    EMBED_CACHE_PG,
+    EMBED_CACHE_PG_TTL,
+    ANSWER_CACHE_SIZE,
+    ANSWER_CACHE_TTL,
+    ANSWER_CACHE_POLL,
+)
+from app.db import get_conn, get_aconn
+from app.metrics import set_known_buckets
+
+_MISSING = object()
+
+
+class TTLCache:
+    """线程安全的 LRU + TTL 缓存，带命中/未命中/淘汰计数"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING or item[0] < now:
+                if item is not _MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, ttl: float | None = None):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def drop_where(self, pred) -> int:
+        """删除 value 满足 pred 的条目，返回删除条数"""
+        with self._lock:
+            keys = [k for k, (_, v) in self._data.items() if pred(v)]
+            for k in keys:
+                del self._data[k]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+# ------------ 查询 embedding 缓存 ------------
+def normalize_query(text: str) -> str:
+    """缓存键用的规范化：NFKC + 合并空白"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def _embed_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+
+_EMBED_CACHE_DDL = """
+    CREATE TABLE IF NOT EXISTS query_embedding_cache (
+        key        TEXT PRIMARY KEY,
+        model      TEXT NOT NULL,
+        embedding  REAL[] NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+"""
+_EMBED_CACHE_GET = """
+    SELECT embedding FROM query_embedding_cache
+    WHERE key = %s AND created_at > now() - make_interval(secs => %s)
+"""
+_EMBED_CACHE_PUT = """
+    INSERT INTO query_embedding_cache (key, model, embedding) VALUES (%s, %s, %s)
+    ON CONFLICT (key) DO UPDATE SET embedding = EXCLUDED.embedding, created_at = now()
+"""
+
+
+class EmbeddingCache:
+    """两级缓存：进程内 LRU（L1） + 可选的 Postgres 表（L2，多 worker 共享）。
+    Postgres 出错时只降级为未命中，不影响主流程。
+    """
+
+    def __init__(self, maxsize: int, ttl: float, use_pg: bool, pg_ttl: float):
+        self.lru = TTLCache(maxsize, ttl)
+        self.use_pg = use_pg
+        self.pg_ttl = pg_ttl
+        self.pg_hits = 0
+        self.pg_misses = 0
+        self.pg_errors = 0
+
+    # ---- 同步 ----
+    def get(self, model: str, text: str):
+        key = _embed_key(model, text)
+        emb = self.lru.get(key)
+        if emb is not None or not self.use_pg:
+            return emb
+        try:
+            with get_conn() as conn:
+                cur = conn.cursor()
+                cur.execute(_EMBED_CACHE_GET, (key, self.pg_ttl))
+                row = cur.fetchone()
+        except Exception:
+            self.pg_errors += 1
+            return None
+        return self._pg_result(key, row)
+
+    def put(self, model: str, text: str, emb: list[float]):
+        key = _embed_key(model, text)
+        self.lru.set(key, emb)
+        if not self.use_pg:
+            return
+        try:
+            with get_conn() as conn:
+                cur = conn.cursor()
+                cur.execute(_EMBED_CACHE_PUT, (key, model, list(emb)))
+                conn.commit()
+        except Exception:
+            self.pg_errors += 1
+
+    # ---- 异步 ----
+    async def get_async(self, model: str, text: str):
+        key = _embed_key(model, text)
+        emb = self.lru.get(key)
+        if emb is not None or not self.use_pg:
+            return emb
+        try:
+            async with get_aconn() as conn:
+                cur = await conn.execute(_EMBED_CACHE_GET, (key, self.pg_ttl))
+                row = await cur.fetchone()
+        except Exception:
+            self.pg_errors += 1
+            return None
+        return self._pg_result(key, row)
+
+    async def put_async(self, model: str, text: str, emb: list[float]):
+        key = _embed_key(model, text)
+        self.lru.set(key, emb)
+        if not self.use_pg:
+            return
+        try:
+            async with get_aconn() as conn:
+                await conn.execute(_EMBED_CACHE_PUT, (key, model, list(emb)))
+                await conn.commit()
+        except Exception:
+            self.pg_errors += 1
+
+    def _pg_result(self, key, row):
+        if row is None:
+            self.pg_misses += 1
+            return None
+        self.pg_hits += 1
+        emb = list(row[0])
+        self.lru.set(key, emb)  # 回填 L1
+        return emb
+
+    async def ensure_table_async(self):
+        if not self.use_pg:
+            return
+        async with get_aconn() as conn:
+            await conn.execute(_EMBED_CACHE_DDL)
+            await conn.commit()
+
+    def stats(self) -> dict:
+        lru = self.lru.stats()
+        lookups = lru["hits"] + lru["misses"]
+        hits = lru["hits"] + self.pg_hits
+        return {
+            "lru": lru,
+            "pg_enabled": self.use_pg,
+            "pg_hits": self.pg_hits,
+            "pg_misses": self.pg_misses,
+            "pg_errors": self.pg_errors,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+
+embedding_cache = EmbeddingCache(
+    EMBED_CACHE_SIZE, EMBED_CACHE_TTL,
+    use_pg=EMBED_CACHE_PG, pg_ttl=EMBED_CACHE_PG_TTL,
+)
+
+
+# ------------ 回答缓存 ------------
+# scripts.ingest 每次写入新行都会把 ingest_generations 里对应 bucket 的 generation +1；
+# 这里定期（ANSWER_CACHE_POLL 秒）读一次，发现变化就清掉该 bucket 及不限 bucket 的缓存。
+_GENERATIONS_SQL = "SELECT bucket, generation FROM ingest_generations"
+
+
+def answer_key(query: str, bucket: str | None, topk: int, max_distance: float,
+               history: list[dict] | None, chunks: list[dict]) -> str:
+    """请求摘要 + 检索到的 chunk（id, content_hash）"""
+    payload = {
+        "q": normalize_query(query),
+        "bucket": bucket,
+        "topk": topk,
+        "max_distance": max_distance,
+        "history": [(h["role"], h["content"]) for h in (history or [])],
+        "chunks": [(c.get("id"), c.get("content_hash")) for c in chunks],
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    def __init__(self, maxsize: int, ttl: float, poll: float):
+        self.cache = TTLCache(maxsize, ttl)
+        self.poll = poll
+        self._generations: dict | None = None
+        self._next_poll = 0.0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.cache.maxsize > 0
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def put(self, key, bucket: str | None, answer: str, sources: list[dict]):
+        self.cache.set(key, (bucket, answer, sources))
+
+    def invalidate_bucket(self, bucket: str | None):
+        """清掉该 bucket 的条目；不限 bucket 的查询也可能检索到它，一并清掉"""
+        n = self.cache.drop_where(lambda v: v[0] is None or v[0] == bucket)
+        self.invalidations += n
+
+    def _apply_generations(self, rows):
+        gens = {b: g for b, g in rows}
+        set_known_buckets(gens)
+        if self._generations is not None:
+            for b in set(gens) | set(self._generations):
+                if gens.get(b) != self._generations.get(b):
+                    print(f"[CACHE] bucket={b} re-ingested, invalidating answers")
+                    self.invalidate_bucket(b)
+        self._generations = gens
+
+    def _due(self) -> bool:
+        # 回答缓存关闭时也轮询：指标的 bucket 白名单靠它更新
+        now = time.monotonic()
+        if now < self._next_poll:
+            return False
+        self._next_poll = now + self.poll
+        return True
+
+    def refresh(self):
+        if not self._due():
+            return
+        try:
+            with get_conn() as conn:
+                cur = conn.cursor()
+                cur.execute(_GENERATIONS_SQL)
+                rows = cur.fetchall()
+        except Exception:
+            return  # 表还没建（从未 ingest）等情况，下次再查
+        self._apply_generations(rows)
+
+    async def refresh_async(self):
+        if not self._due():
+            return
+        try:
+            async with get_aconn() as conn:
+                cur = await conn.execute(_GENERATIONS_SQL)
+                rows = await cur.fetchall()
+        except Exception:
+            return
+        self._apply_generations(rows)
+
+    def stats(self) -> dict:
+        return {**self.cache.stats(), "invalidated": self.invalidations}
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_POLL)
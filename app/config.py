@@ -16,4 +16,95 @@ load_dotenv(dotenv_path=global_env)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 DB_URL = os.getenv("DB_URL")
 print("API Key Loaded:", bool(OPENAI_API_KEY))
-print("DB_URL Loaded:", bool(DB_URL))
\ No newline at end of file
+print("DB_URL Loaded:", bool(DB_URL))
+
+# 数据库连接池
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))           # 等待空闲连接的最长秒数
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv("DB_POOL_HEALTHCHECK_IDLE", "30"))  # 空闲超过 N 秒的连接借出前先 SELECT 1
+
+# 批量 embedding（scripts/ingest.py）
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))          # 每个请求最多多少条 input（API 上限 2048）
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "250000"))   # 每个请求估算 token 上限（API 上限 300k）
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))          # 同时在途的 batch 数
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "8"))          # 429 / 网络错误最多重试次数
+
+# PDF 抽取并行度（scripts/ingest.py）；1 = 单进程
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "1"))
+INGEST_PAGE_CACHE = int(os.getenv("INGEST_PAGE_CACHE", "64"))        # 流式抽取时最多缓存多少页文本
+
+# 多文件 ingest 流水线（scripts/pipeline.py）
+INGEST_FILE_WORKERS = int(os.getenv("INGEST_FILE_WORKERS", "0"))      # 同时抽取的 PDF 数（进程），0 = CPU 核数
+INGEST_EMBED_WORKERS = int(os.getenv("INGEST_EMBED_WORKERS", "2"))    # 同时在途的 embed_many 调用数
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "8"))          # 阶段之间的队列长度（背压）
+
+# 查询 embedding 缓存：进程内 LRU + 可选 Postgres 共享层
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "10000"))        # LRU 条数上限，0 = 关闭
+EMBED_CACHE_TTL = float(os.getenv("EMBED_CACHE_TTL", "86400"))        # LRU 过期秒数
+EMBED_CACHE_PG = os.getenv("EMBED_CACHE_PG", "0") == "1"              # 是否启用 Postgres 共享层
+EMBED_CACHE_PG_TTL = float(os.getenv("EMBED_CACHE_PG_TTL", str(30 * 86400)))
+
+# 回答缓存（相同请求 + 相同检索结果直接返回）
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "2000"))       # 0 = 关闭
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_POLL = float(os.getenv("ANSWER_CACHE_POLL", "5"))        # 多久检查一次 ingest 代数（秒）
+
+# ANN 索引（scripts/ann_index.py）
+ANN_INDEX_TYPE = os.getenv("ANN_INDEX_TYPE", "hnsw")                  # hnsw / ivfflat
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "64"))
+IVFFLAT_LISTS = int(os.getenv("IVFFLAT_LISTS", "0"))                  # 0 = 按行数自动（rows/1000，百万以上 sqrt(rows)）
+ANN_MAINTENANCE_WORK_MEM = os.getenv("ANN_MAINTENANCE_WORK_MEM", "1GB")
+ANN_BUILD_WORKERS = int(os.getenv("ANN_BUILD_WORKERS", "2"))          # max_parallel_maintenance_workers
+
+# 量化检索：none = 直接在全精度向量上检索；halfvec / binary = 先在量化表达式索引上粗排，再用全精度向量重排
+EMBED_QUANT = os.getenv("EMBED_QUANT", "none")
+QUANT_RERANK_FACTOR = int(os.getenv("QUANT_RERANK_FACTOR", "4"))      # 粗排取 topk × factor 个候选
+
+# 迭代索引扫描（pgvector >= 0.8）：带过滤条件时索引继续往下扫，直到凑满 top-k；服务启动时检查版本，旧版 pgvector 上自动不设置
+ANN_ITERATIVE_SCAN = os.getenv("ANN_ITERATIVE_SCAN", "relaxed_order")  # off / relaxed_order / strict_order
+
+# documents 按 bucket LIST 分区（scripts/partition.py）：只对新建表生效，已有表用 partition migrate 迁移
+DOCUMENTS_PARTITIONED = os.getenv("DOCUMENTS_PARTITIONED", "1") == "1"
+
+# 条款号直查：问题里带 "Section 3.3.1" / "6.1.1.1.5" 时先按 section 精确查，不做 embedding
+SECTION_FASTPATH = os.getenv("SECTION_FASTPATH", "1") == "1"
+
+# ingest 的内容寻址 embedding 库：hash(model, 文本) -> 向量，重复 chunk 不再付费
+EMBED_STORE = os.getenv("EMBED_STORE", "1") == "1"
+
+# query_logs 后台批量写入
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))            # 队列上限，满了丢弃并计数
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "200"))              # 攒够多少条写一次
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1.0"))    # 最长多少秒写一次
+LOG_PARTITIONED = os.getenv("LOG_PARTITIONED", "1") == "1"             # 新建的 query_logs 按月分区（已有表用 scripts.log_partitions migrate）
+LOG_PARTITIONS_AHEAD = int(os.getenv("LOG_PARTITIONS_AHEAD", "2"))    # 提前建好几个月的分区
+LOG_EXPORT_FETCH = int(os.getenv("LOG_EXPORT_FETCH", "1000"))         # /logs/export 服务端游标每次取多少行
+
+# 上下文拼装（app/context.py）：按 token 预算塞 chunk 和历史，调用 LLM 前先去重
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))      # 提示词总预算（模板 + 问题 + 历史 + 上下文）
+CONTEXT_HISTORY_TOKENS = int(os.getenv("CONTEXT_HISTORY_TOKENS", "1000"))  # 历史最多占用的 token
+CONTEXT_DEDUP_DISTANCE = float(os.getenv("CONTEXT_DEDUP_DISTANCE", "0.2")) # 两个 chunk 向量 L2 距离小于此值视为近似重复，0 = 关闭
+
+# 批量问答（/ask/batch）
+ASK_BATCH_MAX = int(os.getenv("ASK_BATCH_MAX", "500"))                 # 每批最多多少个问题
+ASK_BATCH_CONCURRENCY = int(os.getenv("ASK_BATCH_CONCURRENCY", "8"))   # 每批同时在途的 chat 请求数
+
+# Prometheus 指标的 bucket 标签：只用这里列出的和 ingest_generations 里已有的 bucket，其它记为 "other"
+METRICS_BUCKETS = [b.strip() for b in os.getenv("METRICS_BUCKETS", "").split(",") if b.strip()]
+
+# OpenAI 调用（app/limiter.py）：相同的在途请求合并成一次上游调用 + 自适应并发（AIMD，遇到 429 减半）
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "1") == "1"
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "16"))            # 初始并发上限（embeddings / chat 各一个）
+LLM_CONCURRENCY_MIN = int(os.getenv("LLM_CONCURRENCY_MIN", "1"))
+LLM_CONCURRENCY_MAX = int(os.getenv("LLM_CONCURRENCY_MAX", "64"))
+LLM_QUEUE_MAX = int(os.getenv("LLM_QUEUE_MAX", "256"))               # 排队上限，满了直接拒绝（503）
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "10"))      # 排队 + 重试等待的最长秒数，超时拒绝（503）
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))             # 429 / 网络错误最多重试次数
+
+# 检索后端：pg = pgvector；snapshot = 内存映射的只读快照（scripts/snapshot.py 导出），不查数据库
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "pg")
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", str(Path(__file__).resolve().parents[1] / "snapshots"))
+SNAPSHOT_POLL = float(os.getenv("SNAPSHOT_POLL", "5"))               # 多久检查一次 CURRENT（秒）
+SNAPSHOT_DTYPE = os.getenv("SNAPSHOT_DTYPE", "float16")               # 导出精度：float16 体积减半
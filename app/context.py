@@ -0,0 +1,156 @@
+# app/context.py
+# 按 token 预算拼上下文：在调用 LLM 之前去掉重复/重叠的 chunk，再把上下文 + 历史塞进预算里。
+#   1) 完全相同（content_hash）或被已选 chunk 包含的 chunk 丢掉
+#   2) 向量距离很近（近似重复，比如同一条款在两份文件里各一份）的 chunk 丢掉
+#   3) 同一 section 相邻 soft-chunk 的 overlap 只保留一次（从后一个 chunk 里剪掉）
+#   4) 历史按 token 而不是轮数截断：从最近一轮往前取，直到 CONTEXT_HISTORY_TOKENS
+#   5) chunk 按相似度从高到低放入，超出 CONTEXT_TOKEN_BUDGET 时截断最后一个并停止
+import numpy as np
+
+from app.config import (
+    CONTEXT_TOKEN_BUDGET,
+    CONTEXT_HISTORY_TOKENS,
+    CONTEXT_DEDUP_DISTANCE,
+)
+from app.tokens import estimate_tokens
+
+MIN_OVERLAP = 40          # 少于这么多字符的首尾重合不算 overlap
+MAX_OVERLAP = 1000        # soft_chunk 默认 overlap=200，留足余量
+MIN_TAIL_TOKENS = 100     # 预算只剩这么点时不再截断塞入半个 chunk
+
+
+def split_header(content: str) -> tuple[str, str]:
+    """ingest 写入的 chunk 形如 "[file | sec:.. | title | p.a-b]\n正文"，拆成 (头, 正文)"""
+    if content.startswith("[") and "]\n" in content[:500]:
+        head, body = content.split("]\n", 1)
+        return head + "]", body
+    return "", content
+
+
+def _overlap(tail_text: str, head_text: str) -> int:
+    """tail_text 的结尾和 head_text 的开头重合的最长字符数"""
+    limit = min(len(tail_text), len(head_text), MAX_OVERLAP)
+    for k in range(limit, MIN_OVERLAP - 1, -1):
+        if tail_text.endswith(head_text[:k]):
+            return k
+    return 0
+
+
+def _near_duplicate(emb, kept_embs: list) -> bool:
+    if emb is None or not kept_embs or CONTEXT_DEDUP_DISTANCE <= 0:
+        return False
+    v = np.asarray(emb, dtype=np.float32)
+    others = np.stack(kept_embs)
+    return bool(np.min(np.linalg.norm(others - v, axis=1)) < CONTEXT_DEDUP_DISTANCE)
+
+
+def dedupe_chunks(chunks: list[dict]) -> list[dict]:
+    """按相似度顺序去重，返回 [{chunk, body}]：chunk 是原始检索结果，body 是剪掉 overlap 后的正文"""
+    kept: list[dict] = []
+    kept_embs: list = []
+    seen_hashes = set()
+    for c in chunks:
+        h = c.get("content_hash")
+        if h and h in seen_hashes:
+            continue
+        _, body = split_header(c["content"])
+        body = body.strip()
+        if not body:
+            continue
+        if any(body in k["body"] for k in kept):
+            continue
+        emb = c.get("embedding")
+        if _near_duplicate(emb, kept_embs):
+            continue
+
+        # 同一来源同一 section 的相邻块：剪掉和已选块重合的部分
+        for k in kept:
+            kc = k["chunk"]
+            if (kc.get("source"), kc.get("section")) != (c.get("source"), c.get("section")):
+                continue
+            n = _overlap(k["body"], body)
+            if n:
+                body = body[n:].lstrip()
+                continue
+            n = _overlap(body, k["body"])
+            if n:
+                body = body[:-n].rstrip()
+        if not body:
+            continue
+
+        if h:
+            seen_hashes.add(h)
+        if emb is not None:
+            kept_embs.append(np.asarray(emb, dtype=np.float32))
+        kept.append({"chunk": c, "body": body})
+    return kept
+
+
+def fit_history(history: list[dict] | None, budget: int = CONTEXT_HISTORY_TOKENS) -> list[dict]:
+    """从最近一轮往前取历史，总 token 不超过 budget"""
+    out: list[dict] = []
+    used = 0
+    for h in reversed(history or []):
+        n = estimate_tokens(h["content"]) + 2
+        if used + n > budget:
+            break
+        out.append(h)
+        used += n
+    out.reverse()
+    return out
+
+
+def _meta(c: dict) -> str:
+    return f"[source: {c['source']}, section: {c['section']}, page: {c['page']}]"
+
+
+def assemble_context(chunks: list[dict], budget: int) -> tuple[str, list[dict]]:
+    """去重后按顺序放入 chunk，直到用完 budget；返回 (上下文文本, 实际用到的原始 chunk)"""
+    parts: list[str] = []
+    used: list[dict] = []
+    remaining = budget
+    for item in dedupe_chunks(chunks):
+        c, body = item["chunk"], item["body"]
+        meta = _meta(c)
+        cost = estimate_tokens(meta) + estimate_tokens(body) + 2
+        if cost > remaining:
+            # 放不下整块：剩余预算还够就截断放入，然后停止
+            room = remaining - estimate_tokens(meta) - 2
+            if room >= MIN_TAIL_TOKENS:
+                parts.append(meta + "\n" + _truncate(body, room))
+                used.append(c)
+            break
+        parts.append(meta + "\n" + body)
+        used.append(c)
+        remaining -= cost
+    return "\n\n".join(parts), used
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """截到大约 max_tokens，尽量在换行 / 句号处断开"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    cut = text[:lo]
+    for sep in ("\n", ". "):
+        i = cut.rfind(sep)
+        if i > lo // 2:
+            return cut[:i + 1].rstrip() + " …"
+    return cut.rstrip() + " …"
+
+
+def plan_prompt(query: str, chunks: list[dict], history: list[dict] | None,
+                template_tokens: int, budget: int = CONTEXT_TOKEN_BUDGET):
+    """返回 (context, 用到的 chunk, 截断后的历史)：历史先占用至多 CONTEXT_HISTORY_TOKENS，
+    剩下的预算（扣掉模板和问题）给检索上下文"""
+    recent = fit_history(history, min(CONTEXT_HISTORY_TOKENS, budget // 2))
+    hist_tokens = sum(estimate_tokens(h["content"]) + 2 for h in recent)
+    room = budget - template_tokens - estimate_tokens(query) - hist_tokens
+    context, used = assemble_context(chunks, max(room, MIN_TAIL_TOKENS))
+    return context, used, recent
@@ -1,8 +1,249 @@
-from app.config import DB_URL
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+
 import psycopg2
+from psycopg2 import pool as pg_pool
+from psycopg_pool import AsyncConnectionPool
+
+from app.vector import configure_async_conn
+
+from app.config import (
+    DB_URL,
+    DB_POOL_MIN,
+    DB_POOL_MAX,
+    DB_POOL_TIMEOUT,
+    DB_POOL_HEALTHCHECK_IDLE,
+)
+
+
+class PoolTimeout(Exception):
+    """在 DB_POOL_TIMEOUT 秒内没等到空闲连接"""
+
+
+class ConnectionPool:
+    """在 psycopg2 ThreadedConnectionPool 外面包一层：
+    - 满了不直接报错，而是排队等待，最长 timeout 秒
+    - 借出前对空闲太久/已断开的连接做健康检查
+    - 统计等待时间、使用率，方便 /stats 暴露
+    """
+
+    def __init__(self, dsn: str, minconn: int, maxconn: int,
+                 timeout: float, healthcheck_idle: float):
+        self._pool = pg_pool.ThreadedConnectionPool(minconn, maxconn, dsn)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used: dict[int, float] = {}
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+
+        # 统计
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.leases = 0
+        self.timeouts = 0
+        self.broken = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        last = self._last_used.get(id(conn))
+        if last is not None and time.monotonic() - last < self.healthcheck_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self, timeout: float | None = None):
+        timeout = self.timeout if timeout is None else timeout
+        t0 = time.monotonic()
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise PoolTimeout(f"no free DB connection after {timeout:.1f}s (max={self.maxconn})")
+        try:
+            conn = self._pool.getconn()
+            while not self._healthy(conn):
+                with self._lock:
+                    self.broken += 1
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+        waited = time.monotonic() - t0
+        with self._lock:
+            self.leases += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return conn
+
+    def release(self, conn, discard: bool = False):
+        try:
+            if not discard and not conn.closed:
+                # 归还前保证不带着未结束的事务
+                try:
+                    conn.rollback()
+                    self._last_used[id(conn)] = time.monotonic()
+                except Exception:
+                    discard = True
+            if discard or conn.closed:
+                self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=discard or bool(conn.closed))
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_size": self.maxconn,
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "saturation": self.in_use / self.maxconn if self.maxconn else 0.0,
+                "leases": self.leases,
+                "timeouts": self.timeouts,
+                "broken_replaced": self.broken,
+                "wait_avg_ms": (self.wait_total / self.leases * 1000) if self.leases else 0.0,
+                "wait_max_ms": self.wait_max * 1000,
+            }
+
+    def close(self):
+        self._pool.closeall()
+
+
+_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """进程内共享的连接池（懒加载）"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                if not DB_URL:
+                    raise ValueError("❌ 未检测到 DB_URL，请检查 .env 文件配置")
+                _pool = ConnectionPool(
+                    DB_URL,
+                    minconn=DB_POOL_MIN,
+                    maxconn=DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    healthcheck_idle=DB_POOL_HEALTHCHECK_IDLE,
+                )
+    return _pool
+
+
+@contextmanager
+def get_conn(timeout: float | None = None):
+    """从连接池借一个连接，用完自动归还：
+
+        with get_conn() as conn:
+            ...
+
+    出错时回滚；连接已损坏的直接丢弃。
+    """
+    pool = get_pool()
+    conn = pool.acquire(timeout=timeout)
+    discard = False
+    try:
+        yield conn
+    except psycopg2.InterfaceError:
+        discard = True
+        raise
+    except psycopg2.OperationalError:
+        discard = True
+        raise
+    finally:
+        pool.release(conn, discard=discard)
+
+
+def pool_stats() -> dict:
+    if _pool is None:
+        return {"initialized": False}
+    return {"initialized": True, **_pool.stats()}
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+# ------------ 异步连接池（psycopg 3）------------
+# /ask 走 async 路径时使用，避免每个请求占住一个线程池 worker
+_apool: AsyncConnectionPool | None = None
+
+
+def get_async_pool() -> AsyncConnectionPool:
+    """进程内共享的异步连接池；需在事件循环里 open_async_pool() 之后使用"""
+    global _apool
+    if _apool is None:
+        if not DB_URL:
+            raise ValueError("❌ 未检测到 DB_URL，请检查 .env 文件配置")
+        _apool = AsyncConnectionPool(
+            DB_URL,
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            timeout=DB_POOL_TIMEOUT,
+            check=AsyncConnectionPool.check_connection,
+            configure=configure_async_conn,
+            open=False,
+        )
+    return _apool
+
+
+async def open_async_pool():
+    await get_async_pool().open()
+
+
+async def close_async_pool():
+    global _apool
+    if _apool is not None:
+        await _apool.close()
+        _apool = None
+
+
+@asynccontextmanager
+async def get_aconn(timeout: float | None = None):
+    """异步版 get_conn：
+
+        async with get_aconn() as conn:
+            ...
+    """
+    pool = get_async_pool()
+    async with pool.connection(timeout=timeout) as conn:
+        yield conn
+
 
-def get_conn():
-    """创建并返回数据库连接"""
-    if not DB_URL:
-        raise ValueError("❌ 未检测到 DB_URL，请检查 .env 文件配置")
-    return psycopg2.connect(DB_URL)
+def async_pool_stats() -> dict:
+    if _apool is None:
+        return {"initialized": False}
+    s = _apool.get_stats()
+    max_size = _apool.max_size
+    in_use = s.get("pool_size", 0) - s.get("pool_available", 0)
+    requests = s.get("requests_num", 0)
+    return {
+        "initialized": True,
+        "max_size": max_size,
+        "in_use": in_use,
+        "saturation": in_use / max_size if max_size else 0.0,
+        "waiting": s.get("requests_waiting", 0),
+        "leases": requests,
+        "timeouts": s.get("requests_errors", 0),
+        "wait_avg_ms": (s.get("requests_wait_ms", 0) / requests) if requests else 0.0,
+    }
@@ -0,0 +1,419 @@
+# app/limiter.py
+# OpenAI 调用的两层保护：
+#   - SingleFlight：同一个 key（同一段查询文本 / 同一个回答缓存键）已有请求在途时，后来者等它的结果，
+#     热门问题同时来 N 个只打一次上游
+#   - AdaptiveLimiter：进程内的并发上限（embeddings / chat 各一个），AIMD 调整 ——
+#     成功一次上限 +1/limit，遇到 429 减半；满了排队，队列满或超过截止时间直接拒绝（Overloaded → 503）
+# 429 / 网络错误在这里按 retry-after 重试（OpenAI 客户端关掉了 SDK 自带的重试），重试期间不占名额。
+# 协程走 call()，同步代码（线程 / 脚本）走 call_sync()，两边共用同一份上限和队列。
+import asyncio
+import math
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import openai
+
+from app.config import (
+    SINGLE_FLIGHT,
+    LLM_CONCURRENCY,
+    LLM_CONCURRENCY_MIN,
+    LLM_CONCURRENCY_MAX,
+    LLM_QUEUE_MAX,
+    LLM_QUEUE_TIMEOUT,
+    LLM_MAX_RETRIES,
+)
+from app.metrics import LLM_LIMIT, LLM_IN_FLIGHT, LLM_QUEUE_DEPTH, LLM_SHED, LLM_RATE_LIMITED, LLM_COALESCED
+
+RETRYABLE = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+
+def retry_after(err: Exception) -> float | None:
+    """从 429 响应头里读建议等待时间（秒）"""
+    resp = getattr(err, "response", None)
+    if resp is None:
+        return None
+    headers = resp.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class Overloaded(Exception):
+    """排队已满或等不到名额：由 /ask 转成 503 + Retry-After"""
+
+    def __init__(self, kind: str, reason: str, retry_after: float):
+        super().__init__(f"{kind} upstream overloaded ({reason}), retry in {retry_after:.0f}s")
+        self.kind = kind
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class SingleFlight:
+    """相同 key 的在途调用只执行一次，结果（或异常）分给所有等待者。
+    do() 给同步代码（线程），ado() / ado_many() 给协程；线程和协程各一张在途表。
+    """
+
+    def __init__(self, kind: str, enabled: bool = SINGLE_FLIGHT):
+        self.kind = kind
+        self.enabled = enabled
+        self._calls: dict = {}     # key -> concurrent.futures.Future
+        self._tasks: dict = {}     # key -> asyncio.Task / Future（ado_many 的每个 key）
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """返回 (结果, 是否复用了别人的调用)"""
+        if not self.enabled:
+            return fn(), False
+        with self._lock:
+            fut = self._calls.get(key)
+            leader = fut is None
+            if leader:
+                fut = self._calls[key] = Future()
+        if not leader:
+            self._shared()
+            return fut.result(), True
+        self.leaders += 1
+        try:
+            value = fn()
+            fut.set_result(value)
+            return value, False
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    async def ado(self, key, fn):
+        """fn 是无参的协程函数；返回 (结果, 是否复用了别人的调用)。
+        上游调用放在单独的 task 里并 shield：发起者断开不会连累其它等待者。
+        """
+        if not self.enabled:
+            return await fn(), False
+        task = self._tasks.get(key)
+        if task is not None:
+            self._shared()
+            return await asyncio.shield(task), True
+        task = asyncio.ensure_future(fn())
+        self._tasks[key] = task
+        task.add_done_callback(lambda t: self._done(key, t))
+        self.leaders += 1
+        return await asyncio.shield(task), False
+
+    async def ado_many(self, keys, fn):
+        """批量版本：fn(keys) 是协程函数，一次取回多个 key，返回 {key: 结果}。
+        已有调用在途的 key 等它的结果；其余 key 合成一次 fn 调用，期间逐个登记为在途，
+        同一时刻的单条 ado() 也会搭这次批量调用的车。
+        """
+        keys = list(dict.fromkeys(keys))
+        if not self.enabled:
+            return await fn(keys)
+        waits = {k: self._tasks[k] for k in keys if k in self._tasks}
+        for _ in waits:
+            self._shared()
+        own = [k for k in keys if k not in waits]
+        if own:
+            loop = asyncio.get_running_loop()
+            futs = {k: loop.create_future() for k in own}
+            for k, fut in futs.items():
+                self._tasks[k] = fut
+                fut.add_done_callback(lambda f, k=k: self._done(k, f))
+            task = asyncio.ensure_future(fn(own))
+            task.add_done_callback(lambda t: self._fan_out(t, futs))
+            self.leaders += 1
+            waits.update(futs)
+        return {k: await asyncio.shield(f) for k, f in waits.items()}
+
+    @staticmethod
+    def _fan_out(task, futs: dict):
+        """批量调用结束：结果（或异常）按 key 分给各自的 future"""
+        for key, fut in futs.items():
+            if fut.done():
+                continue
+            if task.cancelled():
+                fut.cancel()
+            elif task.exception() is not None:
+                fut.set_exception(task.exception())
+            elif key in task.result():
+                fut.set_result(task.result()[key])
+            else:
+                fut.set_exception(KeyError(key))
+
+    def _done(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # 所有等待者都已离开时，避免 "exception was never retrieved"
+        if not task.cancelled():
+            task.exception()
+
+    def _shared(self):
+        self.coalesced += 1
+        LLM_COALESCED.labels(self.kind).inc()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._calls) + len(self._tasks),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
+
+
+class AdaptiveLimiter:
+    """AIMD 并发限制，协程和线程共用。名额由 release() 直接转交给队首，不会被新来的插队。
+    队列里协程等 asyncio.Future，线程等 concurrent.futures.Future；计数都在 _lock 下改。
+    """
+
+    def __init__(self, kind: str, initial: int = LLM_CONCURRENCY,
+                 min_limit: int = LLM_CONCURRENCY_MIN, max_limit: int = LLM_CONCURRENCY_MAX,
+                 max_queue: int = LLM_QUEUE_MAX, queue_timeout: float = LLM_QUEUE_TIMEOUT,
+                 max_retries: int = LLM_MAX_RETRIES):
+        self.kind = kind
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.in_flight = 0
+        self._waiters: deque = deque()
+        self._lock = threading.Lock()
+        # 一波并发请求会几乎同时收到一串 429，冷却期内只减一次
+        self._cooldown_until = 0.0
+
+        # 统计
+        self.admitted = 0
+        self.queued = 0
+        self.peak_queue = 0
+        self.wait_seconds = 0.0
+        self.shed_full = 0
+        self.shed_timeout = 0
+        self.rate_limited = 0
+        self.retries = 0
+        self.decreases = 0
+
+        LLM_LIMIT.labels(kind).set_function(lambda: self.limit)
+        LLM_IN_FLIGHT.labels(kind).set_function(lambda: self.in_flight)
+        LLM_QUEUE_DEPTH.labels(kind).set_function(lambda: len(self._waiters))
+
+    def _cap(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    def _shed(self, reason: str):
+        if reason == "queue_full":
+            self.shed_full += 1
+        else:
+            self.shed_timeout += 1
+        LLM_SHED.labels(self.kind, reason).inc()
+        # 429 冷却期内建议等到冷却结束，否则 1 秒后再试
+        wait = max(1.0, self._cooldown_until - time.monotonic())
+        raise Overloaded(self.kind, reason, math.ceil(wait))
+
+    def _enqueue(self, timeout: float, new_future):
+        """有空位直接拿名额返回 None；否则新建一个 future 排进队列并返回它"""
+        with self._lock:
+            if not self._waiters and self.in_flight < self._cap():
+                self.in_flight += 1
+                self.admitted += 1
+                return None
+            if len(self._waiters) >= self.max_queue or timeout <= 0:
+                self._shed("queue_full" if timeout > 0 else "timeout")
+            fut = new_future()
+            self._waiters.append(fut)
+            self.queued += 1
+            self.peak_queue = max(self.peak_queue, len(self._waiters))
+            return fut
+
+    def _dequeue(self, fut, t0: float):
+        with self._lock:
+            if fut in self._waiters:
+                self._waiters.remove(fut)
+            self.wait_seconds += time.monotonic() - t0
+
+    async def acquire(self, timeout: float):
+        fut = self._enqueue(timeout, asyncio.get_running_loop().create_future)
+        if fut is None:
+            return
+        t0 = time.monotonic()
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            # 超时和转交名额撞在一起时名额已经是我们的，照常继续
+            if fut.cancelled() or not fut.done():
+                self._shed("timeout")
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+        finally:
+            self._dequeue(fut, t0)
+        self.admitted += 1
+
+    def acquire_sync(self, timeout: float):
+        """acquire() 的线程版本：阻塞当前线程直到拿到名额"""
+        fut = self._enqueue(timeout, Future)
+        if fut is None:
+            return
+        t0 = time.monotonic()
+        try:
+            fut.result(timeout)
+        except FutureTimeout:
+            # 还在队列里就是没等到；已经出队说明名额刚转交过来
+            with self._lock:
+                granted = fut not in self._waiters
+            if not granted:
+                self._shed("timeout")
+        finally:
+            self._dequeue(fut, t0)
+        self.admitted += 1
+
+    def release(self, ok: bool = False):
+        """ok=True：上游调用成功，加性增加上限"""
+        with self._lock:
+            self.in_flight -= 1
+            if ok and self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._wake()
+
+    def _wake(self):
+        # 持有 _lock 时调用
+        while self._waiters and self.in_flight < self._cap():
+            fut = self._waiters.popleft()
+            if fut.done():
+                continue
+            self.in_flight += 1
+            if isinstance(fut, Future):
+                fut.set_result(None)
+                continue
+            loop = fut.get_loop()
+            try:
+                same_loop = asyncio.get_running_loop() is loop
+            except RuntimeError:
+                same_loop = False
+            if same_loop:
+                fut.set_result(None)
+            else:
+                # 线程里 release 的名额转交给协程：回到它的事件循环上再 set_result
+                loop.call_soon_threadsafe(self._hand_over, fut)
+
+    def _hand_over(self, fut):
+        if fut.done():
+            # 等待的协程已经超时 / 取消，名额还回去
+            self.release()
+        else:
+            fut.set_result(None)
+
+    def _on_rate_limited(self, wait: float):
+        with self._lock:
+            self.rate_limited += 1
+            LLM_RATE_LIMITED.labels(self.kind).inc()
+            now = time.monotonic()
+            if now < self._cooldown_until:
+                return
+            self.limit = max(float(self.min_limit), self.limit / 2)
+            self.decreases += 1
+            self._cooldown_until = now + max(1.0, wait)
+        print(f"[LIMIT] {self.kind} rate limited, concurrency limit -> {self._cap()}")
+
+    def _retry_wait(self, err: Exception, attempt: int, deadline: float) -> float | None:
+        """第 attempt 次失败后该等几秒；不该再重试时返回 None"""
+        wait = retry_after(err)
+        if isinstance(err, openai.RateLimitError):
+            self._on_rate_limited(wait or 1.0)
+        if wait is None:
+            wait = min(8.0, 0.25 * 2 ** attempt) * (0.5 + random.random() / 2)
+        if attempt > self.max_retries or time.monotonic() + wait >= deadline:
+            return None
+        self.retries += 1
+        return wait
+
+    async def call(self, fn, *args, hold: bool = False, **kwargs):
+        """拿到名额后 await fn(*args, **kwargs)；429 / 网络错误退避重试，整个等待不超过 queue_timeout。
+        hold=True：成功后名额不释放（流式响应），调用方读完流再 release(ok)。
+        """
+        deadline = time.monotonic() + self.queue_timeout
+        attempt = 0
+        while True:
+            await self.acquire(deadline - time.monotonic())
+            try:
+                result = await fn(*args, **kwargs)
+            except RETRYABLE as e:
+                self.release()
+                attempt += 1
+                wait = self._retry_wait(e, attempt, deadline)
+                if wait is None:
+                    raise
+                await asyncio.sleep(wait)
+                continue
+            except BaseException:
+                self.release()
+                raise
+            if not hold:
+                self.release(ok=True)
+            return result
+
+    def call_sync(self, fn, *args, **kwargs):
+        """call() 的同步版本（同步 OpenAI 客户端）：和协程共用上限、队列和 429 反馈"""
+        deadline = time.monotonic() + self.queue_timeout
+        attempt = 0
+        while True:
+            self.acquire_sync(deadline - time.monotonic())
+            try:
+                result = fn(*args, **kwargs)
+            except RETRYABLE as e:
+                self.release()
+                attempt += 1
+                wait = self._retry_wait(e, attempt, deadline)
+                if wait is None:
+                    raise
+                time.sleep(wait)
+                continue
+            except BaseException:
+                self.release()
+                raise
+            self.release(ok=True)
+            return result
+
+    def stats(self) -> dict:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queue_depth": len(self._waiters),
+            "peak_queue_depth": self.peak_queue,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "avg_queue_wait_ms": round(self.wait_seconds / self.queued * 1000, 1) if self.queued else 0.0,
+            "shed_queue_full": self.shed_full,
+            "shed_timeout": self.shed_timeout,
+            "rate_limited": self.rate_limited,
+            "retries": self.retries,
+            "decreases": self.decreases,
+        }
+
+
+embed_limiter = AdaptiveLimiter("embed")
+chat_limiter = AdaptiveLimiter("chat")
+embed_flight = SingleFlight("embed")
+chat_flight = SingleFlight("chat")
+
+
+def limiter_stats() -> dict:
+    return {
+        "embed": {**embed_limiter.stats(), "single_flight": embed_flight.stats()},
+        "chat": {**chat_limiter.stats(), "single_flight": chat_flight.stats()},
+    }
@@ -0,0 +1,241 @@
+# app/logwriter.py
+# query_logs 的后台批量写入：请求线程只把日志放进有界队列就返回，
+# 后台线程按条数 / 时间间隔攒批，一条多行 INSERT 写入；关停时把剩余的刷完。
+# 队列满了直接丢弃并计数，写库失败也计数 —— 日志丢失可以在 /stats 看到。
+# query_logs 按月 RANGE 分区（created_at，UTC 月份）：保留期清理直接删整月分区（export_logs.sh），
+# 不再做全表 DELETE + VACUUM；写入前按需建当月分区，DEFAULT 分区兜底。
+import atexit
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+from psycopg2.extras import Json, execute_values
+
+from app.config import LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL
+from app.config import LOG_PARTITIONED, LOG_PARTITIONS_AHEAD
+from app.db import get_conn
+
+LOG_DDL = """
+    CREATE TABLE IF NOT EXISTS query_logs (
+        id         BIGSERIAL PRIMARY KEY,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        query      TEXT,
+        bucket     TEXT,
+        answer     TEXT
+    );
+    -- 分阶段耗时（毫秒）和 LLM token 数
+    ALTER TABLE query_logs ADD COLUMN IF NOT EXISTS timings JSONB;
+    ALTER TABLE query_logs ADD COLUMN IF NOT EXISTS prompt_tokens INT;
+    ALTER TABLE query_logs ADD COLUMN IF NOT EXISTS completion_tokens INT;
+"""
+
+# 新库直接建分区表；分区表的主键必须包含分区键，所以是 (id, created_at)
+PARTITIONED_LOG_DDL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id         BIGINT NOT NULL DEFAULT nextval('{seq}'),
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        query      TEXT,
+        bucket     TEXT,
+        answer     TEXT,
+        timings    JSONB,
+        prompt_tokens INT,
+        completion_tokens INT,
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at);
+    CREATE TABLE IF NOT EXISTS query_logs_default PARTITION OF {table} DEFAULT;
+    -- /logs?bucket=... 按 id 翻页
+    CREATE INDEX IF NOT EXISTS {table}_bucket_id ON {table} (bucket, id);
+"""
+
+_INSERT_SQL = """
+    INSERT INTO query_logs (created_at, query, bucket, answer, timings, prompt_tokens, completion_tokens)
+    VALUES %s
+"""
+
+
+def month_start(ts: datetime) -> datetime:
+    ts = ts.astimezone(timezone.utc)
+    return datetime(ts.year, ts.month, 1, tzinfo=timezone.utc)
+
+
+def next_month(month: datetime) -> datetime:
+    return month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+
+
+def log_partition_name(month: datetime) -> str:
+    return f"query_logs_{month:%Y%m}"
+
+
+def create_log_partition(cur, month: datetime, table: str = "query_logs"):
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {log_partition_name(month)} "
+                f"PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)", (month, next_month(month)))
+
+
+def log_relkind(cur, table: str = "query_logs") -> str | None:
+    """'r' 普通表 / 'p' 分区表 / None 不存在"""
+    cur.execute("""
+        SELECT relkind FROM pg_class
+        WHERE relname = %s AND relnamespace = 'public'::regnamespace
+    """, (table,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+class LogWriter:
+    def __init__(self, maxsize: int, batch_size: int, interval: float):
+        self._q: queue.Queue = queue.Queue(maxsize=maxsize)
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        # 已确认存在的月分区；_partitioned 为 None 表示还没查过表类型
+        self._months: set = set()
+        self._partitioned: bool | None = None
+
+        # 统计
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_error: str | None = None
+
+    def submit(self, query: str, bucket: str | None, answer: str,
+               timings: dict | None = None,
+               prompt_tokens: int | None = None,
+               completion_tokens: int | None = None) -> bool:
+        """非阻塞入队；队列满返回 False（计入 dropped）"""
+        self._ensure_started()
+        row = (datetime.now(timezone.utc), query, bucket, answer[:5000],  # 防爆长
+               Json(dict(timings)) if timings else None, prompt_tokens, completion_tokens)
+        try:
+            self._q.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.submitted += 1
+        return True
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="query-log-writer", daemon=True)
+                self._thread.start()
+
+    def start(self):
+        self._ensure_started()
+
+    def ensure_table(self):
+        with get_conn() as conn:
+            cur = conn.cursor()
+            if LOG_PARTITIONED and log_relkind(cur) is None:
+                cur.execute("CREATE SEQUENCE IF NOT EXISTS query_logs_id_seq")
+                cur.execute(PARTITIONED_LOG_DDL.format(table="query_logs", seq="query_logs_id_seq"))
+                cur.execute("ALTER SEQUENCE query_logs_id_seq OWNED BY query_logs.id")
+            # 分区表上也执行：CREATE 跳过，ADD COLUMN IF NOT EXISTS 不做任何事
+            cur.execute(LOG_DDL)
+            conn.commit()
+        # 当月和之后几个月的分区先建好
+        month = month_start(datetime.now(timezone.utc))
+        months = [month]
+        for _ in range(LOG_PARTITIONS_AHEAD):
+            months.append(next_month(months[-1]))
+        self._ensure_partitions(months)
+
+    def _ensure_partitions(self, months):
+        """给还没有分区的月份建分区（单独提交）；query_logs 不是分区表时什么也不做"""
+        todo = sorted(m for m in set(months) if m not in self._months)
+        if not todo or self._partitioned is False:
+            return
+        with get_conn() as conn:
+            cur = conn.cursor()
+            if self._partitioned is None:
+                self._partitioned = log_relkind(cur) == "p"
+                if not self._partitioned:
+                    conn.rollback()
+                    return
+            for m in todo:
+                try:
+                    create_log_partition(cur, m)
+                    conn.commit()
+                except Exception as e:
+                    # 并发建同一个分区，或 DEFAULT 分区里已有这个月的行：这个月的日志继续写进 DEFAULT，不影响写入
+                    conn.rollback()
+                    if log_relkind(cur, log_partition_name(m)) is None:
+                        self.last_error = str(e)
+                        print(f"[LOG][WARN] cannot create partition {log_partition_name(m)}: {e}")
+                    conn.rollback()
+                self._months.add(m)
+
+    def _take_batch(self) -> list:
+        """最多等 interval 秒，攒到 batch_size 条就提前返回"""
+        batch = []
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._q.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: list):
+        if not batch:
+            return
+        try:
+            # 跨月时先建新月份的分区，避免落进 DEFAULT 分区
+            self._ensure_partitions({month_start(row[0]) for row in batch})
+            with get_conn() as conn:
+                cur = conn.cursor()
+                execute_values(cur, _INSERT_SQL, batch, page_size=len(batch))
+                conn.commit()
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            self.failed += len(batch)
+            self.last_error = str(e)
+            print(f"[LOG][ERROR] failed to write {len(batch)} query logs: {e}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._write(self._take_batch())
+        # 关停：把队列里剩下的全部写完
+        while True:
+            batch = []
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._q.get_nowait())
+            except queue.Empty:
+                pass
+            if not batch:
+                break
+            self._write(batch)
+
+    def stop(self, timeout: float = 10.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._q.qsize(),
+            "capacity": self._q.maxsize,
+            "submitted": self.submitted,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "batches": self.batches,
+            "last_error": self.last_error,
+        }
+
+
+log_writer = LogWriter(LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL)
+# 非 FastAPI 场景（脚本里直接调 answer_question）退出时也刷一次
+atexit.register(log_writer.stop)
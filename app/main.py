@@ -1,20 +1,66 @@
 # app/main.py
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse, Response
 from pathlib import Path
+import asyncio
+import csv
+import io
+import json
+import math
+from datetime import datetime
 from typing import List, Literal, Optional
 from typing import Dict, Any
-import psycopg2
-from app.config import DB_URL
-from pydantic import BaseModel
-from app.db import get_conn
-from app.config import DB_URL
-from app.rag import answer_question
+import openai
+from pydantic import BaseModel, Field
+from app.db import (
+    get_conn, get_aconn, pool_stats, close_pool,
+    open_async_pool, close_async_pool, async_pool_stats,
+)
+from app.config import ASK_BATCH_MAX, LOG_EXPORT_FETCH
+from app.rag import answer_question_async, answer_batch_async, stream_answer, detect_pgvector_async
+from app.cache import embedding_cache, answer_cache
+from app.logwriter import log_writer
+from app.snapshot import snapshot_store
+from app.limiter import Overloaded, limiter_stats, retry_after
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
 app = FastAPI()
 
+
+@app.on_event("startup")
+async def _startup():
+    await open_async_pool()
+    await embedding_cache.ensure_table_async()
+    await detect_pgvector_async()
+    # 先读一次已有的 bucket：指标标签从第一个请求起就正确
+    await answer_cache.refresh_async()
+    await asyncio.to_thread(log_writer.ensure_table)
+    log_writer.start()
+
+
+@app.on_event("shutdown")
+async def _shutdown():
+    # 先把排队的日志刷进库，再关连接池
+    log_writer.stop()
+    await close_async_pool()
+    close_pool()
+
+
+# 上游限流 / 排队等不到名额：503 + Retry-After，客户端可以退避重试（而不是 500）
+@app.exception_handler(Overloaded)
+async def _overloaded(request: Request, exc: Overloaded):
+    return JSONResponse({"detail": str(exc)}, status_code=503,
+                        headers={"Retry-After": str(math.ceil(exc.retry_after))})
+
+
+@app.exception_handler(openai.RateLimitError)
+async def _rate_limited(request: Request, exc: openai.RateLimitError):
+    wait = max(1, math.ceil(retry_after(exc) or 1))
+    return JSONResponse({"detail": "upstream rate limited"}, status_code=503,
+                        headers={"Retry-After": str(wait)})
+
 # 挂载静态目录
 static_dir = Path(__file__).resolve().parents[1] / "static"
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
@@ -24,23 +70,115 @@ def ui():
     return FileResponse(static_dir / "index.html")
 
 
+_LOG_COLUMNS = ["id", "created_at", "bucket", "query", "answer", "timings", "prompt_tokens", "completion_tokens"]
+
+
+def _log_filters(bucket: str | None, since: datetime | None, until: datetime | None,
+                 before_id: int | None = None) -> tuple[str, list]:
+    """拼 query_logs 的 WHERE；带时间条件时分区表只扫对应月份"""
+    conds, params = [], []
+    if before_id is not None:
+        conds.append("id < %s")
+        params.append(before_id)
+    if bucket is not None:
+        conds.append("bucket = %s")
+        params.append(bucket)
+    if since is not None:
+        conds.append("created_at >= %s")
+        params.append(since)
+    if until is not None:
+        conds.append("created_at < %s")
+        params.append(until)
+    return ("WHERE " + " AND ".join(conds)) if conds else "", params
+
+
 @app.get("/logs")
-def get_logs(limit: int = 50, offset: int = 0):
-    conn = psycopg2.connect(DB_URL)
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT id, created_at, COALESCE(bucket,''), query, answer
-        FROM query_logs
-        ORDER BY id DESC
-        LIMIT %s OFFSET %s
-    """, (limit, offset))
-    rows = cur.fetchall()
-    conn.close()
+def get_logs(response: Response,
+             limit: int = Query(50, ge=1, le=500),
+             before_id: Optional[int] = None,
+             bucket: Optional[str] = None,
+             since: Optional[datetime] = None,
+             until: Optional[datetime] = None):
+    """按 id 倒序的 keyset 分页：下一页传 before_id=上一页最后一条的 id
+    （响应头 X-Next-Before-Id），深翻页也只走索引取 limit 行，不像 OFFSET 要扫过前面所有行"""
+    where, params = _log_filters(bucket, since, until, before_id)
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT id, created_at, COALESCE(bucket,''), query, answer
+            FROM query_logs
+            {where}
+            ORDER BY id DESC
+            LIMIT %s
+        """, params + [limit])
+        rows = cur.fetchall()
+    if len(rows) == limit:
+        response.headers["X-Next-Before-Id"] = str(rows[-1][0])
     return [
         {"id": r[0], "created_at": r[1], "bucket": r[2], "query": r[3], "answer": r[4]}
         for r in rows
     ]
 
+
+def _csv_line(values) -> str:
+    buf = io.StringIO()
+    csv.writer(buf).writerow(values)
+    return buf.getvalue()
+
+
+@app.get("/logs/export")
+async def export_logs(format: Literal["csv", "ndjson"] = "csv",
+                      bucket: Optional[str] = None,
+                      since: Optional[datetime] = None,
+                      until: Optional[datetime] = None):
+    """流式导出 query_logs（按 id 升序）：服务端游标每次取 LOG_EXPORT_FETCH 行，
+    边读边写给客户端，内存占用和导出行数无关"""
+    where, params = _log_filters(bucket, since, until)
+    sql = f"SELECT {', '.join(_LOG_COLUMNS)} FROM query_logs {where} ORDER BY id"
+
+    def encode(row) -> str:
+        rec = dict(zip(_LOG_COLUMNS, row))
+        if format == "ndjson":
+            return json.dumps(rec, ensure_ascii=False, default=str) + "\n"
+        if rec["timings"] is not None:
+            rec["timings"] = json.dumps(rec["timings"])
+        return _csv_line(rec.values())
+
+    async def body():
+        if format == "csv":
+            yield _csv_line(_LOG_COLUMNS)
+        async with get_aconn() as conn:
+            async with conn.cursor(name="query_logs_export") as cur:
+                cur.itersize = LOG_EXPORT_FETCH
+                await cur.execute(sql, params)
+                chunk = []
+                async for row in cur:
+                    chunk.append(encode(row))
+                    if len(chunk) >= LOG_EXPORT_FETCH:
+                        yield "".join(chunk)
+                        chunk = []
+                if chunk:
+                    yield "".join(chunk)
+
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        body(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="query_logs_{stamp}.{format}"'},
+    )
+
+
+@app.get("/logs/{log_id}")
+def get_log(log_id: int):
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT {', '.join(_LOG_COLUMNS)} FROM query_logs WHERE id = %s", (log_id,))
+        row = cur.fetchone()
+    if row is None:
+        raise HTTPException(status_code=404, detail="log not found")
+    return dict(zip(_LOG_COLUMNS, row))
+
 @app.get("/")
 def read_root():
     return {"msg": "hello rag"}
@@ -48,23 +186,39 @@ def read_root():
 @app.get("/dbtest")
 def dbtest():
     try:
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT version();")
-        version = cur.fetchone()
-        conn.close()
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT version();")
+            version = cur.fetchone()
         return {
             "ok": True,
             "postgres_version": version,
-            "DB_URL": DB_URL,
+            "pool": pool_stats(),
         }
     except Exception as e:
         return {
             "ok": False,
             "error": str(e),
-            "DB_URL": DB_URL,
         }
 
+@app.get("/stats")
+def stats():
+    """运行时统计：连接池等待时间、使用率等"""
+    return {
+        "db_pool": pool_stats(),
+        "db_async_pool": async_pool_stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "query_log_writer": log_writer.stats(),
+        "snapshot": snapshot_store.stats(),
+        "llm_limiter": limiter_stats(),
+    }
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus 抓取：docrag_stage_seconds{stage,bucket} / docrag_llm_tokens_total 等"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 class HistoryTurn(BaseModel):
     role: Literal["user", "assistant"]
     content: str
@@ -72,17 +226,82 @@ class HistoryTurn(BaseModel):
 class AskRequest(BaseModel):
     query: str
     bucket: Optional[str] = None  # "oncor" / "ercot" / None
-    top_k: int = 6
+    top_k: int = Field(default=6, ge=1, le=100)
     history: List[HistoryTurn] = []
     max_distance: Optional[float] = None   # 允许前端调阈值
+    ef_search: Optional[int] = Field(default=None, ge=1, le=1000)  # HNSW 召回/延迟权衡
+    probes: Optional[int] = Field(default=None, ge=1, le=10000)    # IVFFlat 召回/延迟权衡
 
 @app.post("/ask")
-def ask(req: AskRequest):
-    answer, sources = answer_question(
+async def ask(req: AskRequest):
+    answer, sources = await answer_question_async(
         req.query,
         bucket=req.bucket,
         topk=req.top_k,
         history=[h.model_dump() for h in req.history],  # 传递给 RAG
         max_distance=req.max_distance,
+        ef_search=req.ef_search,
+        probes=req.probes,
     )
     return {"answer": answer, "sources": sources}
+
+
+class AskItem(BaseModel):
+    query: str
+    bucket: Optional[str] = None
+    top_k: int = Field(default=6, ge=1, le=100)
+    history: List[HistoryTurn] = []
+    max_distance: Optional[float] = None
+
+class AskBatchRequest(BaseModel):
+    items: List[AskItem] = Field(min_length=1, max_length=ASK_BATCH_MAX)
+    ef_search: Optional[int] = Field(default=None, ge=1, le=1000)
+    probes: Optional[int] = Field(default=None, ge=1, le=10000)
+
+@app.post("/ask/batch")
+async def ask_batch(req: AskBatchRequest):
+    """一批问题：一次 embedding 请求 + 一条 SQL 检索，chat 有界并发；
+    results 与 items 一一对应，失败的条目带 error 字段"""
+    results = await answer_batch_async(
+        [
+            {
+                "query": it.query,
+                "bucket": it.bucket,
+                "topk": it.top_k,
+                "history": [h.model_dump() for h in it.history],
+                "max_distance": it.max_distance,
+            }
+            for it in req.items
+        ],
+        ef_search=req.ef_search,
+        probes=req.probes,
+    )
+    return {"results": [{"index": i, **r} for i, r in enumerate(results)]}
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+@app.post("/ask/stream")
+async def ask_stream(req: AskRequest):
+    """Server-Sent Events：先推 sources，再逐 token 推回答，最后 done"""
+    async def events():
+        try:
+            async for event, data in stream_answer(
+                req.query,
+                bucket=req.bucket,
+                topk=req.top_k,
+                history=[h.model_dump() for h in req.history],
+                max_distance=req.max_distance,
+                ef_search=req.ef_search,
+                probes=req.probes,
+            ):
+                yield _sse(event, data)
+        except Exception as e:
+            yield _sse("error", {"error": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
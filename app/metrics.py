@@ -0,0 +1,108 @@
+# app/metrics.py
+# 分阶段耗时 + token 统计：导出为 Prometheus 指标（/metrics），同时随 query_logs 每行落库。
+# 注意：多 worker 部署时每个进程各自一份指标，由 Prometheus 按实例抓取汇总。
+import time
+from contextlib import contextmanager, nullcontext
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from app.config import METRICS_BUCKETS
+
+# embed / search / build_context / llm / llm_first_token（流式）/ total 写进直方图，也写进 query_logs.timings；
+# log（日志入队）只有直方图：它发生在这一行日志定稿之后
+
+STAGE_SECONDS = Histogram(
+    "docrag_stage_seconds",
+    "Latency of each /ask pipeline stage",
+    ["stage", "bucket"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+LLM_TOKENS = Counter(
+    "docrag_llm_tokens_total",
+    "Chat completion tokens",
+    ["kind", "bucket"],  # kind = prompt / completion
+)
+ASK_RESULTS = Counter(
+    "docrag_ask_total",
+    "Answered questions by outcome",
+    ["outcome", "bucket"],  # outcome = llm / cached / coalesced / not_found
+)
+
+# OpenAI 调用的并发限制和请求合并（app/limiter.py），kind = embed / chat
+LLM_LIMIT = Gauge("docrag_llm_concurrency_limit", "Current adaptive concurrency limit", ["kind"])
+LLM_IN_FLIGHT = Gauge("docrag_llm_in_flight", "Upstream OpenAI requests in flight", ["kind"])
+LLM_QUEUE_DEPTH = Gauge("docrag_llm_queue_depth", "Callers waiting for an upstream slot", ["kind"])
+LLM_SHED = Counter(
+    "docrag_llm_shed_total",
+    "Calls rejected by the limiter",
+    ["kind", "reason"],  # reason = queue_full / timeout
+)
+LLM_RATE_LIMITED = Counter("docrag_llm_rate_limited_total", "429 responses from OpenAI", ["kind"])
+LLM_COALESCED = Counter("docrag_llm_coalesced_total", "Calls served by an identical in-flight call", ["kind"])
+
+
+# bucket 来自请求参数，不能直接当标签（任意取值会造出无限多的时间序列）：
+# 只认 METRICS_BUCKETS 和数据库里已有的 bucket（answer_cache 轮询 ingest_generations 时更新）
+_known_buckets: frozenset = frozenset(METRICS_BUCKETS)
+
+
+def set_known_buckets(buckets):
+    global _known_buckets
+    _known_buckets = frozenset(METRICS_BUCKETS) | {b for b in buckets if b}
+
+
+def bucket_label(bucket: str | None) -> str:
+    if not bucket:
+        return "all"
+    return bucket if bucket in _known_buckets else "other"
+
+
+class Timings:
+    """一次请求的分阶段耗时（毫秒），同时写入直方图"""
+
+    def __init__(self, bucket: str | None, label: str | None = None):
+        # label：不按 bucket 统计时直接给标签（如 /ask/batch 共享的 "batch"）
+        self.bucket = label or bucket_label(bucket)
+        self.ms: dict[str, float] = {}
+        self.prompt_tokens: int | None = None
+        self.completion_tokens: int | None = None
+        self._t0 = time.perf_counter()
+
+    @contextmanager
+    def span(self, stage: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - t0)
+
+    def add(self, stage: str, seconds: float):
+        # 同一阶段多次进入（如 section 直查 + 向量检索）累加
+        self.ms[stage] = round(self.ms.get(stage, 0.0) + seconds * 1000, 3)
+        self.observe(stage, seconds)
+
+    def observe(self, stage: str, seconds: float):
+        """只记直方图，不进 ms（不写进 query_logs）"""
+        STAGE_SECONDS.labels(stage, self.bucket).observe(seconds)
+
+    def usage(self, usage):
+        """记录 OpenAI 返回的 usage"""
+        if usage is None:
+            return
+        self.prompt_tokens = usage.prompt_tokens
+        self.completion_tokens = usage.completion_tokens
+        LLM_TOKENS.labels("prompt", self.bucket).inc(usage.prompt_tokens or 0)
+        LLM_TOKENS.labels("completion", self.bucket).inc(usage.completion_tokens or 0)
+
+    def outcome(self, outcome: str):
+        ASK_RESULTS.labels(outcome, self.bucket).inc()
+
+    def finish(self) -> dict:
+        """记下 total（到写日志之前为止），返回要写进 query_logs 的各阶段耗时"""
+        self.add("total", time.perf_counter() - self._t0)
+        return self.ms
+
+
+def span(timings: Timings | None, stage: str):
+    """timings 可选：直接调用 search_docs 等函数时不传就不计时"""
+    return timings.span(stage) if timings is not None else nullcontext()
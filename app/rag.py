@@ -1,97 +1,446 @@
 # app/rag.py
-import psycopg2
-from openai import OpenAI
-from app.config import DB_URL, OPENAI_API_KEY
+import asyncio
+import logging
+import re
+import time
+import weakref
+from openai import OpenAI, AsyncOpenAI
+from app.config import OPENAI_API_KEY
+from app.db import get_conn, get_aconn
+from app.cache import embedding_cache, answer_cache, answer_key, normalize_query
+from app.vector import to_array, to_text, from_binary, coarse_order
+from app.logwriter import log_writer
+from app.config import SECTION_FASTPATH, ASK_BATCH_CONCURRENCY, SEARCH_BACKEND
+from app.config import EMBED_QUANT, QUANT_RERANK_FACTOR, ANN_ITERATIVE_SCAN, CONTEXT_DEDUP_DISTANCE
+from app.sections import find_section_label
+from app.tokens import estimate_tokens
+from app.metrics import Timings, span
+from app.context import plan_prompt
+from app.snapshot import snapshot_store
+from app.limiter import embed_limiter, chat_limiter, embed_flight, chat_flight
+
+# 重试交给 app/limiter.py（429 要反馈给自适应并发），两个客户端都关闭 SDK 内置重试
+# 每次检索的细节（距离分布、条款直查命中）只打 debug 日志；统计看 /metrics
+log = logging.getLogger(__name__)
+
+client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+# /ask 用的异步客户端：一个 worker 上可以同时挂几百个 LLM 请求
+aclient = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+
+EMBED_MODEL = "text-embedding-3-small"
+CHAT_MODEL = "gpt-4o-mini"
+
+def log_query(query: str, bucket: str | None, answer: str, timings: Timings | None = None):
+    # 只入队，由后台线程批量写入 query_logs，不占请求延迟
+    if timings is None:
+        log_writer.submit(query, bucket, answer)
+        return
+    ms = timings.finish()
+    t0 = time.perf_counter()
+    log_writer.submit(query, bucket, answer, ms,
+                      timings.prompt_tokens, timings.completion_tokens)
+    # 入队耗时只进直方图：ms 在入队时已经序列化进这一行
+    timings.observe("log", time.perf_counter() - t0)
+
+async def log_query_async(query: str, bucket: str | None, answer: str,
+                          timings: Timings | None = None):
+    log_query(query, bucket, answer, timings)
 
-client = OpenAI(api_key=OPENAI_API_KEY)
-
-def log_query(query: str, bucket: str | None, answer: str):
-    try:
-        import psycopg2
-        from app.config import DB_URL
-        conn = psycopg2.connect(DB_URL)
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO query_logs (query, bucket, answer) VALUES (%s, %s, %s)",
-            (query, bucket, answer[:5000])  # 防爆长
+def embed_query(text: str):
+    # 先查缓存（进程内 LRU → Postgres），命中就不走网络
+    text = normalize_query(text)
+    emb = embedding_cache.get(EMBED_MODEL, text)
+    if emb is not None:
+        return emb
+
+    # 同一文本已有请求在途就等它的结果
+    def fetch():
+        resp = embed_limiter.call_sync(
+            client.embeddings.create,
+            model=EMBED_MODEL,
+            input=text
+        )
+        emb = resp.data[0].embedding
+        embedding_cache.put(EMBED_MODEL, text, emb)
+        return emb
+
+    emb, _ = embed_flight.do((EMBED_MODEL, text), fetch)
+    return emb
+
+async def embed_query_async(text: str):
+    text = normalize_query(text)
+    emb = await embedding_cache.get_async(EMBED_MODEL, text)
+    if emb is not None:
+        return emb
+
+    async def fetch():
+        resp = await embed_limiter.call(
+            aclient.embeddings.create,
+            model=EMBED_MODEL,
+            input=text
         )
-        conn.commit()
-        conn.close()
-    except Exception:
-        pass  # 日志失败不影响主流程
+        emb = resp.data[0].embedding
+        await embedding_cache.put_async(EMBED_MODEL, text, emb)
+        return emb
+
+    emb, _ = await embed_flight.ado((EMBED_MODEL, text), fetch)
+    return emb
+
+
+# chunk 向量只给上下文的近似去重（CONTEXT_DEDUP_DISTANCE）用：关掉时不取；
+# 打开时按 pgvector 二进制格式（vector_send -> bytea，约 6KB）返回，不再转成 real[] 文本
+def _embedding_col(col: str = "embedding") -> str:
+    if CONTEXT_DEDUP_DISTANCE > 0:
+        return f"vector_send({col}) AS embedding"
+    return "NULL::bytea AS embedding"
+
+
+_EMBEDDING = _embedding_col()
+
+# 检索 SQL 模板：{vec} / {where} / {topk} 按驱动替换成各自的占位符
+#   - 异步 psycopg 3：%b（向量走二进制）+ %s，execute(prepare=True) 服务端预编译
+#   - 同步 psycopg2：PREPARE ... AS ... $1 $2，之后 EXECUTE 复用执行计划
+# 距离阈值在 SQL 里过滤：内层按距离取 top-k（走 ANN 索引，配合迭代扫描凑满 k 行），
+# 外层再去掉超过 {max_distance} 的行——阈值不能放进内层 WHERE，否则索引扫描会一直扫到上限
+_SEARCH_SQL = """
+    SELECT * FROM (
+        SELECT id,
+               content_hash,
+               content,
+               source,
+               section,
+               title,
+               page,
+               {embedding},
+               (embedding <-> {vec}) AS distance
+        FROM documents
+        {where}
+        ORDER BY distance
+        LIMIT {topk}
+    ) AS nearest
+    WHERE distance <= {max_distance}
+    ORDER BY distance
+"""
 
-def embed_query(text: str):
-    resp = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=text
-    )
-    return resp.data[0].embedding
+_ASYNC_SEARCH_SQL_BUCKET = _SEARCH_SQL.format(embedding=_EMBEDDING, vec="%b", where="WHERE bucket = %s",
+                                              topk="%s", max_distance="%s")
+_ASYNC_SEARCH_SQL_ALL = _SEARCH_SQL.format(embedding=_EMBEDDING, vec="%b", where="", topk="%s", max_distance="%s")
+
+# 两阶段检索（EMBED_QUANT=halfvec/binary）：内层按量化距离走表达式索引取 {candidates} 个候选，
+# 外层用全精度 embedding 算真实 L2 距离重排取 {topk}；返回的列和 _SEARCH_SQL 一样
+_QUANT_SEARCH_SQL = """
+    SELECT c.id,
+           c.content_hash,
+           c.content,
+           c.source,
+           c.section,
+           c.title,
+           c.page,
+           {embedding},
+           (c.embedding <-> q.v) AS distance
+    FROM (SELECT {vec}::vector AS v) AS q
+    CROSS JOIN LATERAL (
+        SELECT id, content_hash, content, source, section, title, page, embedding
+        FROM documents
+        {where}
+        ORDER BY {coarse}
+        LIMIT {candidates}
+    ) AS c
+    WHERE (c.embedding <-> q.v) <= {max_distance}
+    ORDER BY distance
+    LIMIT {topk}
+"""
 
 
-def _to_pgvector(vec: list[float]) -> str:
-    # pgvector 的文本格式是 [0.1,0.2,0.3]
-    return "[" + ",".join(f"{x:.6f}" for x in vec) + "]"
+def quant_search_sql(mode: str, vec: str, where: str, candidates: str, max_distance: str, topk: str) -> str:
+    return _QUANT_SEARCH_SQL.format(vec=vec, where=where, candidates=candidates, max_distance=max_distance,
+                                    topk=topk, coarse=coarse_order(mode, "q.v"),
+                                    embedding=_embedding_col("c.embedding"))
+
+
+def _candidates(topk: int) -> int:
+    return topk * max(1, QUANT_RERANK_FACTOR)
+
+
+def _coarse_ef(ef_search: int | None, candidates: int) -> int | None:
+    """HNSW 一次最多返回 ef_search 个结果，粗排要的候选数更多时把 ef_search 提上去（默认 40）"""
+    if candidates > (ef_search or 40):
+        return candidates
+    return ef_search
+
+# 条款号直查：走 (section, bucket) B-tree（不带 bucket 时也能用），不需要查询向量；distance 记为 0
+_SECTION_SQL = """
+    SELECT id,
+           content_hash,
+           content,
+           source,
+           section,
+           title,
+           page,
+           {embedding},
+           0.0::float8 AS distance
+    FROM documents
+    WHERE {where}
+    ORDER BY page_start, id
+    LIMIT {topk}
+"""
 
+_ASYNC_SECTION_SQL_BUCKET = _SECTION_SQL.format(embedding=_EMBEDDING, where="bucket = %s AND section = %s", topk="%s")
+_ASYNC_SECTION_SQL_ALL = _SECTION_SQL.format(embedding=_EMBEDDING, where="section = %s", topk="%s")
+
+# name -> (参数类型, 语句)
+_PREPARED = {
+    "rag_section_bucket": ("(text, text, int)",
+                           _SECTION_SQL.format(embedding=_EMBEDDING, where="bucket = $1 AND section = $2", topk="$3")),
+    "rag_section_all": ("(text, int)",
+                        _SECTION_SQL.format(embedding=_EMBEDDING, where="section = $1", topk="$2")),
+    "rag_search_bucket": ("(vector, text, int, float8)",
+                          _SEARCH_SQL.format(embedding=_EMBEDDING, vec="$1", where="WHERE bucket = $2",
+                                             topk="$3", max_distance="$4")),
+    "rag_search_all": ("(vector, int, float8)",
+                       _SEARCH_SQL.format(embedding=_EMBEDDING, vec="$1", where="",
+                                          topk="$2", max_distance="$3")),
+}
+
+if EMBED_QUANT != "none":
+    _PREPARED["rag_qsearch_bucket"] = ("(vector, text, int, float8, int)",
+                                       quant_search_sql(EMBED_QUANT, "$1", "WHERE bucket = $2", "$3", "$4", "$5"))
+    _PREPARED["rag_qsearch_all"] = ("(vector, int, float8, int)",
+                                    quant_search_sql(EMBED_QUANT, "$1", "", "$2", "$3", "$4"))
+    _ASYNC_QSEARCH_SQL_BUCKET = quant_search_sql(EMBED_QUANT, "%b", "WHERE bucket = %s", "%s", "%s", "%s")
+    _ASYNC_QSEARCH_SQL_ALL = quant_search_sql(EMBED_QUANT, "%b", "", "%s", "%s", "%s")
+
+
+# 每个连接上已经 PREPARE 过的语句名（预编译语句是会话级的，连接池复用时一直有效）
+_prepared_on: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def _execute_prepared(conn, name: str, params: tuple):
+    """执行服务端预编译语句；当前连接上还没 PREPARE 过就先 PREPARE"""
+    cur = conn.cursor()
+    done = _prepared_on.setdefault(conn, set())
+    if name not in done:
+        argtypes, body = _PREPARED[name]
+        cur.execute(f"PREPARE {name} {argtypes} AS {body}")
+        done.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    return cur.fetchall()
 
-def search_docs(query: str, bucket: str | None = None, topk: int = 6, max_distance: float = 1.2):
-    # 生成查询向量
-    q_emb = embed_query(query)
-    q_vec_literal = _to_pgvector(q_emb)  # 变成 "[0.123,0.456,...]" 这种
 
-    conn = psycopg2.connect(DB_URL)
-    cur = conn.cursor()
+# 每个请求可调的 ANN 召回/延迟参数，只在当前事务内生效（set_config(..., true)）
+#   ef_search 越大 HNSW 召回越高、越慢；probes 同理作用于 IVFFlat
+#   迭代扫描（ANN_ITERATIVE_SCAN）：带 bucket 过滤时索引扫完 ef_search 个候选还不够 k 行就继续扫；
+#   需要 pgvector >= 0.8，启动时 detect_pgvector_async() 查一次版本，旧版本上不设置
+#   所有参数合成一条 SELECT，一次往返
+_iterative_scan = "off"
+
+
+def _pgvector_version(extversion: str | None) -> tuple:
+    return tuple(int(x) for x in re.findall(r"\d+", extversion)[:3]) if extversion else (0,)
 
-    if bucket:
-        sql = f"""
-            SELECT content,
-                   source,
-                   section,
-                   title,
-                   page,
-                   (embedding <-> '{q_vec_literal}'::vector) AS distance
-            FROM documents
-            WHERE bucket = %s
-            ORDER BY distance
-            LIMIT %s;
-        """
-        cur.execute(sql, (bucket, topk))
+
+_PGVECTOR_VERSION_SQL = "SELECT extversion FROM pg_extension WHERE extname = 'vector'"
+
+
+def _apply_pgvector_version(row) -> str:
+    global _iterative_scan
+    found = row[0] if row else None
+    if _pgvector_version(found) >= (0, 8, 0):
+        _iterative_scan = ANN_ITERATIVE_SCAN
     else:
-        sql = f"""
-            SELECT content,
-                   source,
-                   section,
-                   title,
-                   page,
-                   (embedding <-> '{q_vec_literal}'::vector) AS distance
-            FROM documents
-            ORDER BY distance
-            LIMIT %s;
-        """
-        cur.execute(sql, (topk,))
-
-    rows = cur.fetchall()
-    conn.close()
+        print(f"[RAG][WARN] ANN_ITERATIVE_SCAN={ANN_ITERATIVE_SCAN} needs pgvector >= 0.8.0 "
+              f"(found {found or 'none'}); iterative scans stay off")
+    return _iterative_scan
+
+
+async def detect_pgvector_async() -> str:
+    """读一次 pg_extension 里的 pgvector 版本，决定检索时要不要打开迭代扫描；返回实际生效的值"""
+    if ANN_ITERATIVE_SCAN == "off":
+        return _iterative_scan
+    async with get_aconn() as conn:
+        cur = await conn.execute(_PGVECTOR_VERSION_SQL)
+        row = await cur.fetchone()
+    return _apply_pgvector_version(row)
+
+
+def detect_pgvector() -> str:
+    """detect_pgvector_async 的同步版本（脚本 / 同步连接池）"""
+    if ANN_ITERATIVE_SCAN == "off":
+        return _iterative_scan
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(_PGVECTOR_VERSION_SQL)
+        row = cur.fetchone()
+    return _apply_pgvector_version(row)
 
+
+def _knobs(ef_search: int | None, probes: int | None) -> tuple[str, tuple] | None:
+    settings = []
+    if ef_search is not None:
+        settings.append(("hnsw.ef_search", str(ef_search)))
+    if probes is not None:
+        settings.append(("ivfflat.probes", str(probes)))
+    if _iterative_scan != "off":
+        settings.append(("hnsw.iterative_scan", _iterative_scan))
+        # IVFFlat 没有 strict_order，退到 relaxed_order
+        settings.append(("ivfflat.iterative_scan",
+                         "relaxed_order" if _iterative_scan == "strict_order" else _iterative_scan))
+    if not settings:
+        return None
+    sql = "SELECT " + ", ".join(["set_config(%s, %s, true)"] * len(settings))
+    return sql, tuple(v for kv in settings for v in kv)
+
+
+def _set_knobs(cur, ef_search: int | None, probes: int | None):
+    knobs = _knobs(ef_search, probes)
+    if knobs:
+        cur.execute(*knobs)
+
+
+async def _set_knobs_async(conn, ef_search: int | None, probes: int | None):
+    knobs = _knobs(ef_search, probes)
+    if knobs:
+        await conn.execute(*knobs)
+
+
+def _rows_to_results(rows, max_distance: float) -> list[dict]:
     results = []
-    for content, source, section, title, page, distance in rows:
-        # 简单日志，便于你在控制台观察分布
-        try:
-            print(f"[RAG] distance={float(distance):.3f}  {source} p{page}")
-        except Exception:
-            pass
+    debug = log.isEnabledFor(logging.DEBUG)
+    for doc_id, content_hash, content, source, section, title, page, embedding, distance in rows:
+        if debug and distance is not None:
+            log.debug("[RAG] distance=%.3f  %s p%s", float(distance), source, page)
 
         # 相似度阈值过滤
         if distance is not None and distance <= max_distance:
             results.append({
+                "id": doc_id,
+                "content_hash": content_hash,
                 "content": content,
                 "source": source,
                 "section": section,
                 "title": title,
                 "page": page,
+                # 拼上下文时做近似去重；SQL 返回 vector_send 的字节（或 NULL），快照返回 ndarray
+                "embedding": from_binary(embedding) if isinstance(embedding, (bytes, memoryview)) else embedding,
                 "distance": float(distance),
             })
     return results
 
+
+def _snapshot():
+    """SEARCH_BACKEND=snapshot 且已有快照时返回它；否则 None（回退到 pgvector）。
+    快照是精确检索，ef_search / probes 不适用。"""
+    if SEARCH_BACKEND != "snapshot":
+        return None
+    snap = snapshot_store.get()
+    if snap is not None:
+        snapshot_store.searches += 1
+    return snap
+
+
+def search_docs(query: str, bucket: str | None = None, topk: int = 6, max_distance: float = 1.2,
+                ef_search: int | None = None, probes: int | None = None,
+                timings: Timings | None = None):
+    # 问题里直接点名条款号：先精确查，命中就不用 embedding + 向量扫描
+    snap = _snapshot()
+    label = find_section_label(query) if SECTION_FASTPATH else None
+    if label and snap is not None:
+        with span(timings, "search"):
+            rows = snap.section_rows(bucket, label, topk)
+        if rows:
+            log.debug("[RAG] section fast path (snapshot): %s -> %d rows", label, len(rows))
+            return _rows_to_results(rows, max_distance)
+    elif label:
+        with span(timings, "search"), get_conn() as conn:
+            if bucket:
+                rows = _execute_prepared(conn, "rag_section_bucket", (bucket, label, topk))
+            else:
+                rows = _execute_prepared(conn, "rag_section_all", (label, topk))
+        if rows:
+            log.debug("[RAG] section fast path: %s -> %d rows", label, len(rows))
+            return _rows_to_results(rows, max_distance)
+
+    # 生成查询向量；psycopg2 只能传文本参数，但语句本身已预编译
+    with span(timings, "embed"):
+        q_emb = embed_query(query)
+    if snap is not None:
+        with span(timings, "search"):
+            rows = snap.search(to_array(q_emb), bucket, topk)
+        return _rows_to_results(rows, max_distance)
+    q_vec_literal = to_text(q_emb)
+
+    with span(timings, "search"), get_conn() as conn:
+        if EMBED_QUANT != "none":
+            cand = _candidates(topk)
+            _set_knobs(conn.cursor(), _coarse_ef(ef_search, cand), probes)
+            if bucket:
+                rows = _execute_prepared(conn, "rag_qsearch_bucket",
+                                         (q_vec_literal, bucket, cand, max_distance, topk))
+            else:
+                rows = _execute_prepared(conn, "rag_qsearch_all", (q_vec_literal, cand, max_distance, topk))
+        else:
+            _set_knobs(conn.cursor(), ef_search, probes)
+            if bucket:
+                rows = _execute_prepared(conn, "rag_search_bucket", (q_vec_literal, bucket, topk, max_distance))
+            else:
+                rows = _execute_prepared(conn, "rag_search_all", (q_vec_literal, topk, max_distance))
+
+    return _rows_to_results(rows, max_distance)
+
+
+async def search_docs_async(query: str, bucket: str | None = None, topk: int = 6,
+                            max_distance: float = 1.2,
+                            ef_search: int | None = None, probes: int | None = None,
+                            timings: Timings | None = None):
+    snap = _snapshot()
+    label = find_section_label(query) if SECTION_FASTPATH else None
+    if label and snap is not None:
+        with span(timings, "search"):
+            rows = await asyncio.to_thread(snap.section_rows, bucket, label, topk)
+        if rows:
+            log.debug("[RAG] section fast path (snapshot): %s -> %d rows", label, len(rows))
+            return _rows_to_results(rows, max_distance)
+    elif label:
+        if bucket:
+            sql, params = _ASYNC_SECTION_SQL_BUCKET, (bucket, label, topk)
+        else:
+            sql, params = _ASYNC_SECTION_SQL_ALL, (label, topk)
+        with span(timings, "search"):
+            async with get_aconn() as conn:
+                cur = await conn.execute(sql, params, prepare=True, binary=True)
+                rows = await cur.fetchall()
+        if rows:
+            log.debug("[RAG] section fast path: %s -> %d rows", label, len(rows))
+            return _rows_to_results(rows, max_distance)
+
+    with span(timings, "embed"):
+        q_vec = to_array(await embed_query_async(query))
+
+    if snap is not None:
+        # numpy 矩阵乘法会释放 GIL，放到线程里不阻塞事件循环
+        with span(timings, "search"):
+            rows = await asyncio.to_thread(snap.search, q_vec, bucket, topk)
+        return _rows_to_results(rows, max_distance)
+
+    if EMBED_QUANT != "none":
+        cand = _candidates(topk)
+        ef_search = _coarse_ef(ef_search, cand)
+        if bucket:
+            sql, params = _ASYNC_QSEARCH_SQL_BUCKET, (q_vec, bucket, cand, max_distance, topk)
+        else:
+            sql, params = _ASYNC_QSEARCH_SQL_ALL, (q_vec, cand, max_distance, topk)
+    elif bucket:
+        sql, params = _ASYNC_SEARCH_SQL_BUCKET, (q_vec, bucket, topk, max_distance)
+    else:
+        sql, params = _ASYNC_SEARCH_SQL_ALL, (q_vec, topk, max_distance)
+    with span(timings, "search"):
+        async with get_aconn() as conn:
+            await _set_knobs_async(conn, ef_search, probes)
+            cur = await conn.execute(sql, params, prepare=True, binary=True)
+            rows = await cur.fetchall()
+
+    return _rows_to_results(rows, max_distance)
+
 def is_chinese(text: str) -> bool:
     return any("\u4e00" <= ch <= "\u9fff" for ch in text)
 
@@ -127,23 +476,21 @@ Answer:
 """
 
 
-def answer_question(query: str, bucket: str | None = None, topk: int = 6, 
-                    history: list[dict] | None = None,
-                    max_distance: float | None = None):
-    chunks = search_docs(query, bucket=bucket, topk=topk,
-                         max_distance=(max_distance if max_distance is not None else 1.2))
-    if not chunks:
-        if is_chinese(query):
-            ans = "未找到相关内容，请确认文档是否已导入或换个说法再试。"
-        else:
-            ans = "No relevant content found. Please check if the document is loaded or try rephrasing your question."
-        return ans, []
+def _not_found_answer(query: str) -> str:
+    if is_chinese(query):
+        return "未找到相关内容，请确认文档是否已导入或换个说法再试。"
+    return "No relevant content found. Please check if the document is loaded or try rephrasing your question."
 
-    context = build_context(chunks)
 
-    # 只取最近 6 轮历史，避免提示太长
-    history = history or []
-    recent = history[-6:]
+def _build_prompt(query: str, chunks: list[dict], history: list[dict] | None):
+    """返回 (prompt, 实际放进上下文的 chunk)：去重 + 按 token 预算截断上下文和历史"""
+    # 语言设置
+    prompt = BASE_PROMPT
+    if is_chinese(query):
+        prompt += "\nAnswer in Chinese. Keep section numbers and document names in English.\n"
+
+    context, used, recent = plan_prompt(query, chunks, history,
+                                        template_tokens=estimate_tokens(prompt) + 20)
 
     # 把历史拼成一段可读文本
     hist_text = "\n".join(
@@ -151,32 +498,23 @@ def answer_question(query: str, bucket: str | None = None, topk: int = 6,
         for h in recent
     )
 
-    # 语言设置
-    prompt = BASE_PROMPT
-    if is_chinese(query):
-        prompt += "\nAnswer in Chinese. Keep section numbers and document names in English.\n"
-
-    # 合成最终提示：历史 + 上下文 + 当前问题
+    # 合成最终提示：历史 + 上下文 + 当前问题（先填模板，历史里的花括号不会被当成占位符）
+    prompt = prompt.format(context=context, question=query)
     if hist_text:
         prompt = (
             "Conversation so far:\n"
             f"{hist_text}\n\n"
         ) + prompt
 
-    prompt = prompt.format(context=context, question=query)
+    return prompt, used
 
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0
-    )
-    answer = resp.choices[0].message.content
 
+def _format_sources(chunks: list[dict]) -> list[dict]:
     # 去重来源
     deduped = _dedup_sources(chunks)
 
     SNIPPET_LEN = 5000
-    formatted_sources = [
+    return [
         {
             "doc": c["source"],
             "page": c["page"],
@@ -186,13 +524,335 @@ def answer_question(query: str, bucket: str | None = None, topk: int = 6,
         for c in deduped
     ]
 
-    # log query
+
+def answer_question(query: str, bucket: str | None = None, topk: int = 6,
+                    history: list[dict] | None = None,
+                    max_distance: float | None = None,
+                    ef_search: int | None = None, probes: int | None = None):
+    max_distance = max_distance if max_distance is not None else 1.2
+    timings = Timings(bucket)
+    chunks = search_docs(query, bucket=bucket, topk=topk, max_distance=max_distance,
+                         ef_search=ef_search, probes=probes, timings=timings)
     if not chunks:
-        ans = "未找到相关内容，请确认文档是否已导入或换个说法再试。" if is_chinese(query) \
-            else "No relevant content found. Please check if the document is loaded or try rephrasing your question."
-        log_query(query, bucket, ans)
-        return ans, []
-    log_query(query, bucket, answer)
+        timings.outcome("not_found")
+        timings.finish()
+        return _not_found_answer(query), []
+
+    # 同样的请求 + 同样的检索结果：直接用缓存的回答，跳过 LLM
+    answer_cache.refresh()
+    key = answer_key(query, bucket, topk, max_distance, history, chunks)
+    cached = answer_cache.get(key)
+    if cached is not None:
+        _, answer, sources = cached
+        timings.outcome("cached")
+        log_query(query, bucket, answer, timings)
+        return answer, sources
+
+    with timings.span("build_context"):
+        prompt, used = _build_prompt(query, chunks, history)
+
+    # 同一个回答缓存键（同样的问题 + 同样的检索结果）已有 chat 在途就等它的结果
+    with timings.span("llm"):
+        resp, coalesced = chat_flight.do(key, lambda: chat_limiter.call_sync(
+            client.chat.completions.create,
+            model=CHAT_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0
+        ))
+    answer = resp.choices[0].message.content
+    if coalesced:
+        timings.outcome("coalesced")   # token 记在发起的那个请求上
+    else:
+        timings.usage(resp.usage)
+        timings.outcome("llm")
+
+    # log query
+    log_query(query, bucket, answer, timings)
+
+    sources = _format_sources(used)
+    answer_cache.put(key, bucket, answer, sources)
+    return answer, sources
 
-    return answer, formatted_sources
 
+async def answer_question_async(query: str, bucket: str | None = None, topk: int = 6,
+                                history: list[dict] | None = None,
+                                max_distance: float | None = None,
+                                ef_search: int | None = None, probes: int | None = None):
+    """answer_question 的异步版本：embedding / pgvector / chat 全程不占线程"""
+    max_distance = max_distance if max_distance is not None else 1.2
+    timings = Timings(bucket)
+    chunks = await search_docs_async(query, bucket=bucket, topk=topk, max_distance=max_distance,
+                                     ef_search=ef_search, probes=probes, timings=timings)
+    return await _answer_chunks_async(query, bucket, topk, history, max_distance, chunks, timings)
+
+
+async def _answer_chunks_async(query: str, bucket: str | None, topk: int,
+                               history: list[dict] | None, max_distance: float,
+                               chunks: list[dict], timings: Timings):
+    """检索之后的部分：回答缓存 → 拼提示 → chat → 记日志"""
+    if not chunks:
+        timings.outcome("not_found")
+        timings.finish()
+        return _not_found_answer(query), []
+
+    await answer_cache.refresh_async()
+    key = answer_key(query, bucket, topk, max_distance, history, chunks)
+    cached = answer_cache.get(key)
+    if cached is not None:
+        _, answer, sources = cached
+        timings.outcome("cached")
+        await log_query_async(query, bucket, answer, timings)
+        return answer, sources
+
+    with timings.span("build_context"):
+        prompt, used = _build_prompt(query, chunks, history)
+
+    with timings.span("llm"):
+        resp, coalesced = await chat_flight.ado(key, lambda: chat_limiter.call(
+            aclient.chat.completions.create,
+            model=CHAT_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0
+        ))
+    answer = resp.choices[0].message.content
+    if coalesced:
+        timings.outcome("coalesced")
+    else:
+        timings.usage(resp.usage)
+        timings.outcome("llm")
+
+    await log_query_async(query, bucket, answer, timings)
+
+    sources = _format_sources(used)
+    answer_cache.put(key, bucket, answer, sources)
+    return answer, sources
+
+
+# ------------ 批量问答（/ask/batch）------------
+# 一批问题：一次 embeddings 请求 + 一条 SQL（VALUES 列表 LATERAL JOIN 每个向量的 top-k），
+# chat 按 ASK_BATCH_CONCURRENCY 并发；结果按输入顺序返回，单条失败不影响其它条。
+# 按 bucket 分组，每组一个 LATERAL 分支（UNION ALL）：组内是 bucket = 常量参数，
+# 规划时能裁掉其它分区、用上该分区的 ANN 索引；不带 bucket 的组不加条件。
+_BATCH_BRANCH_SQL = """
+    SELECT q.ord,
+           d.id,
+           d.content_hash,
+           d.content,
+           d.source,
+           d.section,
+           d.title,
+           d.page,
+           d.embedding,
+           d.distance
+    FROM (VALUES {values}) AS q(ord, vec, topk, max_distance)
+    CROSS JOIN LATERAL (
+        SELECT id,
+               content_hash,
+               content,
+               source,
+               section,
+               title,
+               page,
+               {embedding},
+               (embedding <-> q.vec) AS distance
+        FROM {source}
+        {where}
+        ORDER BY distance
+        LIMIT q.topk
+    ) AS d
+    WHERE d.distance <= q.max_distance
+"""
+# EMBED_QUANT 时每个查询先按量化距离取 topk × factor 个候选，外层同样按全精度距离重排
+_BATCH_CANDIDATES = """(
+            SELECT * FROM documents
+            {where}
+            ORDER BY {coarse}
+            LIMIT q.topk * {factor}
+        ) AS documents"""
+_BATCH_VALUE = "(%s::int, %b::vector, %s::int, %s::float8)"
+
+
+def _batch_search_sql(items: list[dict], embeddings: list) -> tuple[str, list]:
+    """每个 bucket 一个分支；参数顺序和 SQL 里占位符的顺序一致（VALUES 在前，bucket 在后）"""
+    groups: dict = {}
+    for i, it in enumerate(items):
+        groups.setdefault(it["bucket"], []).append(i)
+    branches, params = [], []
+    for bucket, idxs in groups.items():
+        where = "WHERE bucket = %s" if bucket is not None else ""
+        if EMBED_QUANT != "none":
+            source = _BATCH_CANDIDATES.format(where=where, coarse=coarse_order(EMBED_QUANT, "q.vec"),
+                                              factor=max(1, QUANT_RERANK_FACTOR))
+            where_outer = ""
+        else:
+            source, where_outer = "documents", where
+        branches.append(_BATCH_BRANCH_SQL.format(values=", ".join([_BATCH_VALUE] * len(idxs)),
+                                                 source=source, where=where_outer, embedding=_EMBEDDING))
+        for i in idxs:
+            params += [i, to_array(embeddings[i]), items[i]["topk"], items[i]["max_distance"]]
+        if bucket is not None:
+            params.append(bucket)
+    return "UNION ALL".join(branches) + "    ORDER BY ord, distance", params
+
+
+async def embed_queries_async(texts: list[str]) -> list:
+    """多条查询一次 embeddings 请求（先查缓存，相同文本只算一次），返回与 texts 对应的向量"""
+    norm = [normalize_query(t) for t in texts]
+    found: dict[str, list] = {}
+    for t in dict.fromkeys(norm):
+        emb = await embedding_cache.get_async(EMBED_MODEL, t)
+        if emb is not None:
+            found[t] = emb
+    missing = [t for t in dict.fromkeys(norm) if t not in found]
+    if missing:
+        # 逐条登记到 embed_flight：和同时在途的 /ask 共用同一次上游调用
+        async def fetch(keys):
+            batch = [t for _, t in keys]
+            resp = await embed_limiter.call(aclient.embeddings.create, model=EMBED_MODEL, input=batch)
+            out = {}
+            for d in sorted(resp.data, key=lambda d: d.index):
+                t = batch[d.index]
+                out[(EMBED_MODEL, t)] = d.embedding
+                await embedding_cache.put_async(EMBED_MODEL, t, d.embedding)
+            return out
+
+        got = await embed_flight.ado_many([(EMBED_MODEL, t) for t in missing], fetch)
+        for (_, t), emb in got.items():
+            found[t] = emb
+    return [found[t] for t in norm]
+
+
+async def search_many_async(items: list[dict], embeddings: list,
+                            ef_search: int | None = None, probes: int | None = None) -> list[list[dict]]:
+    """items: {bucket, topk, max_distance}；一条 SQL 取回所有查询的 top-k，按输入顺序分组"""
+    snap = _snapshot()
+    if snap is not None:
+        def run():
+            return [snap.search(to_array(emb), it["bucket"], it["topk"]) for it, emb in zip(items, embeddings)]
+        groups = await asyncio.to_thread(run)
+        return [_rows_to_results(g, it["max_distance"]) for g, it in zip(groups, items)]
+
+    sql, params = _batch_search_sql(items, embeddings)
+    async with get_aconn() as conn:
+        if EMBED_QUANT != "none":
+            ef_search = _coarse_ef(ef_search, _candidates(max(it["topk"] for it in items)))
+        await _set_knobs_async(conn, ef_search, probes)
+        cur = await conn.execute(sql, params, binary=True)
+        rows = await cur.fetchall()
+
+    grouped: list[list] = [[] for _ in items]
+    for row in rows:
+        grouped[row[0]].append(row[1:])
+    return [_rows_to_results(g, it["max_distance"]) for g, it in zip(grouped, items)]
+
+
+async def answer_batch_async(items: list[dict], ef_search: int | None = None,
+                             probes: int | None = None,
+                             concurrency: int = ASK_BATCH_CONCURRENCY) -> list[dict]:
+    """items: {query, bucket, topk, history, max_distance}；
+    返回同样顺序的 [{"answer", "sources"} | {"error"}]"""
+    items = [{**it, "max_distance": it.get("max_distance") if it.get("max_distance") is not None else 1.2}
+             for it in items]
+    timings = [Timings(it["bucket"]) for it in items]
+
+    # embedding + 检索整批只做一次，直方图记一次，耗时复制进每条日志
+    shared = Timings(None, label="batch")
+    try:
+        with shared.span("embed"):
+            embeddings = await embed_queries_async([it["query"] for it in items])
+        with shared.span("search"):
+            results = await search_many_async(items, embeddings, ef_search=ef_search, probes=probes)
+    except Exception as e:
+        log.warning("[RAG][BATCH] retrieval failed for %d queries: %s", len(items), e)
+        return [{"error": f"retrieval failed: {e}"} for _ in items]
+    for t in timings:
+        t.ms.update(shared.ms)
+
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def one(it: dict, chunks: list[dict], t: Timings) -> dict:
+        async with sem:
+            try:
+                answer, sources = await _answer_chunks_async(
+                    it["query"], it["bucket"], it["topk"], it.get("history"),
+                    it["max_distance"], chunks, t)
+                return {"answer": answer, "sources": sources}
+            except Exception as e:
+                return {"error": str(e)}
+
+    return await asyncio.gather(*(one(it, chunks, t) for it, chunks, t in zip(items, results, timings)))
+
+
+async def stream_answer(query: str, bucket: str | None = None, topk: int = 6,
+                        history: list[dict] | None = None,
+                        max_distance: float | None = None,
+                        ef_search: int | None = None, probes: int | None = None):
+    """流式回答：检索完先产出 ("sources", [...])，然后逐段产出 ("token", "...")，
+    最后 ("done", {})。完整回答在流结束后写入 query_logs。
+    """
+    max_distance = max_distance if max_distance is not None else 1.2
+    timings = Timings(bucket)
+    chunks = await search_docs_async(query, bucket=bucket, topk=topk, max_distance=max_distance,
+                                     ef_search=ef_search, probes=probes, timings=timings)
+    if not chunks:
+        timings.outcome("not_found")
+        timings.finish()
+        yield "sources", []
+        yield "token", _not_found_answer(query)
+        yield "done", {}
+        return
+
+    # 先拼好上下文，推给前端的来源就是 LLM 实际看到的 chunk
+    with timings.span("build_context"):
+        prompt, used = _build_prompt(query, chunks, history)
+    sources = _format_sources(used)
+    yield "sources", sources
+
+    await answer_cache.refresh_async()
+    key = answer_key(query, bucket, topk, max_distance, history, chunks)
+    cached = answer_cache.get(key)
+    if cached is not None:
+        _, answer, _ = cached
+        yield "token", answer
+        timings.outcome("cached")
+        await log_query_async(query, bucket, answer, timings)
+        yield "done", {"cached": True}
+        return
+
+    # llm 只算模型生成的时间，不含 yield 之后客户端读流的时间
+    # 流式回答不做请求合并（token 要逐个推给各自的客户端）；名额一直占到流读完
+    llm_seconds = 0.0
+    t0 = time.perf_counter()
+    stream = await chat_limiter.call(
+        aclient.chat.completions.create,
+        model=CHAT_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0,
+        stream=True,
+        stream_options={"include_usage": True},  # 最后一个事件带 usage
+        hold=True,
+    )
+    parts = []
+    ok = False
+    try:
+        async for event in stream:
+            llm_seconds += time.perf_counter() - t0
+            if event.usage is not None:
+                timings.usage(event.usage)
+            delta = event.choices[0].delta.content if event.choices else None
+            if delta:
+                if not parts:
+                    timings.add("llm_first_token", llm_seconds)
+                parts.append(delta)
+                yield "token", delta
+            t0 = time.perf_counter()
+        ok = True
+    finally:
+        chat_limiter.release(ok)
+    timings.add("llm", llm_seconds)
+    timings.outcome("llm")
+
+    answer = "".join(parts)
+    await log_query_async(query, bucket, answer, timings)
+    answer_cache.put(key, bucket, answer, sources)
+    yield "done", {}
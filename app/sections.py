@@ -0,0 +1,53 @@
+# app/sections.py
+# 标题 / 条款号识别：scripts.ingest 切分 PDF 时用 detect_heading，app.rag 用 find_section_label 识别问题里的条款号
+import re
+from typing import Optional, Tuple
+
+SEC_PATTERNS = [
+    # "Section 3.3.1  Title"
+    re.compile(r'(?i)^\s*(section)\s+(\d+(?:\.\d+)+)\s*[:\-–]?\s*(.*\S)?\s*$'),
+    # "3.3.1  Title"
+    re.compile(r'^\s*(\d+(?:\.\d+){1,6})\s+([A-Z][^\n]{0,120})?\s*$'),
+    # Oncor 常见条款："6.1.1.1.5 Distribution System Charge (DSC)"
+    re.compile(r'^\s*(\d+(?:\.\d+){2,7})\s+([A-Za-z][^\n]{0,160})\s*$'),
+]
+
+def detect_heading(line: str) -> Optional[Tuple[str, str]]:
+    """匹配返回 (section_label, title)。匹配失败返回 None。"""
+    for pat in SEC_PATTERNS:
+        m = pat.match(line)
+        if not m:
+            continue
+        groups = [g for g in m.groups() if g is not None]
+        # 根据不同正则形态回组
+        if len(groups) == 3 and groups[0].lower() == "section":
+            # e.g. "Section 3.3.1 Title"
+            return (groups[1], groups[2] or "")
+        elif len(groups) == 2:
+            # e.g. "3.3.1 Title"
+            return (groups[0], groups[1] or "")
+    return None
+
+
+# ------------ 问题里的条款号 ------------
+# 明确点名："Section 3.3.1" / "sec. 3.3" / "§6.1.1" / "第 6.1.1 条"
+_NAMED = re.compile(r'(?i)(?:\bsection|\bsec\.?|§|第)\s*(\d+(?:\.\d+)+)')
+# 没有前缀时至少三级（6.1.1），避免把 "2.5 MW" 之类的小数当成条款
+_BARE = re.compile(r'(?<![\d.])(\d+(?:\.\d+){2,7})(?![\d.]*\d)')
+# 没有前缀的三级数字也可能是日期："2024.01.05" / "5.1.2024"
+_DATE = re.compile(r'(?:19|20)\d{2}\.\d{1,2}\.\d{1,2}|\d{1,2}\.\d{1,2}\.(?:19|20)\d{2}')
+
+
+def find_section_label(query: str) -> Optional[str]:
+    """从问题里找条款号，找不到返回 None。
+    少于三级的条款号必须带前缀（Section / § / 第…），整句像标题（"2.5 MW is the limit?"）也不例外；
+    误判会让问题走条款直查、跳过向量检索。
+    """
+    text = query.strip()
+    m = _NAMED.search(text)
+    if m:
+        return m.group(1)
+    for m in _BARE.finditer(text):
+        if not _DATE.fullmatch(m.group(1)):
+            return m.group(1)
+    return None
@@ -0,0 +1,184 @@
+# app/snapshot.py
+# 只读向量快照检索（SEARCH_BACKEND=snapshot）：
+#   - scripts/snapshot.py 导出的矩阵和元数据用 np.load(mmap_mode="r") 映射，多个 worker 共享 OS 页缓存
+#   - 精确 L2 top-k：分块做 X @ q（float16 分块转 float32），argpartition 取前 k，不走数据库
+#   - 每 SNAPSHOT_POLL 秒看一次 CURRENT，发现新快照就加载并原子替换引用，正在进行的查询继续用旧的
+import json
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from app.config import SNAPSHOT_DIR, SNAPSHOT_POLL
+
+BLOCK_ROWS = 16384     # 每块转 float32 的行数：1536 维时约 100MB
+
+
+def read_current(root: Path) -> str | None:
+    try:
+        return (root / "CURRENT").read_text(encoding="utf-8").strip() or None
+    except FileNotFoundError:
+        return None
+
+
+class _Strings:
+    """UTF-8 拼接 + 偏移数组的字符串列，按需解码单行"""
+
+    def __init__(self, base: Path):
+        self.offsets = np.load(f"{base}.idx.npy", mmap_mode="r")
+        self.nulls = np.load(f"{base}.null.npy", mmap_mode="r")
+        size = int(self.offsets[-1]) if len(self.offsets) else 0
+        self.data = np.memmap(f"{base}.bin", dtype=np.uint8, mode="r") if size else np.zeros(0, np.uint8)
+
+    def __getitem__(self, i: int) -> str | None:
+        if self.nulls[i]:
+            return None
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+
+class VectorSnapshot:
+    def __init__(self, path: Path):
+        self.path = path
+        self.name = path.name
+        self.meta = json.loads((path / "meta.json").read_text(encoding="utf-8"))
+        self.vectors = np.load(path / "vectors.npy", mmap_mode="r")
+        self.norms = np.load(path / "norms.npy", mmap_mode="r")
+        self.ids = np.load(path / "ids.npy", mmap_mode="r")
+        self.pages = np.load(path / "pages.npy", mmap_mode="r")
+        codes = np.load(path / "buckets.npy")
+        self.strings = {c: _Strings(path / c) for c in ("content_hash", "content", "source", "section", "title")}
+        # bucket -> 行号数组：带 bucket 过滤的查询只扫这些行
+        self.bucket_rows = {b: np.flatnonzero(codes == k) for k, b in enumerate(self.meta["buckets"])}
+        self._codes = codes
+        self._sections: dict | None = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return int(self.meta["count"])
+
+    def _rows(self, bucket: str | None):
+        if bucket is None:
+            return None
+        return self.bucket_rows.get(bucket, np.zeros(0, dtype=np.int64))
+
+    def search(self, q: np.ndarray, bucket: str | None, topk: int) -> list[tuple]:
+        """返回和 SQL 检索同样结构的行：(id, content_hash, content, source, section, title, page, embedding, distance)"""
+        q = np.asarray(q, dtype=np.float32)
+        rows = self._rows(bucket)
+        n = len(self) if rows is None else len(rows)
+        if n == 0 or topk <= 0:
+            return []
+
+        # ||x - q||² = ||x||² - 2·x·q + ||q||²，||x||² 导出时已算好
+        best_idx = np.zeros(0, dtype=np.int64)
+        best_d2 = np.zeros(0, dtype=np.float32)
+        for s in range(0, n, BLOCK_ROWS):
+            e = min(n, s + BLOCK_ROWS)
+            if rows is None:
+                idx = np.arange(s, e)
+                block = self.vectors[s:e]
+            else:
+                idx = rows[s:e]
+                block = self.vectors[idx]
+            d2 = self.norms[idx] - 2.0 * (block.astype(np.float32, copy=False) @ q)
+            k = min(topk, len(d2))
+            part = np.argpartition(d2, k - 1)[:k]
+            best_idx = np.concatenate([best_idx, idx[part]])
+            best_d2 = np.concatenate([best_d2, d2[part]])
+            if len(best_idx) > topk:
+                keep = np.argpartition(best_d2, topk - 1)[:topk]
+                best_idx, best_d2 = best_idx[keep], best_d2[keep]
+
+        order = np.argsort(best_d2, kind="stable")
+        dist = np.sqrt(np.maximum(best_d2[order] + float(q @ q), 0.0))
+        return [self._row(int(i), float(d)) for i, d in zip(best_idx[order], dist)]
+
+    def section_rows(self, bucket: str | None, section: str, topk: int) -> list[tuple]:
+        """条款号直查（对应 _SECTION_SQL）：按 page, id 排序，distance 记为 0"""
+        if self._sections is None:
+            with self._lock:
+                if self._sections is None:
+                    index: dict[str, list[int]] = {}
+                    col = self.strings["section"]
+                    for i in range(len(self)):
+                        sec = col[i]
+                        if sec is not None:
+                            index.setdefault(sec, []).append(i)
+                    self._sections = index
+        hits = self._sections.get(section, [])
+        if bucket is not None:
+            code = self.meta["buckets"].index(bucket) if bucket in self.meta["buckets"] else -2
+            hits = [i for i in hits if self._codes[i] == code]
+        hits = sorted(hits, key=lambda i: (int(self.pages[i]), int(self.ids[i])))[:topk]
+        return [self._row(i, 0.0) for i in hits]
+
+    def _row(self, i: int, distance: float) -> tuple:
+        s = self.strings
+        page = int(self.pages[i])
+        return (
+            int(self.ids[i]),
+            s["content_hash"][i],
+            s["content"][i],
+            s["source"][i],
+            s["section"][i],
+            s["title"][i],
+            None if page < 0 else page,
+            np.asarray(self.vectors[i], dtype=np.float32),
+            distance,
+        )
+
+
+class SnapshotStore:
+    """持有当前快照；get() 按 poll 间隔检查 CURRENT，有新版本就热切换"""
+
+    def __init__(self, root: str, poll: float):
+        self.root = Path(root)
+        self.poll = poll
+        self._snap: VectorSnapshot | None = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self.swaps = 0
+        self.searches = 0
+        self.last_error: str | None = None
+
+    def get(self) -> VectorSnapshot | None:
+        now = time.monotonic()
+        if now >= self._next_check:
+            with self._lock:
+                if now >= self._next_check:
+                    self._next_check = now + self.poll
+                    self._refresh()
+        return self._snap
+
+    def _refresh(self):
+        name = read_current(self.root)
+        if name is None or (self._snap is not None and self._snap.name == name):
+            return
+        try:
+            snap = VectorSnapshot(self.root / name)
+        except Exception as e:
+            # 新快照读不了就继续用旧的
+            self.last_error = f"{name}: {e}"
+            print(f"[SNAPSHOT][ERROR] cannot load {name}: {e}")
+            return
+        old = self._snap
+        self._snap = snap
+        self.swaps += 1
+        print(f"[SNAPSHOT] serving {name} ({len(snap)} rows, {snap.meta['dtype']})"
+              + (f", replaced {old.name}" if old else ""))
+
+    def stats(self) -> dict:
+        snap = self._snap
+        return {
+            "current": snap.name if snap else None,
+            "rows": len(snap) if snap else 0,
+            "dtype": snap.meta["dtype"] if snap else None,
+            "created_at": snap.meta["created_at"] if snap else None,
+            "swaps": self.swaps,
+            "searches": self.searches,
+            "last_error": self.last_error,
+        }
+
+
+snapshot_store = SnapshotStore(SNAPSHOT_DIR, SNAPSHOT_POLL)
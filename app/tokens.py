@@ -0,0 +1,10 @@
+# app/tokens.py
+# 粗略 token 估算：不依赖 tiktoken，偏保守（宁可多估）
+# 英文 ≈ 4 字符 / token；中文等非 ASCII 字符按 1 字符 / token 算
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return (len(text) - non_ascii) // 4 + non_ascii + 1
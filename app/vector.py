@@ -0,0 +1,153 @@
+# app/vector.py
+# 向量编解码：统一用 float32 NumPy 数组在进程内流转，
+# 发给 Postgres 时尽量走 pgvector 二进制格式，避免 ~15KB 的十进制文本来回解析。
+import struct
+
+import numpy as np
+from pgvector import Vector
+from pgvector.psycopg import register_vector_async
+
+EMBED_DIM = 1536
+
+
+def to_array(vec) -> np.ndarray:
+    """list[float] / ndarray -> float32 ndarray"""
+    return np.asarray(vec, dtype=np.float32)
+
+
+def to_text(vec) -> str:
+    """pgvector 文本格式 [0.1,0.2,...]；仅用于只能传文本的场景（psycopg2 参数）"""
+    return Vector(to_array(vec)).to_text()
+
+
+def to_binary(vec) -> bytes:
+    """pgvector 二进制格式（vector_recv）：int16 维度 + int16 保留 + float4[] 大端"""
+    return Vector(to_array(vec)).to_binary()
+
+
+async def configure_async_conn(conn):
+    """psycopg 3 连接池的 configure 回调：注册 vector 类型，
+    之后 ndarray 参数配合 %b 占位符按二进制发送
+    """
+    await register_vector_async(conn)
+    # configure 回调必须让连接回到 idle 状态
+    await conn.commit()
+
+
+# ------------ COPY ... (FORMAT binary) ------------
+_PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+_PGCOPY_TRAILER = struct.pack(">h", -1)
+
+
+def _copy_field(value) -> bytes:
+    if value is None:
+        return struct.pack(">i", -1)
+    if isinstance(value, np.ndarray):
+        data = to_binary(value)
+    elif isinstance(value, bool):
+        data = struct.pack(">?", value)
+    elif isinstance(value, int):
+        data = struct.pack(">i", value)
+    else:
+        data = str(value).encode("utf-8")
+    return struct.pack(">i", len(data)) + data
+
+
+def pgcopy_binary(rows) -> bytes:
+    """把若干行编码成 COPY BINARY 流。
+    字段类型约定：None -> NULL，ndarray -> vector，int -> int4，其余 -> text。
+    """
+    out = [_PGCOPY_HEADER]
+    for row in rows:
+        out.append(struct.pack(">h", len(row)))
+        out.extend(_copy_field(v) for v in row)
+    out.append(_PGCOPY_TRAILER)
+    return b"".join(out)
+
+
+class PgCopyBinaryReader:
+    """COPY ... TO STDOUT WITH (FORMAT binary) 的流式解析。
+    当作文件对象传给 cursor.copy_expert，每解析出完整的一行就调用 on_row(fields)，
+    fields 为每列的原始字节（NULL 为 None）；内存里只留不完整的半行。
+    """
+
+    def __init__(self, on_row):
+        self.on_row = on_row
+        self.rows = 0
+        self._buf = bytearray()
+        self._header_done = False
+
+    def write(self, data) -> int:
+        self._buf += data
+        self._parse()
+        return len(data)
+
+    def _parse(self):
+        buf = self._buf
+        pos = 0
+        if not self._header_done:
+            # 11 字节签名 + int32 flags + int32 扩展区长度 + 扩展区
+            if len(buf) < 19:
+                return
+            ext = struct.unpack_from(">i", buf, 15)[0]
+            if len(buf) < 19 + ext:
+                return
+            pos = 19 + ext
+            self._header_done = True
+        while len(buf) - pos >= 2:
+            nfields = struct.unpack_from(">h", buf, pos)[0]
+            if nfields == -1:   # trailer
+                pos += 2
+                break
+            p = pos + 2
+            fields = []
+            for _ in range(nfields):
+                if len(buf) - p < 4:
+                    break
+                size = struct.unpack_from(">i", buf, p)[0]
+                p += 4
+                if size == -1:
+                    fields.append(None)
+                    continue
+                if len(buf) - p < size:
+                    break
+                fields.append(bytes(buf[p:p + size]))
+                p += size
+            if len(fields) < nfields:
+                break           # 半行，等下一块数据
+            self.on_row(fields)
+            self.rows += 1
+            pos = p
+        del buf[:pos]
+
+
+def from_binary(data: bytes) -> np.ndarray:
+    """pgvector 二进制格式 -> float32 ndarray"""
+    dim = struct.unpack_from(">H", data, 0)[0]
+    return np.frombuffer(data, dtype=">f4", count=dim, offset=4).astype(np.float32)
+
+
+# ------------ 量化检索（EMBED_QUANT）------------
+# 量化副本不单独存列：documents 上建表达式索引（scripts/ann_index.py --quant），
+# 写入时由 Postgres 自动维护；检索先按量化距离粗排取候选，再用全精度 embedding 重排。
+#   halfvec —— float16，索引约为全精度的一半，召回几乎不变
+#   binary  —— 每维 1 bit（binary_quantize，Hamming 距离），索引约 1/32，需要更大的重排倍数
+QUANT_MODES = {
+    # mode -> (距离运算符, 索引 opclass)
+    "halfvec": ("<->", "halfvec_l2_ops"),
+    "binary": ("<~>", "bit_hamming_ops"),
+}
+
+
+def quant_key(mode: str, vec: str) -> str:
+    """向量表达式 vec 的量化形式；必须和表达式索引写法一致，planner 才会走索引"""
+    if mode == "halfvec":
+        return f"({vec})::halfvec({EMBED_DIM})"
+    if mode == "binary":
+        return f"binary_quantize({vec})::bit({EMBED_DIM})"
+    raise ValueError(f"unknown EMBED_QUANT: {mode}")
+
+
+def coarse_order(mode: str, vec: str) -> str:
+    """粗排的 ORDER BY 表达式：documents.embedding 与查询向量 vec 的量化距离"""
+    return f"{quant_key(mode, 'embedding')} {QUANT_MODES[mode][0]} {quant_key(mode, vec)}"
@@ -33,11 +33,47 @@ else
 fi
 
 # === 清理旧记录 ===
+# query_logs 按月分区时：整月都早于保留期的分区直接 DROP（不扫表、不留死元组），
+# 最近的那个月要等整月过期才删，所以实际保留 ${DAYS_TO_KEEP} 天到一个月多一点；
+# DEFAULT 分区里的零散旧行照常 DELETE。普通表（还没迁移）仍然 DELETE + VACUUM。
 echo "🧹 Cleaning logs older than ${DAYS_TO_KEEP} days..."
-psql -h "$DB_HOST" -U "$DB_USER" -d "$DB_NAME" -c "
-  DELETE FROM query_logs WHERE created_at < now() - interval '${DAYS_TO_KEEP} days';
-  VACUUM ANALYZE query_logs;
+psql -h "$DB_HOST" -U "$DB_USER" -d "$DB_NAME" -v ON_ERROR_STOP=1 -c "
+DO \$\$
+DECLARE
+  part text;
+  cutoff timestamptz := now() - interval '${DAYS_TO_KEEP} days';
+BEGIN
+  IF (SELECT relkind FROM pg_class WHERE relname = 'query_logs' AND relnamespace = 'public'::regnamespace) = 'p' THEN
+    FOR part IN
+      SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+      WHERE i.inhparent = 'query_logs'::regclass AND c.relname ~ '^query_logs_[0-9]{6}\$'
+        AND to_date(right(c.relname, 6), 'YYYYMM') + interval '1 month' <= cutoff
+      ORDER BY c.relname
+    LOOP
+      EXECUTE format('DROP TABLE %I', part);
+      RAISE NOTICE 'dropped partition %', part;
+    END LOOP;
+    DELETE FROM query_logs_default WHERE created_at < cutoff;
+  ELSE
+    DELETE FROM query_logs WHERE created_at < cutoff;
+  END IF;
+END
+\$\$;
 "
 
+if [ $? -ne 0 ]; then
+  echo "❌ Cleanup failed"
+  exit 1
+fi
+
+# VACUUM 不能和其他语句放在同一个 -c 里（会被包进事务）；分区直接 DROP 的不需要
+IS_PARTITIONED=$(psql -h "$DB_HOST" -U "$DB_USER" -d "$DB_NAME" -tAc \
+  "SELECT relkind = 'p' FROM pg_class WHERE relname = 'query_logs' AND relnamespace = 'public'::regnamespace")
+if [ "$IS_PARTITIONED" = "t" ]; then
+  psql -h "$DB_HOST" -U "$DB_USER" -d "$DB_NAME" -c "VACUUM ANALYZE query_logs_default;"
+else
+  psql -h "$DB_HOST" -U "$DB_USER" -d "$DB_NAME" -c "VACUUM ANALYZE query_logs;"
+fi
+
 echo "✅ Cleanup done."
 echo "All done! 🎉"
@@ -0,0 +1,250 @@
+# scripts/ann_index.py
+# documents.embedding 的 ANN 索引管理：建索引 / 重建 / 查看状态。
+# 全部用 CONCURRENTLY，建索引期间线上检索和写入不受阻塞。
+# documents 按 bucket 分区时（scripts/partition.py），每个分区各建一个索引再挂到父表的分区索引上。
+#
+#   python -m scripts.ann_index status
+#   python -m scripts.ann_index create      # 不存在才建（失败残留的无效索引会先清掉）
+#   python -m scripts.ann_index rebuild     # 按当前配置建新索引，再替换旧的
+#   python -m scripts.ann_index drop
+#
+# --quant halfvec / binary 管理量化表达式索引（EMBED_QUANT 检索用的那个，默认取 EMBED_QUANT）。
+# 已有数据迁移到量化检索：
+#   1) python -m scripts.ann_index create --quant halfvec   # CONCURRENTLY 建在现有行上，不改表、不重写数据
+#   2) EMBED_QUANT=halfvec 重启 app                          # 检索改成粗排 + 全精度重排
+#   3) python -m scripts.ann_index drop --quant none        # 可选：删掉全精度 ANN 索引，省下它占的内存
+#   python -m scripts.bench recall --quant halfvec,binary   # 看召回率再决定
+import argparse
+import math
+from contextlib import contextmanager
+
+from app.config import (
+    ANN_INDEX_TYPE,
+    HNSW_M,
+    HNSW_EF_CONSTRUCTION,
+    IVFFLAT_LISTS,
+    ANN_MAINTENANCE_WORK_MEM,
+    ANN_BUILD_WORKERS,
+    EMBED_QUANT,
+)
+from app.db import get_conn
+from app.vector import QUANT_MODES, quant_key
+
+INDEX_NAME = "documents_embedding_ann"
+TABLE = "documents"
+# 检索用的是 <->（L2 距离），索引必须用对应的 opclass
+OPCLASS = "vector_l2_ops"
+ALL_QUANT = ("none", *QUANT_MODES)
+
+
+def index_name(quant: str = EMBED_QUANT) -> str:
+    return INDEX_NAME if quant == "none" else f"{INDEX_NAME}_{quant}"
+
+
+def _index_column(quant: str) -> str:
+    """索引列：全精度直接用 embedding，量化模式用表达式（和 app.rag 粗排的写法一致）"""
+    if quant == "none":
+        return f"embedding {OPCLASS}"
+    return f"({quant_key(quant, 'embedding')}) {QUANT_MODES[quant][1]}"
+
+
+@contextmanager
+def _autocommit():
+    """CREATE/DROP INDEX CONCURRENTLY 不能在事务里执行"""
+    with get_conn() as conn:
+        conn.autocommit = True
+        cur = conn.cursor()
+        try:
+            yield cur
+        finally:
+            # SET maintenance_work_mem 等是会话级的，别带回连接池
+            try:
+                cur.execute("RESET ALL")
+            except Exception:
+                pass
+            conn.autocommit = False
+
+
+def _ivfflat_lists(cur, table: str = TABLE) -> int:
+    if IVFFLAT_LISTS > 0:
+        return IVFFLAT_LISTS
+    cur.execute(f"SELECT count(*) FROM {table}")
+    rows = cur.fetchone()[0]
+    # pgvector 推荐：百万行以内 rows/1000，以上 sqrt(rows)
+    lists = rows // 1000 if rows <= 1_000_000 else int(math.sqrt(rows))
+    return max(lists, 1)
+
+
+def index_ddl(cur, name: str, index_type: str = ANN_INDEX_TYPE, quant: str = EMBED_QUANT,
+              table: str = TABLE, only: bool = False) -> str:
+    """only=True：分区父表上的 ON ONLY 索引（不能 CONCURRENTLY，也不会去建子表索引）"""
+    if index_type == "hnsw":
+        with_ = f"m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION}"
+    elif index_type == "ivfflat":
+        with_ = f"lists = {_ivfflat_lists(cur, table)}"
+    else:
+        raise ValueError(f"unknown ANN_INDEX_TYPE: {index_type}")
+    head = f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table}" if only else f"CREATE INDEX CONCURRENTLY {name} ON {table}"
+    return f"{head} USING {index_type} ({_index_column(quant)}) WITH ({with_})"
+
+
+def _partitions(cur, table: str) -> list[str]:
+    """分区表的各个分区；普通表返回 []"""
+    cur.execute("""
+        SELECT c.relname
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+        ORDER BY c.relname
+    """, (table,))
+    return [r[0] for r in cur.fetchall()]
+
+
+def _child_name(partition: str, name: str) -> str:
+    """分区上的索引名：分区名 + 父索引名去掉 documents_embedding_ 前缀（ann / ann_halfvec / ann_new ...）"""
+    return f"{partition}_{name.removeprefix('documents_embedding_')}"[:63]
+
+
+def _drop(cur, name: str):
+    """普通索引 DROP CONCURRENTLY；分区父索引不支持 CONCURRENTLY，直接 DROP（连同各分区上的索引）"""
+    cur.execute("SELECT relkind FROM pg_class WHERE relname = %s AND relnamespace = 'public'::regnamespace", (name,))
+    row = cur.fetchone()
+    if row is None:
+        return
+    if row[0] == "I":
+        cur.execute(f"DROP INDEX IF EXISTS {name}")
+    else:
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+def _index_state(cur, name: str):
+    """返回 (是否存在, 是否有效)"""
+    cur.execute("""
+        SELECT i.indisvalid
+        FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+        WHERE c.relname = %s AND c.relnamespace = 'public'::regnamespace
+    """, (name,))
+    row = cur.fetchone()
+    return (row is not None, bool(row and row[0]))
+
+
+def _build(cur, name: str, quant: str, table: str = TABLE):
+    cur.execute(f"SET maintenance_work_mem = '{ANN_MAINTENANCE_WORK_MEM}'")
+    cur.execute(f"SET max_parallel_maintenance_workers = {int(ANN_BUILD_WORKERS)}")
+    parts = _partitions(cur, table)
+    if not parts:
+        ddl = index_ddl(cur, name, quant=quant, table=table)
+        print(f"[INDEX] {ddl}")
+        cur.execute(ddl)
+        return
+
+    # 分区表：父表上先建 ON ONLY 的索引（无效状态），每个分区 CONCURRENTLY 建好后 ATTACH，
+    # 全部挂上父索引自动变有效；之后新建的分区会自动带上同样的索引
+    ddl = index_ddl(cur, name, quant=quant, table=table, only=True)
+    print(f"[INDEX] {ddl}")
+    cur.execute(ddl)
+    for part in parts:
+        child = _child_name(part, name)
+        exists, valid = _index_state(cur, child)
+        if exists and not valid:
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {child}")
+        if not valid:
+            ddl = index_ddl(cur, child, quant=quant, table=part)
+            print(f"[INDEX] {ddl}")
+            cur.execute(ddl)
+        cur.execute(f"ALTER INDEX {name} ATTACH PARTITION {child}")
+
+
+def create_index(quant: str = EMBED_QUANT, table: str = TABLE, name: str | None = None):
+    name = name or index_name(quant)
+    with _autocommit() as cur:
+        exists, valid = _index_state(cur, name)
+        if exists and valid:
+            print(f"[INDEX] {name} already exists")
+            return
+        if exists and not _partitions(cur, table):
+            # 上次 CONCURRENTLY 失败会留下 INVALID 索引，先删
+            # （分区父索引无效只是还有分区没挂上，_build 会补齐）
+            print(f"[INDEX] dropping invalid {name}")
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        _build(cur, name, quant, table)
+    print(f"[INDEX] {name} created")
+
+
+def rebuild_index(quant: str = EMBED_QUANT):
+    """按当前配置建一个新索引，建好后删旧的并改名，期间检索一直有索引可用"""
+    name = index_name(quant)
+    tmp = name + "_new"
+    with _autocommit() as cur:
+        _drop(cur, tmp)
+        _build(cur, tmp, quant)
+        _drop(cur, name)
+        rename_index(cur, tmp, name)
+    print(f"[INDEX] {name} rebuilt")
+
+
+def rename_index(cur, old: str, new: str, table: str = TABLE):
+    """改名；分区表上连同各分区的索引一起改（自动生成名字的不动）"""
+    cur.execute(f"ALTER INDEX {old} RENAME TO {new}")
+    for part in _partitions(cur, table):
+        exists, _ = _index_state(cur, _child_name(part, old))
+        if exists:
+            cur.execute(f"ALTER INDEX {_child_name(part, old)} RENAME TO {_child_name(part, new)}")
+
+
+def drop_index(quant: str = EMBED_QUANT):
+    name = index_name(quant)
+    with _autocommit() as cur:
+        _drop(cur, name)
+    print(f"[INDEX] {name} dropped")
+
+
+def index_status() -> dict:
+    """全精度和各量化索引（含重建中的 _new）的状态和大小"""
+    names = [n for q in ALL_QUANT for n in (index_name(q), index_name(q) + "_new")]
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT c.relname, i.indisvalid, pg_get_indexdef(c.oid),
+                   -- 分区父索引本身是空的，大小按整棵分区树加总
+                   pg_size_pretty((SELECT sum(pg_relation_size(t.relid)) FROM pg_partition_tree(c.oid) t))
+            FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+            WHERE c.relname = ANY(%s) AND c.relnamespace = 'public'::regnamespace
+        """, (names,))
+        indexes = [
+            {"name": r[0], "valid": r[1], "definition": r[2], "size": r[3]}
+            for r in cur.fetchall()
+        ]
+        # 正在进行的建索引进度
+        cur.execute("""
+            SELECT p.phase, p.blocks_done, p.blocks_total, p.tuples_done, p.tuples_total
+            FROM pg_stat_progress_create_index p
+            WHERE p.relid = %s::regclass
+        """, (TABLE,))
+        progress = [
+            {"phase": r[0], "blocks": f"{r[1]}/{r[2]}", "tuples": f"{r[3]}/{r[4]}"}
+            for r in cur.fetchall()
+        ]
+    return {"indexes": indexes, "building": progress}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="manage the documents ANN index")
+    parser.add_argument("action", choices=["status", "create", "rebuild", "drop"])
+    parser.add_argument("--quant", choices=ALL_QUANT, default=EMBED_QUANT,
+                        help="none = full-precision index; halfvec/binary = quantized expression index")
+    args = parser.parse_args()
+
+    if args.action == "create":
+        create_index(args.quant)
+    elif args.action == "rebuild":
+        rebuild_index(args.quant)
+    elif args.action == "drop":
+        drop_index(args.quant)
+    else:
+        st = index_status()
+        for ix in st["indexes"]:
+            print(f"[INDEX] {ix['name']} valid={ix['valid']} size={ix['size']}\n        {ix['definition']}")
+        if not st["indexes"]:
+            print(f"[INDEX] no ANN index on {TABLE}")
+        for p in st["building"]:
+            print(f"[INDEX] building: {p['phase']} blocks={p['blocks']} tuples={p['tuples']}")
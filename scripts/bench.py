@@ -0,0 +1,270 @@
+# scripts/bench.py
+# 离线微基准：
+#   chunk   —— soft_chunk 的吞吐（用 Sample.pdf 抽出来的真实 section 文本）
+#   extract —— extract_sections_with_toc 在 data/Sample.pdf 上的耗时（可比较不同 worker 数）
+#   search  —— search_docs 在 10k / 100k / 1M 行时的延迟（合成向量，bucket=bench）
+#   recall  —— 量化两阶段检索（EMBED_QUANT）相对精确 top-k 的召回率和延迟，可用真实 bucket
+#
+# search 需要本地 Postgres + pgvector，并且会往 documents 里写合成数据，请用单独的库：
+#   python -m scripts.fake_openai --port 9000 &
+#   DB_URL=postgresql://.../docrag_bench OPENAI_BASE_URL=http://127.0.0.1:9000/v1 OPENAI_API_KEY=fake \
+#       python -m scripts.bench search --sizes 10000,100000,1000000
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from app.db import get_conn
+from app.metrics import Timings
+from app.rag import search_docs, quant_search_sql, detect_pgvector
+from app.vector import to_text
+from scripts.ann_index import ALL_QUANT, create_index, index_status, rebuild_index
+from scripts.benchutil import report
+from scripts.ingest import ensure_table, extract_sections_with_toc, insert_records, soft_chunk
+
+SAMPLE_PDF = "data/Sample.pdf"
+BENCH_BUCKET = "bench"
+BENCH_SOURCE = "bench-synthetic"
+EMBED_DIM = 1536
+
+
+# ------------ soft_chunk ------------
+def bench_chunk(repeat: int, max_chars: int, overlap: int):
+    sections = extract_sections_with_toc(SAMPLE_PDF)
+    texts = [s["text"] for s in sections if s["text"].strip()]
+    total_chars = sum(len(t) for t in texts)
+    samples = []
+    n_chunks = 0
+    t_wall = time.perf_counter()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        n_chunks = sum(len(soft_chunk(t, max_chars=max_chars, overlap=overlap)) for t in texts)
+        samples.append(time.perf_counter() - t0)
+    wall = time.perf_counter() - t_wall
+    report("soft_chunk", samples, wall, sections=len(texts), chunks=n_chunks,
+           mb_per_s=round(total_chars * repeat / wall / 1e6, 2))
+
+
+# ------------ extract_sections_with_toc ------------
+def bench_extract(repeat: int, workers: list[int]):
+    for w in workers:
+        samples = []
+        n = 0
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            n = len(extract_sections_with_toc(SAMPLE_PDF, workers=w))
+            samples.append(time.perf_counter() - t0)
+        report("extract_sections_with_toc", samples, workers=w, sections=n)
+
+
+# ------------ search_docs ------------
+def _bench_rows() -> int:
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT count(*) FROM documents WHERE bucket = %s", (BENCH_BUCKET,))
+        return cur.fetchone()[0]
+
+
+def seed(target: int, batch: int = 5000):
+    """把 bench bucket 补到 target 行；向量为确定性的随机单位向量，重复运行是幂等的"""
+    have = _bench_rows()
+    if have >= target:
+        return
+    print(f"[BENCH] seeding bench rows {have} -> {target}")
+    t0 = time.perf_counter()
+    with get_conn() as conn:
+        for start in range(have, target, batch):
+            end = min(target, start + batch)
+            rng = np.random.default_rng(start)
+            vecs = rng.standard_normal((end - start, EMBED_DIM), dtype=np.float32)
+            vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+            rows = [
+                (f"bench row {i}", vecs[i - start], BENCH_SOURCE, None, "bench", i // 100, i // 100, BENCH_BUCKET)
+                for i in range(start, end)
+            ]
+            insert_records(conn, rows)
+    print(f"[BENCH] seeded {target - have} rows in {time.perf_counter() - t0:.1f}s")
+
+
+def bench_search(sizes: list[int], queries: int, concurrency: int, topk: int,
+                 ef_search: int | None, probes: int | None, reindex: bool):
+    ensure_table()
+    for size in sizes:
+        seed(size)
+        t0 = time.perf_counter()
+        if reindex:
+            rebuild_index()
+        else:
+            create_index()
+        print(f"[BENCH] ANN index ready in {time.perf_counter() - t0:.1f}s")
+
+        qs = [f"bench query {size} {i}" for i in range(queries)]
+        # 预热：连接池、预编译语句、查询 embedding 缓存
+        for q in qs[: min(10, len(qs))]:
+            search_docs(q, bucket=BENCH_BUCKET, topk=topk, max_distance=10.0,
+                        ef_search=ef_search, probes=probes)
+
+        def one(q):
+            t = Timings(BENCH_BUCKET)
+            t0 = time.perf_counter()
+            hits = search_docs(q, bucket=BENCH_BUCKET, topk=topk, max_distance=10.0,
+                               ef_search=ef_search, probes=probes, timings=t)
+            return time.perf_counter() - t0, t.ms.get("embed", 0.0) / 1000, t.ms.get("search", 0.0) / 1000, len(hits)
+
+        t_wall = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            results = list(pool.map(one, qs))
+        wall = time.perf_counter() - t_wall
+
+        report("search_docs", [r[0] for r in results], wall, rows=size, concurrency=concurrency,
+               avg_hits=round(statistics.fmean(r[3] for r in results), 1))
+        report("search_docs.sql", [r[2] for r in results], rows=size)
+        report("search_docs.embed", [r[1] for r in results], rows=size)
+
+
+# ------------ recall ------------
+# 精确 top-k（关掉索引扫描走顺序扫描）作为真值；同一条语句开着索引就是全精度 ANN 的结果
+_TOPK_SQL = """
+    SELECT id FROM documents
+    WHERE bucket = %s
+    ORDER BY embedding <-> %s::vector
+    LIMIT %s
+"""
+
+
+def _sample_queries(bucket: str, n: int) -> list[np.ndarray]:
+    """随机取 2n 行向量，两两取中点再归一化：落在数据分布里，但不和任何一行重合"""
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT setseed(0.42)")
+        cur.execute("""
+            SELECT embedding::real[] FROM documents
+            WHERE bucket = %s AND embedding IS NOT NULL
+            ORDER BY random() LIMIT %s
+        """, (bucket, 2 * n))
+        vecs = [np.asarray(r[0], dtype=np.float32) for r in cur.fetchall()]
+        conn.rollback()
+    out = []
+    for a, b in zip(vecs[0::2], vecs[1::2]):
+        m = a + b
+        out.append(m / (np.linalg.norm(m) or 1.0))
+    return out
+
+
+def bench_recall(quants: list[str], factors: list[int], queries: int, topk: int,
+                 bucket: str, size: int, ef_search: int | None):
+    ensure_table()
+    if bucket == BENCH_BUCKET:
+        seed(size)
+    for quant in quants:
+        create_index(quant)
+    qvecs = _sample_queries(bucket, queries)
+    if not qvecs:
+        print(f"[BENCH] bucket {bucket!r} has fewer than 2 rows")
+        return
+    literals = [to_text(v) for v in qvecs]
+    # 旧版 pgvector 没有 hnsw.iterative_scan，和检索服务一样先查版本
+    iterative_scan = detect_pgvector()
+
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SET LOCAL enable_indexscan = off")
+        truth = []
+        for lit in literals:
+            cur.execute(_TOPK_SQL, (bucket, lit, topk))
+            truth.append({r[0] for r in cur.fetchall()})
+        conn.rollback()
+
+        for quant in quants:
+            for factor in ([1] if quant == "none" else factors):
+                cand = topk * factor
+                ef = max(ef_search or 40, cand)
+                if quant == "none":
+                    sql, params = _TOPK_SQL, lambda lit: (bucket, lit, topk)
+                else:
+                    sql = quant_search_sql(quant, "%s", "WHERE bucket = %s", "%s", "%s", "%s")
+                    params = lambda lit: (lit, bucket, cand, float("inf"), topk)
+                cur.execute("SELECT set_config('hnsw.ef_search', %s, true)", (str(ef),))
+                if iterative_scan != "off":
+                    cur.execute("SELECT set_config('hnsw.iterative_scan', %s, true)", (iterative_scan,))
+                lat, hits = [], []
+                for lit, want in zip(literals, truth):
+                    t0 = time.perf_counter()
+                    cur.execute(sql, params(lit))
+                    got = {r[0] for r in cur.fetchall()}
+                    lat.append(time.perf_counter() - t0)
+                    hits.append(len(got & want) / max(1, len(want)))
+                conn.rollback()
+                report(f"recall.{quant}", lat, topk=topk, factor=factor, ef_search=ef,
+                       recall=round(statistics.fmean(hits), 4))
+
+    for ix in index_status()["indexes"]:
+        print(f"[BENCH] index {ix['name']} size={ix['size']}")
+
+
+def cleanup():
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM documents WHERE bucket = %s", (BENCH_BUCKET,))
+        print(f"[BENCH] deleted {cur.rowcount} bench rows")
+        conn.commit()
+
+
+def _ints(s: str) -> list[int]:
+    return [int(x) for x in s.split(",") if x.strip()]
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="docRag micro-benchmarks")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("chunk", help="soft_chunk throughput on Sample.pdf sections")
+    p.add_argument("--repeat", type=int, default=200)
+    p.add_argument("--max-chars", type=int, default=2000)
+    p.add_argument("--overlap", type=int, default=200)
+
+    p = sub.add_parser("extract", help="extract_sections_with_toc on Sample.pdf")
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--workers", type=_ints, default=[1, 2, 4])
+
+    p = sub.add_parser("search", help="search_docs latency at several table sizes")
+    p.add_argument("--sizes", type=_ints, default=[10_000, 100_000, 1_000_000])
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--concurrency", type=int, default=1)
+    p.add_argument("--topk", type=int, default=6)
+    p.add_argument("--ef-search", type=int, default=None)
+    p.add_argument("--probes", type=int, default=None)
+    p.add_argument("--no-reindex", action="store_true", help="keep the existing ANN index instead of rebuilding per size")
+    p.add_argument("--cleanup", action="store_true", help="delete the synthetic rows afterwards")
+
+    p = sub.add_parser("recall", help="recall@k of quantized coarse search + rerank vs exact search")
+    p.add_argument("--quant", type=lambda s: [x for x in s.split(",") if x], default=list(ALL_QUANT))
+    p.add_argument("--factors", type=_ints, default=[1, 2, 4, 8])
+    p.add_argument("--queries", type=int, default=100)
+    p.add_argument("--topk", type=int, default=6)
+    p.add_argument("--bucket", default=BENCH_BUCKET, help="bucket to measure (bench = synthetic rows)")
+    p.add_argument("--size", type=int, default=100_000, help="synthetic rows to seed when --bucket bench")
+    p.add_argument("--ef-search", type=int, default=None)
+    p.add_argument("--cleanup", action="store_true", help="delete the synthetic rows afterwards")
+
+    args = ap.parse_args()
+    if args.cmd == "chunk":
+        bench_chunk(args.repeat, args.max_chars, args.overlap)
+    elif args.cmd == "extract":
+        bench_extract(args.repeat, args.workers)
+    elif args.cmd == "search":
+        try:
+            bench_search(args.sizes, args.queries, args.concurrency, args.topk,
+                         args.ef_search, args.probes, reindex=not args.no_reindex)
+        finally:
+            if args.cleanup:
+                cleanup()
+    elif args.cmd == "recall":
+        try:
+            bench_recall(args.quant, args.factors, args.queries, args.topk,
+                         args.bucket, args.size, args.ef_search)
+        finally:
+            if args.cleanup and args.bucket == BENCH_BUCKET:
+                cleanup()
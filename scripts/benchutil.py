@@ -0,0 +1,26 @@
+# scripts/benchutil.py
+# 基准 / 压测共用的分位数统计和输出格式
+import statistics
+
+
+def percentiles(samples: list[float], ps=(50, 90, 95, 99)) -> dict:
+    """samples 为秒，返回毫秒的分位数（最近秩法）"""
+    if not samples:
+        return {f"p{p}": None for p in ps}
+    xs = sorted(samples)
+    out = {}
+    for p in ps:
+        k = max(0, min(len(xs) - 1, int(round(p / 100 * len(xs) + 0.5)) - 1))
+        out[f"p{p}"] = round(xs[k] * 1000, 2)
+    return out
+
+
+def report(name: str, samples: list[float], wall: float | None = None, **extra) -> dict:
+    line = {"bench": name, "n": len(samples), **percentiles(samples)}
+    if samples:
+        line["mean_ms"] = round(statistics.fmean(samples) * 1000, 2)
+    if wall:
+        line["ops_per_s"] = round(len(samples) / wall, 1)
+    line.update(extra)
+    print("[BENCH] " + " | ".join(f"{k}={v}" for k, v in line.items()))
+    return line
@@ -0,0 +1,214 @@
+# scripts/embedder.py
+# 批量 + 并发 embedding：把很多 chunk 打包进一个请求，多个 batch 并发发送，
+# 遇到 429 按 retry-after 退避，输出顺序与输入一一对应。
+# 调 API 前先查内容寻址的 embedding_store（key = sha256(model, 文本)），算完回填。
+import hashlib
+import io
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import openai
+from openai import OpenAI
+
+from app.config import (
+    OPENAI_API_KEY,
+    EMBED_BATCH_SIZE,
+    EMBED_BATCH_TOKENS,
+    EMBED_CONCURRENCY,
+    EMBED_MAX_RETRIES,
+    EMBED_STORE,
+)
+from app.db import get_conn
+from app.limiter import retry_after
+from app.tokens import estimate_tokens
+from app.vector import pgcopy_binary, to_array
+
+EMBED_MODEL = "text-embedding-3-small"
+MAX_INPUTS_PER_REQUEST = 2048
+MAX_TOKENS_PER_INPUT = 8191
+
+# 重试由我们自己控制（要读 retry-after、要全局统计），关闭 SDK 内置重试
+client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+
+_RETRYABLE = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+
+def make_batches(texts: List[str], max_inputs: int = EMBED_BATCH_SIZE,
+                 max_tokens: int = EMBED_BATCH_TOKENS) -> List[List[int]]:
+    """按条数 + 估算 token 数把 texts 切成若干 batch，返回下标列表（保持原顺序）"""
+    max_inputs = max(1, min(max_inputs, MAX_INPUTS_PER_REQUEST))
+    batches: List[List[int]] = []
+    cur: List[int] = []
+    cur_tokens = 0
+    for i, t in enumerate(texts):
+        n = min(estimate_tokens(t), MAX_TOKENS_PER_INPUT)
+        if cur and (len(cur) >= max_inputs or cur_tokens + n > max_tokens):
+            batches.append(cur)
+            cur, cur_tokens = [], 0
+        cur.append(i)
+        cur_tokens += n
+    if cur:
+        batches.append(cur)
+    return batches
+
+
+def _embed_batch(texts: List[str]) -> List[List[float]]:
+    attempt = 0
+    while True:
+        try:
+            resp = client.embeddings.create(model=EMBED_MODEL, input=texts)
+            # API 按 index 返回，保险起见再排一次序
+            return [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+        except _RETRYABLE as e:
+            attempt += 1
+            if attempt > EMBED_MAX_RETRIES:
+                raise
+            wait = retry_after(e)
+            if wait is None:
+                wait = min(60.0, 2 ** attempt) * (0.5 + random.random() / 2)
+            print(f"[EMBED][RETRY] {type(e).__name__} | batch={len(texts)} | "
+                  f"attempt {attempt}/{EMBED_MAX_RETRIES} | sleep {wait:.1f}s")
+            time.sleep(wait)
+
+
+# ------------ 内容寻址 embedding 库 ------------
+STORE_DDL = """
+    CREATE TABLE IF NOT EXISTS embedding_store (
+        key        TEXT PRIMARY KEY,
+        model      TEXT NOT NULL,
+        embedding  vector(1536) NOT NULL,
+        tokens     INT NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+"""
+
+_STORE_STAGING_DDL = """
+    CREATE TEMP TABLE IF NOT EXISTS embedding_store_staging (
+        key       TEXT,
+        model     TEXT,
+        embedding vector(1536),
+        tokens    INT
+    ) ON COMMIT DELETE ROWS;
+"""
+
+
+def store_key(text: str, model: str = EMBED_MODEL) -> str:
+    return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+
+def _store_get(keys: list[str]) -> dict:
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT key, embedding::real[] FROM embedding_store WHERE key = ANY(%s)",
+            (keys,),
+        )
+        return {k: list(emb) for k, emb in cur.fetchall()}
+
+
+def _store_put(items: list[tuple]):
+    """items: (key, text, embedding)；COPY 到临时表再 INSERT ... ON CONFLICT DO NOTHING"""
+    records = [(k, EMBED_MODEL, to_array(emb), estimate_tokens(t)) for k, t, emb in items]
+    with get_conn() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(_STORE_STAGING_DDL)
+            cur.copy_expert(
+                "COPY embedding_store_staging (key, model, embedding, tokens) FROM STDIN WITH (FORMAT binary)",
+                io.BytesIO(pgcopy_binary(records)),
+            )
+            cur.execute("""
+                INSERT INTO embedding_store (key, model, embedding, tokens)
+                SELECT key, model, embedding, tokens FROM embedding_store_staging
+                ON CONFLICT (key) DO NOTHING
+            """)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+class EmbedStats:
+    """统计 embedding 库/去重省下了多少 API 调用和 token"""
+
+    def __init__(self):
+        self.inputs = 0           # 请求 embedding 的文本总数
+        self.dup_inputs = 0       # 同一批里重复的文本
+        self.store_hits = 0       # 命中 embedding_store 的文本
+        self.api_inputs = 0       # 实际发给 API 的文本
+        self.api_calls = 0        # 实际 API 请求数
+        self.saved_calls = 0      # 不去重/不查库时本该多发的请求数
+        self.tokens_used = 0      # 发给 API 的估算 token
+        self.tokens_saved = 0     # 去重 + 命中省下的估算 token
+
+    def report(self) -> str:
+        return (f"inputs={self.inputs} | store hits={self.store_hits} | in-batch dups={self.dup_inputs} | "
+                f"API inputs={self.api_inputs} in {self.api_calls} calls "
+                f"(saved {self.saved_calls} calls) | tokens used≈{self.tokens_used} saved≈{self.tokens_saved}")
+
+
+stats = EmbedStats()
+
+
+def embed_many(texts: List[str], concurrency: int = EMBED_CONCURRENCY,
+               use_store: bool = EMBED_STORE) -> List[List[float]]:
+    """批量 embedding，返回与 texts 等长的列表；空文本对应 []。
+    相同文本只算一次；use_store 时先查 embedding_store，新算出来的再写回去。
+    """
+    out: List[List[float]] = [[] for _ in texts]
+    # 去重：key -> 文本，保持首次出现的顺序
+    unique: dict[str, str] = {}
+    index_keys: list[tuple[int, str]] = []
+    for i, t in enumerate(texts):
+        t = t.strip()
+        if not t:
+            continue
+        k = store_key(t)
+        unique.setdefault(k, t)
+        index_keys.append((i, k))
+    if not unique:
+        return out
+
+    stats.inputs += len(index_keys)
+    stats.dup_inputs += len(index_keys) - len(unique)
+    all_batches = len(make_batches([texts[i].strip() for i, _ in index_keys]))
+
+    found = _store_get(list(unique)) if use_store else {}
+    stats.store_hits += len(found)
+    stats.tokens_saved += sum(estimate_tokens(texts[i]) for i, k in index_keys) \
+        - sum(estimate_tokens(t) for k, t in unique.items() if k not in found)
+
+    missing = [(k, t) for k, t in unique.items() if k not in found]
+    if missing:
+        miss_texts = [t for _, t in missing]
+        batches = make_batches(miss_texts)
+        stats.api_inputs += len(missing)
+        stats.api_calls += len(batches)
+        stats.tokens_used += sum(estimate_tokens(t) for t in miss_texts)
+
+        def run(batch: List[int]):
+            return batch, _embed_batch([miss_texts[j] for j in batch])
+
+        fresh = []
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            for batch, embs in pool.map(run, batches):
+                for j, emb in zip(batch, embs):
+                    k, t = missing[j]
+                    found[k] = emb
+                    fresh.append((k, t, emb))
+        if use_store and fresh:
+            _store_put(fresh)
+        stats.saved_calls += all_batches - len(batches)
+    else:
+        stats.saved_calls += all_batches
+
+    for i, k in index_keys:
+        out[i] = found[k]
+    return out
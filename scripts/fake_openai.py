@@ -0,0 +1,169 @@
+# scripts/fake_openai.py
+# 本地 OpenAI 替身，压测/基准用：不花钱、没有公网抖动。
+#   - /v1/embeddings：按 sha256(文本) 生成确定性的 1536 维单位向量（同一文本永远同一向量）
+#   - /v1/chat/completions：返回固定长度的回答，支持 stream=True 和 stream_options.include_usage
+#   - 延迟可配：固定延迟 + 随机抖动 + 流式每 token 间隔；可按比例注入 429
+#
+# 用法：
+#   python -m scripts.fake_openai --port 9000 --embed-latency-ms 30 --chat-latency-ms 400
+#   OPENAI_BASE_URL=http://127.0.0.1:9000/v1 OPENAI_API_KEY=fake uvicorn app.main:app
+# OpenAI SDK 会自动读取 OPENAI_BASE_URL，应用代码不需要改。
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import time
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+EMBED_DIM = 1536
+
+# 由命令行参数覆盖
+settings = {
+    "embed_latency_ms": 20.0,     # 每个 embeddings 请求的固定延迟
+    "embed_per_input_ms": 0.2,    # 每条 input 额外延迟（模拟大 batch 更慢）
+    "chat_latency_ms": 300.0,     # chat 首 token 前的延迟
+    "token_latency_ms": 5.0,      # 流式每个 token 的间隔
+    "completion_tokens": 120,     # 回答长度（token 数）
+    "jitter": 0.1,                # 延迟随机抖动比例（±）
+    "error_rate": 0.0,            # 返回 429 的比例
+}
+
+app = FastAPI()
+_stats = {"embedding_requests": 0, "embedding_inputs": 0, "chat_requests": 0, "rate_limited": 0}
+
+
+def fake_embedding(text: str) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    v = np.random.default_rng(seed).standard_normal(EMBED_DIM).astype(np.float32)
+    return v / np.linalg.norm(v)
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+async def _sleep_ms(ms: float):
+    if ms <= 0:
+        return
+    j = settings["jitter"]
+    await asyncio.sleep(ms * (1 + random.uniform(-j, j)) / 1000.0)
+
+
+def _rate_limited():
+    if settings["error_rate"] > 0 and random.random() < settings["error_rate"]:
+        _stats["rate_limited"] += 1
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached (fake)", "type": "requests", "code": "rate_limit_exceeded"}},
+            status_code=429,
+            headers={"retry-after-ms": "200"},
+        )
+    return None
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    if (err := _rate_limited()) is not None:
+        return err
+    inputs = body["input"]
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    _stats["embedding_requests"] += 1
+    _stats["embedding_inputs"] += len(inputs)
+    await _sleep_ms(settings["embed_latency_ms"] + settings["embed_per_input_ms"] * len(inputs))
+
+    as_base64 = body.get("encoding_format") == "base64"
+    data = []
+    for i, text in enumerate(inputs):
+        v = fake_embedding(str(text))
+        emb = base64.b64encode(v.tobytes()).decode("ascii") if as_base64 else v.tolist()
+        data.append({"object": "embedding", "index": i, "embedding": emb})
+    tokens = sum(_estimate_tokens(str(t)) for t in inputs)
+    return {
+        "object": "list",
+        "data": data,
+        "model": body.get("model", "fake-embedding"),
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+def _answer_tokens(prompt: str) -> list[str]:
+    """确定性的回答：同一个 prompt 永远得到同样的 token 序列"""
+    seed = int.from_bytes(hashlib.sha256(prompt.encode("utf-8")).digest()[:8], "little")
+    rng = random.Random(seed)
+    words = ["ERCOT", "section", "tariff", "the", "shall", "per", "Protocol", "settlement",
+             "QSE", "resource", "interval", "and", "of", "to", "is", "defined", "as"]
+    return [("" if i == 0 else " ") + rng.choice(words) for i in range(settings["completion_tokens"])]
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    if (err := _rate_limited()) is not None:
+        return err
+    _stats["chat_requests"] += 1
+    prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+    tokens = _answer_tokens(prompt)
+    usage = {
+        "prompt_tokens": _estimate_tokens(prompt),
+        "completion_tokens": len(tokens),
+        "total_tokens": _estimate_tokens(prompt) + len(tokens),
+    }
+    model = body.get("model", "fake-chat")
+    cid = f"chatcmpl-fake-{int(time.time() * 1000)}"
+    created = int(time.time())
+
+    if not body.get("stream"):
+        await _sleep_ms(settings["chat_latency_ms"] + settings["token_latency_ms"] * len(tokens))
+        return {
+            "id": cid, "object": "chat.completion", "created": created, "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "".join(tokens)}}],
+            "usage": usage,
+        }
+
+    include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+    async def events():
+        def chunk(delta, finish=None, with_usage=False):
+            obj = {"id": cid, "object": "chat.completion.chunk", "created": created, "model": model,
+                   "choices": [] if delta is None else [{"index": 0, "delta": delta, "finish_reason": finish}]}
+            if with_usage:
+                obj["usage"] = usage
+            return f"data: {json.dumps(obj)}\n\n"
+
+        await _sleep_ms(settings["chat_latency_ms"])
+        yield chunk({"role": "assistant", "content": ""})
+        for t in tokens:
+            await _sleep_ms(settings["token_latency_ms"])
+            yield chunk({"content": t})
+        yield chunk({}, finish="stop")
+        if include_usage:
+            yield chunk(None, with_usage=True)
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/stats")
+def stats():
+    return {**_stats, "settings": settings}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Local OpenAI stand-in for benchmarks")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=9000)
+    for name, default in settings.items():
+        ap.add_argument("--" + name.replace("_", "-"), type=type(default), default=default)
+    args = ap.parse_args()
+    for name in settings:
+        settings[name] = getattr(args, name)
+    print(f"[FAKE] OpenAI stand-in on http://{args.host}:{args.port}/v1 | {settings}")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
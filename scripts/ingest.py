@@ -1,140 +1,196 @@
 # scripts/ingest.py
+import io
 import os
 import re
-import psycopg2
 import fitz  # PyMuPDF
 from pathlib import Path
-from typing import List, Tuple, Optional, Dict
+from typing import List, Tuple, Optional, Dict, Iterator
+from collections import OrderedDict
 import hashlib
-from openai import OpenAI
-
-from app.config import DB_URL, OPENAI_API_KEY
-
-client = OpenAI(api_key=OPENAI_API_KEY)
+from concurrent.futures import ProcessPoolExecutor
+
+from app.config import EMBED_BATCH_SIZE, EMBED_CONCURRENCY, INGEST_WORKERS, INGEST_PAGE_CACHE, EMBED_QUANT
+from app.config import DOCUMENTS_PARTITIONED, ANN_ITERATIVE_SCAN
+from app.db import get_conn
+from app.sections import SEC_PATTERNS, detect_heading  # noqa: F401  (SEC_PATTERNS 供旧代码引用)
+from app.vector import to_array, pgcopy_binary
+from scripts.embedder import embed_many, STORE_DDL, stats as embed_stats
+from scripts.ann_index import create_index
+from scripts.manifest import MANIFEST_DDL, Manifest, delete_chunks, file_sha256, section_hash
+from scripts.partition import create_partitioned_table, ensure_partitions, relkind
 
 # ------------ 嵌入 ------------
 def embed(text: str) -> List[float]:
-    text = text.strip()
-    if not text:
-        return []
-    resp = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=text
-    )
-    return resp.data[0].embedding
-
-# ------------ 切分：标题/条款号 ------------
-SEC_PATTERNS = [
-    # "Section 3.3.1  Title"
-    re.compile(r'(?i)^\s*(section)\s+(\d+(?:\.\d+)+)\s*[:\-–]?\s*(.*\S)?\s*$'),
-    # "3.3.1  Title"
-    re.compile(r'^\s*(\d+(?:\.\d+){1,6})\s+([A-Z][^\n]{0,120})?\s*$'),
-    # Oncor 常见条款："6.1.1.1.5 Distribution System Charge (DSC)"
-    re.compile(r'^\s*(\d+(?:\.\d+){2,7})\s+([A-Za-z][^\n]{0,160})\s*$'),
-]
-
-def detect_heading(line: str) -> Optional[Tuple[str, str]]:
-    """匹配返回 (section_label, title)。匹配失败返回 None。"""
-    for pat in SEC_PATTERNS:
-        m = pat.match(line)
-        if not m:
-            continue
-        groups = [g for g in m.groups() if g is not None]
-        # 根据不同正则形态回组
-        if len(groups) == 3 and groups[0].lower() == "section":
-            # e.g. "Section 3.3.1 Title"
-            return (groups[1], groups[2] or "")
-        elif len(groups) == 2:
-            # e.g. "3.3.1 Title"
-            return (groups[0], groups[1] or "")
-    return None
-
-def extract_sections_with_toc(pdf_path: str):
-    """优先用 TOC（目录），回退到正则扫描，返回 list[dict]：
-       dict: {section, title, page_start, page_end, text}
+    """单条 embedding（兼容旧调用）；批量请用 embed_many"""
+    return embed_many([text])[0]
+
+# ------------ 抽取页面文本（可多进程） ------------
+def _extract_page_range(args) -> List[str]:
+    """子进程入口：每个 worker 自己打开一个 fitz 句柄，抽 [start, end) 页的文本"""
+    pdf_path, start, end = args
+    doc = fitz.open(pdf_path)
+    try:
+        return [doc.load_page(p).get_text("text") for p in range(start, end)]
+    finally:
+        doc.close()
+
+
+def read_page_texts(pdf_path: str, page_count: int, workers: int = INGEST_WORKERS) -> List[str]:
+    """抽取整份 PDF 的逐页文本，返回 list（下标 = 页码 - 1）。
+    workers > 1 时按页段切给进程池，结果按页序拼回。
+    """
+    if workers <= 1 or page_count < 2 * workers:
+        return _extract_page_range((pdf_path, 0, page_count))
+
+    # 每个 worker 分几段，段小一点方便负载均衡
+    step = max(1, -(-page_count // (workers * 4)))
+    ranges = [(pdf_path, s, min(s + step, page_count)) for s in range(0, page_count, step)]
+    print(f"[INGEST] extracting {page_count} pages with {workers} workers ({len(ranges)} ranges)")
+
+    texts: List[str] = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for part in pool.map(_extract_page_range, ranges):
+            texts.extend(part)
+    return texts
+
+
+class PageTextCache:
+    """按页取文本，每页只抽一次，最多缓存 max_pages 页（LRU）。
+    TOC 的 section 按页序连续，跨页的 section 直接复用缓存里的页，不会重复抽取；
+    内存占用只和 max_pages 有关，和 PDF 总页数无关。
+    """
+
+    def __init__(self, load, page_count: int, max_pages: int = INGEST_PAGE_CACHE):
+        self._load = load                 # 0-based 页号 -> 文本
+        self.page_count = page_count
+        self.max_pages = max(1, max_pages)
+        self._pages: OrderedDict[int, str] = OrderedDict()
+        self.reads = 0
+        self.hits = 0
+
+    def get(self, page: int) -> str:
+        """page 从 1 起"""
+        text = self._pages.get(page)
+        if text is not None:
+            self.hits += 1
+            self._pages.move_to_end(page)
+            return text
+        text = self._load(page - 1)
+        self.reads += 1
+        self._pages[page] = text
+        if len(self._pages) > self.max_pages:
+            self._pages.popitem(last=False)
+        return text
+
+    def text(self, page_start: int, page_end: int) -> str:
+        page_end = min(page_end, self.page_count)
+        if page_end < page_start:
+            return ""
+        return "\n".join(self.get(p) for p in range(page_start, page_end + 1)).strip()
+
+
+def iter_sections(pdf_path: str, workers: int = INGEST_WORKERS,
+                  cache_pages: int = INGEST_PAGE_CACHE) -> Iterator[dict]:
+    """流式版 extract_sections_with_toc：逐个产出 section dict（字段相同），
+    页文本按需抽取并放在有界缓存里，整份 PDF 的文本不会同时留在内存。
+    workers > 1 时仍先用进程池并行抽全部页（换速度，不省内存）。
     """
     doc = fitz.open(pdf_path)
-    print(f"[INGEST] open PDF: {pdf_path} ({doc.page_count} pages)")
+    page_count = doc.page_count
+    print(f"[INGEST] open PDF: {pdf_path} ({page_count} pages)")
 
     # 1) 先尝试 TOC（很多规范/协议类 PDF 有目录）
     toc = doc.get_toc(simple=True)  # [(level, title, page_no), ...] page从1起
-    sections = []
-    if toc:
-        print(f"[INGEST] TOC entries: {len(toc)} (using TOC to cut)")
-        # 只取 level 2/3 标题更准；没要求就都用
-        for i, (lvl, title, page1) in enumerate(toc):
-            page_start = max(1, int(page1))
-            page_end = int(toc[i+1][2] - 1) if i+1 < len(toc) else doc.page_count
-            # 抽取文本
-            text_parts = []
-            for p in range(page_start-1, page_end):
-                text_parts.append(doc.load_page(p).get_text("text"))
-            block_text = "\n".join(text_parts).strip()
-
-            # 尝试从 title 中抽 section 号
-            sec = None
-            m = re.search(r'(?i)(?:section\s+)?(\d+(?:\.\d+)+)', title)
-            if m:
-                sec = m.group(1)
-            sections.append({
-                "section": sec,
-                "title": title.strip(),
-                "page_start": page_start,
-                "page_end": page_end,
-                "text": block_text
-            })
-
-    # 2) 如果没有 TOC，回退到逐页正则识别标题
-    if not sections:
-        print("[INGEST] No TOC/regex headings detected; fallback to whole document")
-        headings = []  # [(page_idx0, section_label, title, y_order, line_text)]
-        for p in range(doc.page_count):
-            page = doc.load_page(p)
-            page_text = page.get_text("text")
-            for raw_line in page_text.splitlines():
-                line = raw_line.strip()
-                if not line:
-                    continue
-                h = detect_heading(line)
-                if h:
-                    headings.append((p, h[0], h[1], line))
-
-        # 用识别到的 heading 将全文切块
-        if headings:
-            # 根据出现顺序切分
-            for i, (p0, sec, title, _) in enumerate(headings):
-                page_start = p0 + 1
-                page_end = (headings[i+1][0] + 1) - 1 if i+1 < len(headings) else doc.page_count
-                text_parts = []
-                for p in range(page_start-1, page_end):
-                    text_parts.append(doc.load_page(p).get_text("text"))
-                block_text = "\n".join(text_parts).strip()
-                sections.append({
+
+    if workers > 1:
+        doc.close()
+        page_texts = read_page_texts(pdf_path, page_count, workers=workers)
+        pages = PageTextCache(page_texts.__getitem__, page_count, max_pages=1)
+    else:
+        pages = PageTextCache(lambda i: doc.load_page(i).get_text("text"), page_count, cache_pages)
+
+    n = 0
+    try:
+        if toc:
+            print(f"[INGEST] TOC entries: {len(toc)} (using TOC to cut)")
+            # 只取 level 2/3 标题更准；没要求就都用
+            for i, (lvl, title, page1) in enumerate(toc):
+                page_start = max(1, int(page1))
+                page_end = int(toc[i+1][2] - 1) if i+1 < len(toc) else page_count
+
+                # 尝试从 title 中抽 section 号
+                sec = None
+                m = re.search(r'(?i)(?:section\s+)?(\d+(?:\.\d+)+)', title)
+                if m:
+                    sec = m.group(1)
+                n += 1
+                yield {
                     "section": sec,
                     "title": title.strip(),
                     "page_start": page_start,
                     "page_end": page_end,
-                    "text": block_text
-                })
-
-    # 3) 若还是识别不到，退化为整页拼段（保证可用）
-    if not sections:
-        print("[INGEST] Still cannot detect headings; fallback to paragraphing whole document")
-        text_parts = []
-        for p in range(doc.page_count):
-            text_parts.append(doc.load_page(p).get_text("text"))
-        whole = "\n".join(text_parts).strip()
-        sections = [{
-            "section": None,
-            "title": Path(pdf_path).name,
-            "page_start": 1,
-            "page_end": doc.page_count,
-            "text": whole
-        }]
-
-    doc.close()
-    print(f"[INGEST] sections detected: {len(sections)}")
-    return sections
+                    "text": pages.text(page_start, page_end)
+                }
+
+        # 2) 如果没有 TOC，回退到逐页正则识别标题：一遍扫描，遇到下一个标题时产出上一个 section
+        if not n:
+            print("[INGEST] No TOC/regex headings detected; fallback to whole document")
+            prev = None  # (page_start, section_label, title)
+            for p0 in range(page_count):
+                for raw_line in pages.get(p0 + 1).splitlines():
+                    line = raw_line.strip()
+                    if not line:
+                        continue
+                    h = detect_heading(line)
+                    if not h:
+                        continue
+                    if prev is not None:
+                        n += 1
+                        yield _heading_section(pages, prev, p0)
+                    prev = (p0 + 1, h[0], h[1])
+            if prev is not None:
+                n += 1
+                yield _heading_section(pages, prev, page_count)
+
+        # 3) 若还是识别不到，退化为整页拼段（保证可用）
+        if not n:
+            print("[INGEST] Still cannot detect headings; fallback to paragraphing whole document")
+            n += 1
+            yield {
+                "section": None,
+                "title": Path(pdf_path).name,
+                "page_start": 1,
+                "page_end": page_count,
+                "text": pages.text(1, page_count)
+            }
+    finally:
+        if not doc.is_closed:
+            doc.close()
+
+    print(f"[INGEST] sections detected: {n}")
+    if workers <= 1:
+        print(f"[INGEST] page cache: {pages.reads}/{page_count} pages read, {pages.hits} hits "
+              f"(max {pages.max_pages} pages)")
+
+
+def _heading_section(pages: PageTextCache, prev: tuple, page_end: int) -> dict:
+    page_start, sec, title = prev
+    return {
+        "section": sec,
+        "title": title.strip(),
+        "page_start": page_start,
+        "page_end": page_end,
+        "text": pages.text(page_start, page_end)
+    }
+
+
+def extract_sections_with_toc(pdf_path: str, workers: int = INGEST_WORKERS):
+    """优先用 TOC（目录），回退到正则扫描，返回 list[dict]：
+       dict: {section, title, page_start, page_end, text}
+       每页文本只抽一次（workers > 1 时多进程并行），各 section 按页码范围拼接。
+       大文件请用 iter_sections 逐个处理，内存不随页数增长。
+    """
+    return list(iter_sections(pdf_path, workers=workers))
 
 # ------------ 二级切分（防止块过大） ------------
 def soft_chunk(text: str, max_chars=2000, overlap=200) -> list[str]:
@@ -175,15 +231,144 @@ def soft_chunk(text: str, max_chars=2000, overlap=200) -> list[str]:
 
 # ------------ 写库 ------------
 def ensure_table():
-    conn = psycopg2.connect(DB_URL)
-    cur = conn.cursor()
-    print("[INGEST] ensure documents table exists...")
-
-    # 1) 创建表（如果不存在）
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS documents (
-        id SERIAL PRIMARY KEY,
-        content  TEXT NOT NULL,
+    with get_conn() as conn:
+        cur = conn.cursor()
+        print("[INGEST] ensure documents table exists...")
+
+        # 1) 创建表（如果不存在）；新库默认按 bucket 分区（scripts/partition.py）
+        kind = relkind(cur)
+        if kind is None and DOCUMENTS_PARTITIONED:
+            cur.execute("CREATE SEQUENCE IF NOT EXISTS documents_id_seq")
+            create_partitioned_table(cur)
+            cur.execute("ALTER SEQUENCE documents_id_seq OWNED BY documents.id")
+            print("[INGEST] created documents partitioned by bucket")
+        elif kind == "r" and DOCUMENTS_PARTITIONED:
+            print("[INGEST] documents is not partitioned; run `python -m scripts.partition migrate` to convert it")
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS documents (
+            id SERIAL PRIMARY KEY,
+            content  TEXT NOT NULL,
+            embedding vector(1536),
+            source   TEXT,
+            section  TEXT,
+            title    TEXT,
+            page     INT,
+            page_start INT,
+            page_end   INT,
+            bucket   TEXT,
+            content_hash TEXT,
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+        """)
+
+        # 2) 给 content_hash 填已有旧数据
+        cur.execute("""
+            UPDATE documents
+            SET content_hash = md5(content)
+            WHERE content_hash IS NULL;
+        """)
+
+        # 3) 创建 UPSERT 所需的唯一索引
+        #   注意：只有当前用户是 owner 才能成功创建
+        cur.execute("""
+        DO $$
+        DECLARE
+            owner text;
+        BEGIN
+            -- 查 documents 的所有人
+            SELECT pg_get_userbyid(relowner)
+            INTO owner
+            FROM pg_class
+            WHERE relname='documents'
+              AND relnamespace='public'::regnamespace;
+
+            IF owner = current_user THEN
+                -- 如果索引不存在，则创建
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_indexes
+                    WHERE schemaname='public'
+                      AND indexname='uniq_doc_block'
+                ) THEN
+                    RAISE NOTICE 'creating unique index uniq_doc_block...';
+                    CREATE UNIQUE INDEX uniq_doc_block
+                    ON public.documents (
+                        source,
+                        bucket,
+                        COALESCE(section,''),
+                        page_start,
+                        page_end,
+                        content_hash
+                    );
+                END IF;
+
+                -- 条款号直查（app.rag 的 section 快速路径）用的 B-tree；
+                -- section 在前：不带 bucket 的问题也能走索引，带 bucket 时两列都用上
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_indexes
+                    WHERE schemaname='public'
+                      AND indexname='documents_section_bucket'
+                ) THEN
+                    RAISE NOTICE 'creating index documents_section_bucket...';
+                    CREATE INDEX documents_section_bucket
+                    ON public.documents (section, bucket);
+                END IF;
+                -- 旧版本建的 (bucket, section) 已被上面这个取代
+                DROP INDEX IF EXISTS public.documents_bucket_section;
+            ELSE
+                RAISE NOTICE 'skip index creation because current_user % is NOT owner %', current_user, owner;
+            END IF;
+        END$$;
+        """)
+
+        # 4) ingest 清单（断点续传 / 增量）
+        cur.execute(MANIFEST_DDL)
+
+        # 5) 内容寻址 embedding 库
+        cur.execute(STORE_DDL)
+
+        # 6) ingest 代数：每次写入新行 +1，app 侧据此让回答缓存失效
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS ingest_generations (
+                bucket     TEXT PRIMARY KEY,
+                generation BIGINT NOT NULL DEFAULT 0,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+        """)
+
+        # 7) 量化检索（EMBED_QUANT=halfvec/binary）：量化副本是 documents 上的表达式索引，
+        #    写入时由 Postgres 维护，insert_records 不用改；索引在 ingest 结束时由 create_index() 建。
+        #    halfvec / binary_quantize 需要 pgvector >= 0.7，迭代索引扫描（ANN_ITERATIVE_SCAN）需要 0.8
+        cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        row = cur.fetchone()
+        version = tuple(int(x) for x in re.findall(r"\d+", row[0])[:3]) if row else (0,)
+        if EMBED_QUANT != "none" and version < (0, 7, 0):
+            raise RuntimeError(f"EMBED_QUANT={EMBED_QUANT} needs pgvector >= 0.7.0, found {row[0] if row else 'none'}")
+        if ANN_ITERATIVE_SCAN != "off" and version < (0, 8, 0):
+            print(f"[INGEST][WARN] ANN_ITERATIVE_SCAN={ANN_ITERATIVE_SCAN} needs pgvector >= 0.8.0 "
+                  f"(found {row[0] if row else 'none'}); search will run without iterative scans")
+
+        conn.commit()
+
+
+def bump_generation(cur, buckets):
+    """在当前事务里把这些 bucket 的 ingest 代数 +1"""
+    for b in sorted(buckets, key=lambda x: x or ""):
+        cur.execute("""
+            INSERT INTO ingest_generations (bucket, generation) VALUES (%s, 1)
+            ON CONFLICT (bucket) DO UPDATE
+            SET generation = ingest_generations.generation + 1, updated_at = now();
+        """, (b or "",))
+
+
+_DOC_COLUMNS = (
+    "content, embedding, source, section, title, "
+    "page, page_start, page_end, bucket, content_hash"
+)
+
+# 会话级临时表，COPY 进来后一条 INSERT ... SELECT 落到 documents；提交时自动清空
+_STAGING_DDL = """
+    CREATE TEMP TABLE IF NOT EXISTS documents_staging (
+        content  TEXT,
         embedding vector(1536),
         source   TEXT,
         section  TEXT,
@@ -192,165 +377,261 @@ def ensure_table():
         page_start INT,
         page_end   INT,
         bucket   TEXT,
-        content_hash TEXT,
-        created_at TIMESTAMP DEFAULT NOW()
-    );
-    """)
-
-    # 2) 给 content_hash 填已有旧数据
-    cur.execute("""
-        UPDATE documents
-        SET content_hash = md5(content)
-        WHERE content_hash IS NULL;
-    """)
-
-    # 3) 创建 UPSERT 所需的唯一索引
-    #   注意：只有当前用户是 owner 才能成功创建
-    cur.execute("""
-    DO $$
-    DECLARE
-        owner text;
-    BEGIN
-        -- 查 documents 的所有人
-        SELECT pg_get_userbyid(relowner)
-        INTO owner
-        FROM pg_class
-        WHERE relname='documents'
-          AND relnamespace='public'::regnamespace;
-
-        IF owner = current_user THEN
-            -- 如果索引不存在，则创建
-            IF NOT EXISTS (
-                SELECT 1 FROM pg_indexes
-                WHERE schemaname='public'
-                  AND indexname='uniq_doc_block'
-            ) THEN
-                RAISE NOTICE 'creating unique index uniq_doc_block...';
-                CREATE UNIQUE INDEX uniq_doc_block
-                ON public.documents (
-                    source,
-                    bucket,
-                    COALESCE(section,''),
-                    page_start,
-                    page_end,
-                    content_hash
-                );
-            END IF;
-        ELSE
-            RAISE NOTICE 'skip index creation because current_user % is NOT owner %', current_user, owner;
-        END IF;
-    END$$;
-    """)
-
-    conn.commit()
-    conn.close()
+        content_hash TEXT
+    ) ON COMMIT DELETE ROWS;
+"""
 
 
-def insert_record(conn, content, emb, source, section, title,
-                  page_start, page_end, bucket):
-    cur = conn.cursor()
-
-    # 计算内容哈希
-    content_hash = hashlib.md5(content.encode("utf-8")).hexdigest()
-
-    cur.execute("""
-        INSERT INTO documents (
+def insert_records(conn, rows, commit: bool = True) -> int:
+    """批量写入：rows 为 (content, emb, source, section, title, page_start, page_end, bucket)。
+    COPY (FORMAT binary) 到临时表，再一条 INSERT ... SELECT ... ON CONFLICT（沿用 uniq_doc_block 去重），
+    已有的 chunk 只在向量变了时更新 embedding（embedding 输入格式升级后重嵌）；
+    整批一次提交（commit=False 时由调用方在同一事务里提交）。返回新插入 + 更新的行数。
+    """
+    if not rows:
+        return 0
+
+    records = []
+    seen = set()
+    for content, emb, source, section, title, page_start, page_end, bucket in rows:
+        # 计算内容哈希
+        content_hash = hashlib.md5(content.encode("utf-8")).hexdigest()
+        # 同一批里 uniq_doc_block 键相同的行（重复页面切出的相同 chunk）只留一行：
+        # ON CONFLICT DO UPDATE 不允许一条语句两次更新同一行
+        key = (source, bucket, section or "", page_start, page_end, content_hash)
+        if key in seen:
+            continue
+        seen.add(key)
+        records.append((
             content,
-            embedding,
+            to_array(emb),   # 向量按 pgvector 二进制格式写，不再转十进制文本
             source,
             section,
             title,
-            page,
+            page_start,   # 保持page = page_start 兼容旧逻辑
             page_start,
             page_end,
             bucket,
-            content_hash
-        )
-        VALUES (
-            %s,
-            %s::vector,
-            %s,
-            %s,
-            %s,
-            %s,
-            %s,
-            %s,
-            %s,
-            %s
-        )
-        ON CONFLICT (source, bucket, COALESCE(section,''), page_start, page_end, content_hash)
-        DO NOTHING;
-    """, (
-        content,
-        "[" + ",".join(f"{x:.6f}" for x in emb) + "]",
-        source,
-        section,
-        title,
-        page_start,   # 保持page = page_start 兼容旧逻辑
-        page_start,
-        page_end,
-        bucket,
-        content_hash
-    ))
-
-    conn.commit()
-
-
-def ingest_pdf(pdf_path: str, bucket: str):
-    ensure_table()
-    pdf_path = str(pdf_path)
-    sections = extract_sections_with_toc(pdf_path)
-    conn = psycopg2.connect(DB_URL)
+            content_hash,
+        ))
+    buf = io.BytesIO(pgcopy_binary(records))
+    # 分区表：新 bucket 先建分区（单独提交），否则会落进 DEFAULT 分区
+    ensure_partitions({r[7] for r in rows})
+
+    try:
+        cur = conn.cursor()
+        cur.execute(_STAGING_DDL)
+        cur.copy_expert(f"COPY documents_staging ({_DOC_COLUMNS}) FROM STDIN WITH (FORMAT binary)", buf)
+        cur.execute(f"""
+            INSERT INTO documents ({_DOC_COLUMNS})
+            SELECT {_DOC_COLUMNS} FROM documents_staging
+            ON CONFLICT (source, bucket, COALESCE(section,''), page_start, page_end, content_hash)
+            DO UPDATE SET embedding = EXCLUDED.embedding
+            WHERE documents.embedding IS DISTINCT FROM EXCLUDED.embedding;
+        """)
+        inserted = cur.rowcount
+        if inserted > 0:
+            bump_generation(cur, {r[7] for r in rows})
+        if commit:
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return inserted
+
+
+def insert_record(conn, content, emb, source, section, title,
+                  page_start, page_end, bucket):
+    """单行写入（兼容旧调用），内部走 insert_records"""
+    return insert_records(conn, [(content, emb, source, section, title,
+                                  page_start, page_end, bucket)])
+
+
+def begin_file(pdf_path: str, bucket: str, force: bool = False) -> Manifest | None:
+    """读清单并把文件标记为 running；文件没变且上次已完成时返回 None（跳过）"""
     src_name = Path(pdf_path).name
+    file_hash = file_sha256(pdf_path)
+
+    manifest = Manifest(src_name, bucket)
+    with get_conn() as conn:
+        cur = conn.cursor()
+        manifest.load(cur)
+        if manifest.is_done(file_hash) and not force:
+            print(f"[INGEST] unchanged since last ingest, skip: {src_name} | bucket={bucket}")
+            return None
+        manifest.start(cur, file_hash)
+        conn.commit()
+    return manifest
+
+
+def chunk_section(src_name: str, sec: dict) -> tuple[list[str], list[str], str]:
+    """section -> (带装饰头的 chunk, 每个 chunk 的哈希, section 哈希)"""
+    sub_chunks = soft_chunk(sec["text"], max_chars=2000, overlap=200)
+    decorated_chunks = [
+        f"[{src_name} | sec:{sec['section'] or '-'} | {sec['title']} | "
+        f"p.{sec['page_start']}-{sec['page_end']}]\n{sub}"
+        for sub in sub_chunks
+    ]
+    chunk_hashes = [hashlib.md5(d.encode("utf-8")).hexdigest() for d in decorated_chunks]
+    return decorated_chunks, chunk_hashes, section_hash(chunk_hashes)
+
+
+def embed_input(content: str) -> str:
+    """带装饰头的 chunk -> 送去 embedding 的文本：去掉 [文件 | sec | 标题 | 页码] 头，合并空白。
+    embedding_store 按这段文本寻址，TOC 重叠的 section、换了文件名重新导入的同一份 PDF 都能命中。
+    """
+    head, sep, body = content.partition("]\n")
+    if not (sep and head.startswith("[")):
+        body = content
+    return " ".join(body.split())
 
-    print(f"[INGEST] start ingest: {src_name} | sections={len(sections)} | bucket={bucket}")
-    RESUME_FROM_SECTION = 1250
 
-    inserted = 0
-    for si, sec in enumerate(sections, start=1):
-        if si < RESUME_FROM_SECTION:
+def write_batch(conn, manifest: Manifest, pending: list[dict], pending_sections: list[tuple],
+                embs: list, sections_done: int) -> tuple[int, int]:
+    """一批一个事务：写入新 chunk、删掉被替换的旧 chunk、更新清单，一次提交。
+    pending_sections 为 (key, meta, section_hash, chunk_hashes)；返回 (新插入, 删除) 行数。
+    """
+    src_name, bucket = manifest.source, manifest.bucket
+    rows = []
+    for p, emb in zip(pending, embs):
+        if not emb:
+            print(f"[INGEST][WARN] empty embedding at section {p['si']} chunk {p['ci']}, skip")
             continue
-        sec_label = sec["section"]
-        title = sec["title"]
-        page_start = sec["page_start"]
-        page_end = sec["page_end"]
-        text = sec["text"]
-
-        print(f"[INGEST] section {si}/{len(sections)}: sec={sec_label or '-'} | "
-              f"title='{title[:60]}' | pages {page_start}-{page_end} | len={len(text)}")
-
-        sub_chunks = soft_chunk(text, max_chars=2000, overlap=200)
-        print(f"[INGEST]   -> soft-chunks: {len(sub_chunks)}")
-
-        for ci, sub in enumerate(sub_chunks, start=1):
-            decorated = f"[{src_name} | sec:{sec_label or '-'} | {title} | p.{page_start}-{page_end}]\n{sub}"
-            emb = embed(decorated)
-            if not emb:
-                print(f"[INGEST][WARN] empty embedding at section {si} chunk {ci}, skip")
+        rows.append((
+            p["content"],
+            emb,
+            src_name,
+            p["section"],
+            p["title"],
+            p["page_start"],
+            p["page_end"],
+            bucket
+        ))
+    try:
+        n = insert_records(conn, rows, commit=False)
+        cur = conn.cursor()
+        stale = set()
+        for key, meta, sec_hash, chunk_hashes in pending_sections:
+            stale |= manifest.update(cur, key, meta, sec_hash, chunk_hashes)
+        d = delete_chunks(cur, src_name, bucket, stale)
+        if d and not n:
+            bump_generation(cur, {bucket})
+        manifest.progress(cur, sections_done)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return n, d
+
+
+def finish_file(conn, manifest: Manifest, seen: set, total: int) -> int:
+    """新版本里已经没有的 section：删数据、删清单，并把文件标记为完成；返回删除行数"""
+    cur = conn.cursor()
+    try:
+        stale = manifest.remove_missing(cur, seen)
+        d = delete_chunks(cur, manifest.source, manifest.bucket, stale)
+        if d:
+            bump_generation(cur, {manifest.bucket})
+        manifest.finish(cur, total)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return d
+
+
+def ingest_pdf(pdf_path: str, bucket: str, force: bool = False):
+    """导入一个 PDF。按 ingest 清单增量处理：
+    文件没变直接跳过；中断后重跑从断点继续；只重嵌内容变了的 section；删掉已消失 section 的数据。
+    force=True 时忽略文件级跳过（section 级仍按哈希比较）。
+    多个文件请用 scripts/pipeline.py（抽取 / 切分 / embedding / 写库流水线并行）。
+    """
+    ensure_table()
+    pdf_path = str(pdf_path)
+    manifest = begin_file(pdf_path, bucket, force)
+    if manifest is None:
+        return
+    src_name = manifest.source
+
+    # 逐个 section 流式处理：页文本在有界缓存里，内存不随 PDF 大小增长
+    sections = iter_sections(pdf_path)
+
+    # 攒够一批 chunk 再统一 embedding：多个 batch 并发，结果按顺序对回 section 元数据
+    flush_size = max(1, EMBED_BATCH_SIZE * EMBED_CONCURRENCY)
+    pending: list[dict] = []
+    pending_sections: list[tuple] = []   # (key, meta, section_hash, chunk_hashes)
+    seen: set = set()
+    inserted = deleted = skipped = done = total = 0
+
+    def flush(conn):
+        nonlocal inserted, deleted, done
+        if not pending and not pending_sections:
+            return
+        embs = embed_many([embed_input(p["content"]) for p in pending])
+        n, d = write_batch(conn, manifest, pending, pending_sections, embs,
+                           done + len(pending_sections) + skipped)
+        inserted += n
+        deleted += d
+        done += len(pending_sections)
+        print(f"[INGEST]   -> embedded {len(pending)} chunks, inserted {inserted} / "
+              f"replaced {deleted} chunks total...")
+        pending.clear()
+        pending_sections.clear()
+
+    with get_conn() as conn:
+        print(f"[INGEST] start ingest: {src_name} | bucket={bucket}")
+
+        for si, sec in enumerate(sections, start=1):
+            total = si
+            sec_label = sec["section"]
+            title = sec["title"]
+            page_start = sec["page_start"]
+            page_end = sec["page_end"]
+
+            decorated_chunks, chunk_hashes, sec_hash = chunk_section(src_name, sec)
+            key = manifest.section_key(sec_label, title)
+            seen.add(key)
+
+            # 上次已写完且内容没变：跳过（断点续传 / 增量）
+            if manifest.is_unchanged(key, sec_hash):
+                skipped += 1
                 continue
 
-            insert_record(
-                conn,
-                decorated,
-                emb,
-                src_name,
-                sec_label,
-                title,
-                page_start,
-                page_end,
-                bucket
-            )
-            inserted += 1
-            if ci % 10 == 0:
-                print(f"[INGEST]   -> inserted {inserted} chunks total...")
-
-    conn.close()
-    print(f"✅ Ingest OK: {src_name} | total chunks inserted = {inserted}")
+            print(f"[INGEST] section {si}: sec={sec_label or '-'} | "
+                  f"title='{title[:60]}' | pages {page_start}-{page_end} | len={len(sec['text'])}")
+            print(f"[INGEST]   -> soft-chunks: {len(decorated_chunks)}")
+
+            for ci, decorated in enumerate(decorated_chunks, start=1):
+                pending.append({
+                    "si": si,
+                    "ci": ci,
+                    "content": decorated,
+                    "section": sec_label,
+                    "title": title,
+                    "page_start": page_start,
+                    "page_end": page_end,
+                })
+            meta = {"section": sec_label, "title": title,
+                    "page_start": page_start, "page_end": page_end}
+            pending_sections.append((key, meta, sec_hash, chunk_hashes))
+
+            if len(pending) >= flush_size:
+                flush(conn)
+
+        flush(conn)
+        deleted += finish_file(conn, manifest, seen, total)
+
+    print(f"✅ Ingest OK: {src_name} | total chunks inserted = {inserted} | "
+          f"removed = {deleted} | unchanged sections skipped = {skipped}")
+    print(f"[INGEST] embeddings: {embed_stats.report()}")
+
+    # 数据灌完再建 ANN 索引（IVFFlat 需要已有数据训练；已存在则跳过）
+    create_index()
 
 
 # ------------ CLI ------------
+# 用法见 scripts/pipeline.py，例如：
+#   python -m scripts.ingest ercot=data/ercot oncor="data/oncor/*.pdf"
 if __name__ == "__main__":
-    # 示例：可以按需替换为实际文件
-    # ingest_pdf("data/Tariff-for-Retail-Delivery-Service.pdf", bucket="oncor")
-    ingest_pdf("data/September-1-2025-Nodal-Protocols.pdf", bucket="ercot")
-    # ingest_pdf("data/Sample.pdf", bucket="ercot")
+    from scripts.pipeline import main
+    main()
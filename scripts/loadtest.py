@@ -0,0 +1,157 @@
+# scripts/loadtest.py
+# /ask 并发压测：回放 JSONL 流量（每行一个 AskRequest，例如 data/bench_queries.jsonl），
+# 固定并发数持续发请求，输出 QPS、延迟分位数、状态码分布和压测期间的缓存命中率。
+# 流量文件只有几条问题，循环几轮后测的基本是回答缓存 / embedding 缓存命中：
+#   --no-cache 给每个请求的问题加唯一后缀，缓存和 single-flight 都不命中，测检索 + LLM 的真实延迟；
+#   也可以在服务端用 EMBED_CACHE_SIZE=0 ANSWER_CACHE_SIZE=0 关掉缓存
+# 配合 scripts/fake_openai.py 使用时只测我们自己的代码 + Postgres，不受公网波动影响：
+#   python -m scripts.fake_openai --port 9000 &
+#   OPENAI_BASE_URL=http://127.0.0.1:9000/v1 OPENAI_API_KEY=fake uvicorn app.main:app --port 8000 &
+#   python -m scripts.loadtest --url http://127.0.0.1:8000 --concurrency 32 --requests 2000
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+
+import httpx
+
+from scripts.benchutil import percentiles, report
+
+
+def load_traffic(path: str) -> list[dict]:
+    """每行一个 JSON：AskRequest 的字段（query/bucket/top_k/...）；
+    也接受只有 title/body 的行（如 requests.jsonl），把 title 当作 query"""
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            obj = json.loads(line)
+            if "query" not in obj:
+                if "title" not in obj:
+                    continue
+                obj = {"query": obj["title"]}
+            items.append(obj)
+    if not items:
+        raise SystemExit(f"no requests in {path}")
+    return items
+
+
+_CACHES = ("embedding_cache", "answer_cache")
+
+
+async def _cache_counters(client: httpx.AsyncClient) -> dict | None:
+    """从 /stats 读 (命中数, 查找数)；取不到时返回 None"""
+    try:
+        resp = await client.get("/stats")
+        stats = resp.json()
+    except (httpx.HTTPError, ValueError):
+        return None
+    out = {}
+    for name in _CACHES:
+        st = stats.get(name) or {}
+        lru = st.get("lru", st)
+        hits = lru.get("hits", 0) + st.get("pg_hits", 0)
+        out[name] = (hits, lru.get("hits", 0) + lru.get("misses", 0))
+    return out
+
+
+def _cache_report(before: dict | None, after: dict | None) -> str:
+    if before is None or after is None:
+        return "n/a (GET /stats failed)"
+    parts = []
+    for name in _CACHES:
+        hits = after[name][0] - before[name][0]
+        lookups = after[name][1] - before[name][1]
+        rate = f"{hits / lookups:.1%}" if lookups else "-"
+        parts.append(f"{name}={rate} ({hits}/{lookups})")
+    return " | ".join(parts)
+
+
+def _bodies(traffic: list[dict], no_cache: bool):
+    """循环回放流量；no_cache 时每个问题加唯一后缀，缓存键和 single-flight 键都不会重复"""
+    for n, body in enumerate(itertools.cycle(traffic)):
+        yield {**body, "query": f"{body['query']} (load #{n})"} if no_cache else body
+
+
+async def _one(client: httpx.AsyncClient, endpoint: str, body: dict) -> tuple[float, float | None, str]:
+    """返回 (总耗时, 首字节耗时, 状态)"""
+    t0 = time.perf_counter()
+    ttfb = None
+    try:
+        async with client.stream("POST", endpoint, json=body) as resp:
+            async for _ in resp.aiter_bytes():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - t0
+            status = str(resp.status_code)
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    return time.perf_counter() - t0, ttfb, status
+
+
+async def run(url: str, endpoint: str, traffic: list[dict], concurrency: int,
+              total: int, duration: float | None, warmup: int, timeout: float, no_cache: bool = False):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        bodies = _bodies(traffic, no_cache)
+        for _ in range(min(warmup, len(traffic))):
+            await _one(client, endpoint, next(bodies))
+        if not no_cache:
+            bodies = _bodies(traffic, False)
+
+        before = await _cache_counters(client)
+        latencies: list[float] = []
+        ttfbs: list[float] = []
+        statuses: Counter = Counter()
+        sent = 0
+        t_start = time.perf_counter()
+        deadline = t_start + duration if duration else None
+
+        async def worker():
+            nonlocal sent
+            while True:
+                if deadline is not None:
+                    if time.perf_counter() >= deadline:
+                        return
+                elif sent >= total:
+                    return
+                sent += 1
+                elapsed, ttfb, status = await _one(client, endpoint, next(bodies))
+                statuses[status] += 1
+                if status == "200":
+                    latencies.append(elapsed)
+                    if ttfb is not None:
+                        ttfbs.append(ttfb)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - t_start
+        after = await _cache_counters(client)
+
+    ok = statuses.get("200", 0)
+    print(f"[LOAD] {endpoint} | concurrency={concurrency} | sent={sent} | ok={ok} | "
+          f"wall={wall:.1f}s | QPS={ok / wall:.1f} | statuses={dict(statuses)}")
+    print(f"[LOAD] cache hit rate{' (--no-cache)' if no_cache else ''}: {_cache_report(before, after)}")
+    report(f"{endpoint} latency", latencies, wall, concurrency=concurrency)
+    if endpoint.endswith("/stream"):
+        print(f"[LOAD] time to first byte: {percentiles(ttfbs)}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Concurrent /ask load generator")
+    ap.add_argument("--url", default="http://127.0.0.1:8000")
+    ap.add_argument("--endpoint", default="/ask", choices=["/ask", "/ask/stream"])
+    ap.add_argument("--traffic", default="data/bench_queries.jsonl", help="JSONL, one AskRequest per line")
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--requests", type=int, default=500, help="total requests (ignored with --duration)")
+    ap.add_argument("--duration", type=float, default=None, help="run for N seconds instead of a fixed count")
+    ap.add_argument("--warmup", type=int, default=5)
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--no-cache", action="store_true",
+                    help="make every query unique so the answer / embedding caches never hit")
+    args = ap.parse_args()
+
+    asyncio.run(run(args.url, args.endpoint, load_traffic(args.traffic), max(1, args.concurrency),
+                    args.requests, args.duration, args.warmup, args.timeout, args.no_cache))
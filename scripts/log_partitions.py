@@ -0,0 +1,143 @@
+# scripts/log_partitions.py
+# query_logs 按月分区的管理：新库由 LogWriter.ensure_table 直接建成分区表，
+# 这里负责把已有的普通表迁移过去，以及查看各分区的大小。保留期清理见 export_logs.sh（整月 DROP 分区）。
+#
+#   python -m scripts.log_partitions status
+#   python -m scripts.log_partitions migrate [--keep-old]
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+
+from app.config import LOG_PARTITIONS_AHEAD
+from app.db import get_conn
+from app.logwriter import (
+    LOG_DDL,
+    PARTITIONED_LOG_DDL,
+    create_log_partition,
+    log_partition_name,
+    log_relkind,
+    month_start,
+    next_month,
+)
+
+TABLE = "query_logs"
+NEW_TABLE = "query_logs_part"             # 迁移时新表的临时名字
+OLD_TABLE = "query_logs_unpartitioned"    # 迁移后旧表（--keep-old 时保留）
+
+_COLUMNS = "id, created_at, query, bucket, answer, timings, prompt_tokens, completion_tokens"
+_COPY_SQL = f"INSERT INTO {NEW_TABLE} ({_COLUMNS}) SELECT {_COLUMNS} FROM {TABLE}"
+
+
+def migrate(keep_old: bool = False):
+    """普通表 query_logs -> 按月分区的新表。
+    1) 建 query_logs_part 和从最早一条到未来 LOG_PARTITIONS_AHEAD 个月的分区，逐月复制（旧表照常写入）
+    2) 一个事务里：锁住旧表挡写，补复制期间新写入的行，核对行数，改名切换
+    日志写入在切换那一下会短暂等待；复制期间不要跑 export_logs.sh 的清理。
+    """
+    t_start = time.perf_counter()
+    with get_conn() as conn:
+        cur = conn.cursor()
+        kind = log_relkind(cur)
+        if kind is None:
+            raise SystemExit(f"{TABLE} does not exist; new setups are created partitioned by the app on startup")
+        if kind == "p":
+            print(f"[LOG] {TABLE} is already partitioned")
+            return
+        # 旧库可能还没有 timings / token 列
+        cur.execute(LOG_DDL)
+        cur.execute(f"SELECT pg_get_serial_sequence('{TABLE}', 'id')")
+        seq = cur.fetchone()[0]
+        cur.execute(f"DROP TABLE IF EXISTS {NEW_TABLE}")
+        cur.execute(PARTITIONED_LOG_DDL.format(table=NEW_TABLE, seq=seq))
+
+        cur.execute(f"SELECT COALESCE(max(id), 0), min(created_at) FROM {TABLE}")
+        high, oldest = cur.fetchone()
+        now = datetime.now(timezone.utc)
+        month = month_start(oldest or now)
+        last = month_start(now)
+        for _ in range(LOG_PARTITIONS_AHEAD):
+            last = next_month(last)
+        months = []
+        while month <= last:
+            months.append(month)
+            create_log_partition(cur, month, NEW_TABLE)
+            month = next_month(month)
+        conn.commit()
+        print(f"[LOG] created {NEW_TABLE} with {len(months)} monthly partitions")
+
+        # 每个月一个事务
+        for m in months:
+            t0 = time.perf_counter()
+            cur.execute(_COPY_SQL + " WHERE created_at >= %s AND created_at < %s AND id <= %s",
+                        (m, next_month(m), high))
+            n = cur.rowcount
+            conn.commit()
+            if n:
+                print(f"[LOG] copied {n} rows into {log_partition_name(m)} in {time.perf_counter() - t0:.1f}s")
+
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(f"LOCK TABLE {TABLE} IN EXCLUSIVE MODE")   # 挡写，不挡读
+        cur.execute(_COPY_SQL + " WHERE id > %s", (high,))
+        delta = cur.rowcount
+        cur.execute(f"SELECT (SELECT count(*) FROM {TABLE}), (SELECT count(*) FROM {NEW_TABLE})")
+        old_n, new_n = cur.fetchone()
+        if old_n != new_n:
+            conn.rollback()
+            raise SystemExit(f"row count mismatch (old {old_n}, new {new_n}); "
+                             "rows were deleted during the migration - run migrate again")
+
+        cur.execute(f"ALTER TABLE {TABLE} RENAME TO {OLD_TABLE}")
+        cur.execute(f"ALTER SEQUENCE {seq} OWNED BY {NEW_TABLE}.id")
+        if keep_old:
+            cur.execute(f"ALTER INDEX IF EXISTS {TABLE}_pkey RENAME TO {OLD_TABLE}_pkey")
+        else:
+            cur.execute(f"DROP TABLE {OLD_TABLE}")
+        cur.execute(f"ALTER TABLE {NEW_TABLE} RENAME TO {TABLE}")
+        cur.execute(f"ALTER INDEX {NEW_TABLE}_pkey RENAME TO {TABLE}_pkey")
+        cur.execute(f"ALTER INDEX {NEW_TABLE}_bucket_id RENAME TO {TABLE}_bucket_id")
+        conn.commit()
+
+    print(f"[LOG] ✅ {TABLE} is now partitioned by month | rows={new_n} (+{delta} during copy) | "
+          f"old table {'kept as ' + OLD_TABLE if keep_old else 'dropped'} | {time.perf_counter() - t_start:.1f}s")
+    print("[LOG] restart the app so its log writer picks up the partitioned table")
+
+
+def status() -> dict:
+    with get_conn() as conn:
+        cur = conn.cursor()
+        kind = log_relkind(cur)
+        out = {"table": TABLE, "exists": kind is not None, "partitioned": kind == "p"}
+        if kind == "p":
+            cur.execute(f"""
+                SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples::bigint,
+                       pg_size_pretty(pg_total_relation_size(c.oid))
+                FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = '{TABLE}'::regclass
+                ORDER BY c.relname
+            """)
+            out["partitions"] = [
+                {"name": r[0], "bound": r[1], "rows_estimate": r[2], "size": r[3]}
+                for r in cur.fetchall()
+            ]
+        elif kind == "r":
+            cur.execute(f"SELECT count(*), min(created_at), pg_size_pretty(pg_total_relation_size('{TABLE}')) FROM {TABLE}")
+            n, oldest, size = cur.fetchone()
+            out.update(rows=n, oldest=oldest.isoformat() if oldest else None, size=size)
+        conn.rollback()
+    return out
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Partition query_logs by month")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("status")
+    p = sub.add_parser("migrate", help="copy an unpartitioned query_logs table into monthly partitions and swap")
+    p.add_argument("--keep-old", action="store_true", help=f"keep the old table as {OLD_TABLE}")
+    args = ap.parse_args()
+
+    if args.cmd == "migrate":
+        migrate(args.keep_old)
+    else:
+        print(json.dumps(status(), ensure_ascii=False, indent=2))
@@ -0,0 +1,169 @@
+# scripts/manifest.py
+# ingest 清单：记录每个文件的哈希、每个 section 的内容哈希和它写进 documents 的 chunk 哈希。
+#   - 文件哈希没变且上次已完成 -> 整个文件跳过
+#   - section 哈希没变 -> 跳过（中断后重跑自动从断点继续）
+#   - section 变了 -> 只重嵌这一节，并删掉旧 chunk
+#   - 新版本里没有的 section -> 删掉它的 chunk 和清单记录
+import hashlib
+from collections import Counter
+
+MANIFEST_DDL = """
+    CREATE TABLE IF NOT EXISTS ingest_files (
+        source         TEXT NOT NULL,
+        bucket         TEXT NOT NULL,
+        file_hash      TEXT NOT NULL,
+        status         TEXT NOT NULL,          -- running / done
+        sections_total INT,
+        sections_done  INT NOT NULL DEFAULT 0,
+        started_at     TIMESTAMPTZ NOT NULL DEFAULT now(),
+        finished_at    TIMESTAMPTZ,
+        PRIMARY KEY (source, bucket)
+    );
+
+    CREATE TABLE IF NOT EXISTS ingest_sections (
+        source       TEXT NOT NULL,
+        bucket       TEXT NOT NULL,
+        section_key  TEXT NOT NULL,
+        section      TEXT,
+        title        TEXT,
+        page_start   INT,
+        page_end     INT,
+        section_hash TEXT NOT NULL,
+        chunk_hashes TEXT[] NOT NULL,
+        updated_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (source, bucket, section_key)
+    );
+"""
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+# 送去 embedding 的文本格式版本（scripts.ingest.embed_input）；改了就换一个值，所有 section 重嵌一次
+EMBED_INPUT_VERSION = "body"
+
+
+def section_hash(chunk_hashes: list[str]) -> str:
+    """section 的内容哈希 = 它所有 chunk（含装饰头）的哈希 + embedding 输入版本；切分参数变了也会触发重嵌"""
+    return hashlib.md5("\n".join([EMBED_INPUT_VERSION, *chunk_hashes]).encode("utf-8")).hexdigest()
+
+
+def delete_chunks(cur, source: str, bucket: str, hashes) -> int:
+    hashes = sorted(hashes)
+    if not hashes:
+        return 0
+    cur.execute("""
+        DELETE FROM documents
+        WHERE source = %s AND bucket = %s AND content_hash = ANY(%s)
+    """, (source, bucket, hashes))
+    return cur.rowcount
+
+
+class Manifest:
+    """单个 (source, bucket) 的清单；所有写操作都在调用方的事务里完成"""
+
+    def __init__(self, source: str, bucket: str):
+        self.source = source
+        self.bucket = bucket
+        self.file: dict | None = None
+        self.sections: dict[str, dict] = {}
+        # chunk 哈希被多少个 section 引用；降到 0 才真正删除
+        self.claims: Counter = Counter()
+        self._ordinals: Counter = Counter()
+
+    def load(self, cur):
+        cur.execute("""
+            SELECT file_hash, status, sections_total, sections_done
+            FROM ingest_files WHERE source = %s AND bucket = %s
+        """, (self.source, self.bucket))
+        row = cur.fetchone()
+        self.file = None if row is None else {
+            "file_hash": row[0], "status": row[1],
+            "sections_total": row[2], "sections_done": row[3],
+        }
+        cur.execute("""
+            SELECT section_key, section_hash, chunk_hashes
+            FROM ingest_sections WHERE source = %s AND bucket = %s
+        """, (self.source, self.bucket))
+        for key, sec_hash, chunk_hashes in cur.fetchall():
+            self.sections[key] = {"section_hash": sec_hash, "chunk_hashes": list(chunk_hashes)}
+            self.claims.update(set(chunk_hashes))
+
+    def is_done(self, file_hash: str) -> bool:
+        return bool(self.file and self.file["file_hash"] == file_hash and self.file["status"] == "done")
+
+    def section_key(self, section: str | None, title: str) -> str:
+        """(条款号, 标题, 第几次出现)：页码变动不影响身份"""
+        base = f"{section or ''}|{title}"
+        self._ordinals[base] += 1
+        return f"{base}|{self._ordinals[base]}"
+
+    def is_unchanged(self, key: str, sec_hash: str) -> bool:
+        old = self.sections.get(key)
+        return old is not None and old["section_hash"] == sec_hash
+
+    def start(self, cur, file_hash: str):
+        cur.execute("""
+            INSERT INTO ingest_files (source, bucket, file_hash, status, sections_done)
+            VALUES (%s, %s, %s, 'running', 0)
+            ON CONFLICT (source, bucket) DO UPDATE
+            SET file_hash = EXCLUDED.file_hash, status = 'running',
+                sections_done = 0, started_at = now(), finished_at = NULL
+        """, (self.source, self.bucket, file_hash))
+
+    def update(self, cur, key: str, meta: dict, sec_hash: str, chunk_hashes: list[str]) -> set:
+        """记录一个已写完的 section，返回不再被任何 section 引用的旧 chunk 哈希"""
+        old = self.sections.get(key)
+        old_hashes = set(old["chunk_hashes"]) if old else set()
+        new_hashes = set(chunk_hashes)
+        self.claims.subtract(old_hashes)
+        self.claims.update(new_hashes)
+        stale = {h for h in old_hashes - new_hashes if self.claims[h] <= 0}
+
+        cur.execute("""
+            INSERT INTO ingest_sections
+                (source, bucket, section_key, section, title, page_start, page_end,
+                 section_hash, chunk_hashes)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (source, bucket, section_key) DO UPDATE
+            SET section = EXCLUDED.section, title = EXCLUDED.title,
+                page_start = EXCLUDED.page_start, page_end = EXCLUDED.page_end,
+                section_hash = EXCLUDED.section_hash, chunk_hashes = EXCLUDED.chunk_hashes,
+                updated_at = now()
+        """, (self.source, self.bucket, key, meta["section"], meta["title"],
+              meta["page_start"], meta["page_end"], sec_hash, chunk_hashes))
+        self.sections[key] = {"section_hash": sec_hash, "chunk_hashes": chunk_hashes}
+        return stale
+
+    def remove_missing(self, cur, seen_keys: set) -> set:
+        """删除这次没出现的 section 的清单记录，返回需要删掉的 chunk 哈希"""
+        gone = [k for k in self.sections if k not in seen_keys]
+        stale = set()
+        for key in gone:
+            hashes = set(self.sections.pop(key)["chunk_hashes"])
+            self.claims.subtract(hashes)
+            stale |= {h for h in hashes if self.claims[h] <= 0}
+        if gone:
+            cur.execute("""
+                DELETE FROM ingest_sections
+                WHERE source = %s AND bucket = %s AND section_key = ANY(%s)
+            """, (self.source, self.bucket, gone))
+        return stale
+
+    def progress(self, cur, done: int):
+        cur.execute("""
+            UPDATE ingest_files SET sections_done = %s
+            WHERE source = %s AND bucket = %s
+        """, (done, self.source, self.bucket))
+
+    def finish(self, cur, total: int):
+        cur.execute("""
+            UPDATE ingest_files
+            SET status = 'done', sections_total = %s, sections_done = %s, finished_at = now()
+            WHERE source = %s AND bucket = %s
+        """, (total, total, self.source, self.bucket))
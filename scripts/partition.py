@@ -0,0 +1,245 @@
+# scripts/partition.py
+# documents 按 bucket LIST 分区：每个 bucket 一张分区表、各自的 ANN 索引，
+# 带 bucket 的检索只扫这一个分区（"oncor" 的查询碰不到 "ercot" 的数据），过滤也不会让 top-k 凑不满。
+#
+#   - 新库：DOCUMENTS_PARTITIONED=1（默认）时 ensure_table 直接建分区表
+#   - ingest 写入前 ensure_partitions() 给新 bucket 建分区；DEFAULT 分区兜底
+#   - 已有普通表的迁移（先停 ingest；复制期间检索照常，只有最后切换时短暂挡写）：
+#       python -m scripts.partition status
+#       python -m scripts.partition migrate [--keep-old]
+import argparse
+import hashlib
+import json
+import re
+import time
+
+from psycopg2 import errors
+
+from app.config import EMBED_QUANT
+from app.db import get_conn
+from scripts.ann_index import ALL_QUANT, create_index, index_name, rename_index
+
+TABLE = "documents"
+NEW_TABLE = "documents_part"              # 迁移时新表的临时名字
+OLD_TABLE = "documents_unpartitioned"     # 迁移后旧表（--keep-old 时保留）
+DEFAULT_PARTITION = "documents_b_default"
+
+# 分区表的主键必须包含分区键，所以是 (id, bucket)；bucket 不能为 NULL（旧数据里的 NULL 迁移成 ''）
+_DOCUMENTS_DDL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INT NOT NULL DEFAULT nextval('{seq}'),
+        content  TEXT NOT NULL,
+        embedding vector(1536),
+        source   TEXT,
+        section  TEXT,
+        title    TEXT,
+        page     INT,
+        page_start INT,
+        page_end   INT,
+        bucket   TEXT NOT NULL,
+        content_hash TEXT,
+        created_at TIMESTAMP DEFAULT NOW(),
+        PRIMARY KEY (id, bucket)
+    ) PARTITION BY LIST (bucket);
+"""
+
+_COLUMNS = "id, content, embedding, source, section, title, page, page_start, page_end, bucket, content_hash, created_at"
+_COPY_SQL = f"""
+    INSERT INTO {NEW_TABLE} ({_COLUMNS})
+    SELECT id, content, embedding, source, section, title, page, page_start, page_end,
+           COALESCE(bucket, ''), content_hash, created_at
+    FROM {TABLE}
+"""
+
+
+def partition_name(bucket: str) -> str:
+    """bucket -> 分区表名：可读的前缀 + 哈希（bucket 可以是任意文本）"""
+    slug = re.sub(r"[^a-z0-9]+", "_", bucket.lower()).strip("_")[:24]
+    return f"documents_b_{slug}_{hashlib.md5(bucket.encode('utf-8')).hexdigest()[:8]}"
+
+
+def relkind(cur, table: str = TABLE) -> str | None:
+    """'r' 普通表 / 'p' 分区表 / None 不存在"""
+    cur.execute("""
+        SELECT relkind FROM pg_class
+        WHERE relname = %s AND relnamespace = 'public'::regnamespace
+    """, (table,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def create_partitioned_table(cur, table: str = TABLE, seq: str = "documents_id_seq"):
+    cur.execute(_DOCUMENTS_DDL.format(table=table, seq=seq))
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF {table} DEFAULT")
+
+
+def create_partition(cur, bucket: str, parent: str = TABLE):
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {partition_name(bucket)} "
+                f"PARTITION OF {parent} FOR VALUES IN (%s)", (bucket,))
+
+
+# 本进程里已确认有分区的 bucket；_partitioned 为 None 表示还没查过表类型
+_known: set = set()
+_partitioned: bool | None = None
+
+
+def ensure_partitions(buckets):
+    """给还没有分区的 bucket 建分区。在单独的连接里建并提交，
+    不把父表上的锁带进调用方的写入事务；documents 不是分区表时什么也不做。
+    """
+    global _partitioned
+    todo = {b for b in buckets if b is not None and b not in _known}
+    if not todo or _partitioned is False:
+        return
+    with get_conn() as conn:
+        cur = conn.cursor()
+        if _partitioned is None:
+            _partitioned = relkind(cur) == "p"
+            if not _partitioned:
+                conn.rollback()
+                return
+        for b in sorted(todo):
+            try:
+                create_partition(cur, b)
+                conn.commit()
+                print(f"[PART] partition {partition_name(b)} for bucket {b!r} ready")
+            except (errors.DuplicateTable, errors.UniqueViolation):
+                # 另一个 ingest 进程同时在建同一个分区
+                conn.rollback()
+            _known.add(b)
+
+
+def _secondary_indexes(cur, table: str, suffix: str):
+    """和 ensure_table 里一样的两个索引（uniq_doc_block 供 ON CONFLICT，(section, bucket) 供条款直查）"""
+    cur.execute(f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS uniq_doc_block{suffix}
+        ON {table} (source, bucket, COALESCE(section,''), page_start, page_end, content_hash)
+    """)
+    cur.execute(f"CREATE INDEX IF NOT EXISTS documents_section_bucket{suffix} ON {table} (section, bucket)")
+
+
+def _indexes_on(cur, table: str) -> list[str]:
+    cur.execute("""
+        SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = %s::regclass
+    """, (table,))
+    return [r[0] for r in cur.fetchall()]
+
+
+def migrate(keep_old: bool = False):
+    """普通表 documents -> 按 bucket 分区的新表。
+    1) 建 documents_part 和各 bucket 的分区，按 bucket 分批复制（旧表照常服务检索）
+    2) 在新表上建二级索引和与旧表相同种类的 ANN 索引（每个分区 CONCURRENTLY）
+    3) 一个事务里：锁住旧表挡写，补复制期间新增的行，核对行数，改名切换
+    复制期间不能有删除（ingest 的增量更新会删行），请先停 ingest。
+    """
+    t_start = time.perf_counter()
+    with get_conn() as conn:
+        cur = conn.cursor()
+        kind = relkind(cur)
+        if kind is None:
+            raise SystemExit(f"{TABLE} does not exist; new setups are created partitioned by ensure_table")
+        if kind == "p":
+            print(f"[PART] {TABLE} is already partitioned")
+            return
+        cur.execute(f"SELECT pg_get_serial_sequence('{TABLE}', 'id')")
+        seq = cur.fetchone()[0]
+        # 上次中断留下的半成品（连同它的分区）
+        cur.execute(f"DROP TABLE IF EXISTS {NEW_TABLE}")
+        create_partitioned_table(cur, NEW_TABLE, seq)
+
+        cur.execute(f"SELECT COALESCE(max(id), 0) FROM {TABLE}")
+        high = cur.fetchone()[0]
+        cur.execute(f"""
+            SELECT COALESCE(bucket, ''), count(*) FROM {TABLE}
+            WHERE id <= %s GROUP BY 1 ORDER BY 1
+        """, (high,))
+        buckets = cur.fetchall()
+        for b, _ in buckets:
+            create_partition(cur, b, NEW_TABLE)
+        conn.commit()
+        print(f"[PART] created {NEW_TABLE} with {len(buckets)} bucket partitions")
+
+        # 每个 bucket 一个事务，失败可以整体重跑
+        for b, n in buckets:
+            t0 = time.perf_counter()
+            cur.execute(_COPY_SQL + " WHERE COALESCE(bucket, '') = %s AND id <= %s", (b, high))
+            conn.commit()
+            print(f"[PART] copied {n} rows of bucket {b!r} in {time.perf_counter() - t0:.1f}s")
+
+        _secondary_indexes(cur, NEW_TABLE, "_part")
+        conn.commit()
+        quants = [q for q in ALL_QUANT if relkind(cur, index_name(q)) is not None] or [EMBED_QUANT]
+        conn.rollback()
+
+    # ANN 索引先建在新表上，切换后检索马上有索引可用
+    for q in quants:
+        create_index(q, table=NEW_TABLE, name=index_name(q) + "_part")
+
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(f"LOCK TABLE {TABLE} IN EXCLUSIVE MODE")   # 挡写，不挡读
+        cur.execute(_COPY_SQL + " WHERE id > %s", (high,))
+        delta = cur.rowcount
+        cur.execute(f"SELECT (SELECT count(*) FROM {TABLE}), (SELECT count(*) FROM {NEW_TABLE})")
+        old_n, new_n = cur.fetchone()
+        if old_n != new_n:
+            conn.rollback()
+            raise SystemExit(f"row count mismatch (old {old_n}, new {new_n}); "
+                             "rows were deleted during the migration - stop ingest and run migrate again")
+
+        cur.execute(f"ALTER TABLE {TABLE} RENAME TO {OLD_TABLE}")
+        cur.execute(f"ALTER SEQUENCE {seq} OWNED BY {NEW_TABLE}.id")
+        if keep_old:
+            for idx in _indexes_on(cur, OLD_TABLE):
+                cur.execute(f"ALTER INDEX {idx} RENAME TO {idx[:55]}_old")
+        else:
+            cur.execute(f"DROP TABLE {OLD_TABLE}")
+        cur.execute(f"ALTER TABLE {NEW_TABLE} RENAME TO {TABLE}")
+        cur.execute(f"ALTER INDEX {NEW_TABLE}_pkey RENAME TO {TABLE}_pkey")
+        cur.execute("ALTER INDEX uniq_doc_block_part RENAME TO uniq_doc_block")
+        cur.execute("ALTER INDEX documents_section_bucket_part RENAME TO documents_section_bucket")
+        for q in quants:
+            rename_index(cur, index_name(q) + "_part", index_name(q))
+        conn.commit()
+
+    print(f"[PART] ✅ {TABLE} is now partitioned by bucket | rows={new_n} (+{delta} during copy) | "
+          f"old table {'kept as ' + OLD_TABLE if keep_old else 'dropped'} | {time.perf_counter() - t_start:.1f}s")
+
+
+def status() -> dict:
+    with get_conn() as conn:
+        cur = conn.cursor()
+        kind = relkind(cur)
+        out = {"table": TABLE, "exists": kind is not None, "partitioned": kind == "p"}
+        if kind == "p":
+            cur.execute(f"""
+                SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples::bigint,
+                       pg_size_pretty(pg_total_relation_size(c.oid))
+                FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = '{TABLE}'::regclass
+                ORDER BY c.relname
+            """)
+            out["partitions"] = [
+                {"name": r[0], "bound": r[1], "rows_estimate": r[2], "size": r[3]}
+                for r in cur.fetchall()
+            ]
+        elif kind == "r":
+            cur.execute(f"SELECT COALESCE(bucket, ''), count(*) FROM {TABLE} GROUP BY 1 ORDER BY 1")
+            out["buckets"] = dict(cur.fetchall())
+        conn.rollback()
+    return out
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Partition the documents table by bucket")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("status")
+    p = sub.add_parser("migrate", help="copy an unpartitioned documents table into bucket partitions and swap")
+    p.add_argument("--keep-old", action="store_true", help=f"keep the old table as {OLD_TABLE}")
+    args = ap.parse_args()
+
+    if args.cmd == "migrate":
+        migrate(args.keep_old)
+    else:
+        print(json.dumps(status(), ensure_ascii=False, indent=2))
@@ -0,0 +1,462 @@
+# scripts/pipeline.py
+# 多文件 ingest 流水线：抽取 → soft_chunk → embedding → 写库 四个阶段同时跑，阶段之间用有界队列连接。
+#   - extract：进程池，每个进程流式抽一个 PDF，section 逐个经有界队列送出（内存不随 PDF 大小增长）
+#   - chunk  ：切分 + 清单比对（没变的 section 跳过），按 EMBED_BATCH_SIZE * EMBED_CONCURRENCY 攒批
+#   - embed  ：多个线程各自调用 embed_many（受 API 配额约束，按 INGEST_EMBED_WORKERS 扩展）
+#   - write  ：单个连接顺序写库，每批一个事务（chunk + 清单一起提交，和 ingest_pdf 一致）
+# 队列满了上游就阻塞，内存占用有上限；每隔几秒打印各阶段吞吐和队列深度。
+#
+# 用法：
+#   python -m scripts.pipeline ercot=data/ercot oncor="data/oncor/*.pdf" ercot=data/Sample.pdf
+#   python -m scripts.ingest ...   （同一个 CLI）
+import argparse
+import glob
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from app.config import (
+    EMBED_BATCH_SIZE,
+    EMBED_CONCURRENCY,
+    INGEST_EMBED_WORKERS,
+    INGEST_FILE_WORKERS,
+    INGEST_QUEUE_SIZE,
+)
+from app.db import get_conn
+from scripts.ann_index import create_index
+from scripts.embedder import embed_many, stats as embed_stats
+from scripts.ingest import (
+    begin_file,
+    chunk_section,
+    embed_input,
+    ensure_table,
+    finish_file,
+    iter_sections,
+    write_batch,
+)
+
+_DONE = object()          # 阶段结束标记
+_FILE_END = object()      # 一个文件的 section 都已送出
+_FILE_FAILED = object()   # 一个文件抽取失败
+
+
+# ---------- 抽取子进程：section 逐个放进共享队列 ----------
+_shared_q = None
+_stop = None
+
+
+def _init_extract_worker(q, stop):
+    global _shared_q, _stop
+    _shared_q, _stop = q, stop
+    # 中止时队列里可能还有没人读的数据，退出时不等 feeder 线程把它们送完
+    q.cancel_join_thread()
+
+
+def _send(item) -> bool:
+    """队列满了就等（背压）；主进程要求停止时返回 False"""
+    while not _stop.is_set():
+        try:
+            _shared_q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _stream_sections(file_id: int, path: str) -> int:
+    """子进程入口：iter_sections 逐个产出 section（页文本在有界缓存里），最后发结束或错误标记"""
+    n = 0
+    try:
+        for sec in iter_sections(path, workers=1):
+            if not _send(("section", file_id, sec)):
+                return n
+            n += 1
+    except Exception as e:
+        _send(("error", file_id, f"{type(e).__name__}: {e}"))
+        return n
+    _send(("end", file_id, n))
+    return n
+
+
+class _Aborted(Exception):
+    """另一个阶段出错，本阶段放弃"""
+
+
+def expand_specs(specs: list[str], default_bucket: str | None = None) -> list[tuple[str, str]]:
+    """BUCKET=PATH（目录递归找 *.pdf / glob / 单个文件）-> [(pdf_path, bucket)]，去重并保持顺序"""
+    jobs: dict[str, str] = {}
+    for spec in specs:
+        bucket, sep, path = spec.partition("=")
+        if not sep:
+            bucket, path = default_bucket, spec
+        if not bucket:
+            raise SystemExit(f"no bucket for {spec!r}; use BUCKET=PATH or --bucket")
+        p = Path(path)
+        if p.is_dir():
+            files = sorted(str(f) for f in p.rglob("*") if f.suffix.lower() == ".pdf")
+        elif glob.has_magic(path):
+            files = sorted(f for f in glob.glob(path, recursive=True) if f.lower().endswith(".pdf"))
+        else:
+            files = [path]
+        if not files:
+            print(f"[PIPE][WARN] no PDF matched: {spec}")
+        for f in files:
+            jobs.setdefault(f, bucket)
+
+    # documents / 清单按 (文件名, bucket) 区分来源：同名文件会互相覆盖，只保留第一个
+    out, owners = [], {}
+    for f, bucket in jobs.items():
+        key = (Path(f).name, bucket)
+        if key in owners:
+            print(f"[PIPE][WARN] {f} has the same name as {owners[key]} in bucket {bucket}, skipped")
+            continue
+        owners[key] = f
+        out.append((f, bucket))
+    return out
+
+
+class FileState:
+    """一个文件在流水线里的状态；写库阶段等它所有批次都写完才 finish"""
+
+    def __init__(self, path: str, bucket: str, manifest):
+        self.path = path
+        self.bucket = bucket
+        self.manifest = manifest
+        self.sections_total = 0
+        self.skipped = 0
+        self.seen: set = set()
+        # 切分阶段正在攒的批
+        self.pending: list[dict] = []
+        self.pending_sections: list[tuple] = []
+        self.n_batches = 0
+        self.t0: float | None = None
+        self.batches = None          # chunk 阶段结束后才知道总批数
+        self.batches_written = 0
+        self.sections_done = 0
+        self.inserted = 0
+        self.deleted = 0
+
+
+class StageStats:
+    def __init__(self, name: str, unit: str):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.units = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, items: int, units: int, seconds: float):
+        with self._lock:
+            self.items += items
+            self.units += units
+            self.busy += seconds
+
+    def line(self, elapsed: float) -> str:
+        rate = self.units / elapsed if elapsed > 0 else 0.0
+        return f"{self.name} {self.units} {self.unit} ({rate:.1f}/s, busy {self.busy:.0f}s)"
+
+
+class Pipeline:
+    def __init__(self, jobs: list[tuple[str, str]], force: bool = False,
+                 file_workers: int = INGEST_FILE_WORKERS,
+                 embed_workers: int = INGEST_EMBED_WORKERS,
+                 queue_size: int = INGEST_QUEUE_SIZE,
+                 progress_every: float = 5.0):
+        self.jobs = jobs
+        self.force = force
+        self.file_workers = file_workers if file_workers > 0 else (os.cpu_count() or 1)
+        self.embed_workers = max(1, embed_workers)
+        self.flush_size = max(1, EMBED_BATCH_SIZE * EMBED_CONCURRENCY)
+        self.progress_every = progress_every
+
+        self.q_sections: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+        self.q_batches: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+        self.q_write: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+
+        self.stats = {
+            "extract": StageStats("extract", "files"),
+            "chunk": StageStats("chunk", "chunks"),
+            "embed": StageStats("embed", "chunks"),
+            "write": StageStats("write", "rows"),
+        }
+        self.files_skipped = 0
+        self.files_failed: list[tuple[str, str]] = []
+        self.files_done = 0
+        self.inserted = 0
+        self.deleted = 0
+        self._abort = threading.Event()
+        self._errors: list[BaseException] = []
+        self._t0 = 0.0
+
+    # ---------- 队列工具：出错时所有阶段都能退出，不会卡在满/空队列上 ----------
+    def _put(self, q: queue.Queue, item):
+        while not self._abort.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+        raise _Aborted()
+
+    def _get(self, q: queue.Queue):
+        while not self._abort.is_set():
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        raise _Aborted()
+
+    def _stage(self, fn, *args):
+        def run():
+            try:
+                fn(*args)
+            except _Aborted:
+                pass
+            except BaseException as e:
+                self._errors.append(e)
+                self._abort.set()
+                print(f"[PIPE][ERROR] {fn.__name__}: {type(e).__name__}: {e}")
+        t = threading.Thread(target=run, name=f"ingest-{fn.__name__}", daemon=True)
+        t.start()
+        return t
+
+    # ---------- 阶段 1：抽取 ----------
+    def extract_stage(self):
+        """子进程各抽一个 PDF，逐个 section 放进共享的有界队列；这里转发给切分阶段。
+        在途文件不超过进程数，队列满了子进程就停下来，内存不随 PDF 大小增长。
+        """
+        ctx = mp.get_context()
+        shared = ctx.Queue(maxsize=self.q_sections.maxsize)
+        stop = ctx.Event()
+        files: dict[int, tuple] = {}   # file_id -> (FileState, future, t0)
+        jobs = enumerate(self.jobs)
+        with ProcessPoolExecutor(max_workers=self.file_workers, initializer=_init_extract_worker,
+                                 initargs=(shared, stop)) as pool:
+            try:
+                while True:
+                    while len(files) < self.file_workers:
+                        job = next(jobs, None)
+                        if job is None:
+                            break
+                        fid, (path, bucket) = job
+                        manifest = begin_file(path, bucket, self.force)
+                        if manifest is None:
+                            self.files_skipped += 1
+                            continue
+                        fut = pool.submit(_stream_sections, fid, path)
+                        files[fid] = (FileState(path, bucket, manifest), fut, time.perf_counter())
+                    if not files:
+                        break
+                    if self._abort.is_set():
+                        raise _Aborted()
+                    try:
+                        kind, fid, payload = shared.get(timeout=0.5)
+                    except queue.Empty:
+                        # 子进程崩溃（不是 Python 异常）时不会有结束标记
+                        for fid, (state, fut, _) in list(files.items()):
+                            if fut.done() and fut.exception() is not None:
+                                del files[fid]
+                                self._extract_failed(state, str(fut.exception()))
+                        continue
+                    state, fut, t0 = files[fid]
+                    if kind == "section":
+                        self._put(self.q_sections, (state, payload))
+                        continue
+                    del files[fid]
+                    if kind == "error":
+                        self._extract_failed(state, payload)
+                    else:
+                        self.stats["extract"].add(1, 1, time.perf_counter() - t0)
+                        self._put(self.q_sections, (state, _FILE_END))
+            finally:
+                # 正常结束 / 出错都让还卡在队列上的子进程退出
+                stop.set()
+        self._put(self.q_sections, _DONE)
+
+    def _extract_failed(self, state: FileState, err: str):
+        # 单个坏文件不影响其它文件；清单停在 running，下次重跑会再试
+        self.files_failed.append((state.path, err))
+        print(f"[PIPE][ERROR] extract failed: {state.path}: {err}")
+        self._put(self.q_sections, (state, _FILE_FAILED))
+
+    # ---------- 阶段 2：切分 + 清单比对 ----------
+    def chunk_stage(self):
+        """多个文件的 section 交错到达；每个文件各攒各的批，文件结束时发结束标记"""
+        while True:
+            item = self._get(self.q_sections)
+            if item is _DONE:
+                break
+            state, sec = item
+            if sec is _FILE_FAILED:
+                # 已写的批次保留（清单记着，重跑跳过）；不发结束标记，不会按残缺的 seen 删数据
+                state.pending, state.pending_sections = [], []
+                continue
+            if sec is _FILE_END:
+                self._emit_batch(state)
+                # 文件结束标记：写库阶段据此判断什么时候可以 finish
+                self._put(self.q_batches, (state, state.n_batches))
+                continue
+
+            if state.t0 is None:
+                state.t0 = time.perf_counter()
+            state.sections_total += 1
+            si = state.sections_total
+            decorated_chunks, chunk_hashes, sec_hash = chunk_section(state.manifest.source, sec)
+            key = state.manifest.section_key(sec["section"], sec["title"])
+            state.seen.add(key)
+            if state.manifest.is_unchanged(key, sec_hash):
+                state.skipped += 1
+                continue
+            for ci, decorated in enumerate(decorated_chunks, start=1):
+                state.pending.append({
+                    "si": si,
+                    "ci": ci,
+                    "content": decorated,
+                    "section": sec["section"],
+                    "title": sec["title"],
+                    "page_start": sec["page_start"],
+                    "page_end": sec["page_end"],
+                })
+            meta = {"section": sec["section"], "title": sec["title"],
+                    "page_start": sec["page_start"], "page_end": sec["page_end"]}
+            state.pending_sections.append((key, meta, sec_hash, chunk_hashes))
+
+            if len(state.pending) >= self.flush_size:
+                self._emit_batch(state)
+        for _ in range(self.embed_workers):
+            self._put(self.q_batches, _DONE)
+
+    def _emit_batch(self, state: FileState):
+        if not state.pending and not state.pending_sections:
+            return
+        self.stats["chunk"].add(1, len(state.pending), time.perf_counter() - (state.t0 or time.perf_counter()))
+        self._put(self.q_batches, (state, state.pending, state.pending_sections))
+        state.n_batches += 1
+        state.pending, state.pending_sections = [], []
+        state.t0 = time.perf_counter()
+
+    # ---------- 阶段 3：embedding ----------
+    def embed_stage(self):
+        while True:
+            item = self._get(self.q_batches)
+            if item is _DONE:
+                break
+            if len(item) == 3:
+                state, pending, pending_sections = item
+                t0 = time.perf_counter()
+                embs = embed_many([embed_input(p["content"]) for p in pending]) if pending else []
+                self.stats["embed"].add(1, len(pending), time.perf_counter() - t0)
+                item = (state, pending, pending_sections, embs)
+            self._put(self.q_write, item)
+        self._put(self.q_write, _DONE)
+
+    # ---------- 阶段 4：写库 ----------
+    def write_stage(self):
+        remaining = self.embed_workers
+        with get_conn() as conn:
+            while remaining:
+                item = self._get(self.q_write)
+                if item is _DONE:
+                    remaining -= 1
+                    continue
+                if len(item) == 4:
+                    state, pending, pending_sections, embs = item
+                    t0 = time.perf_counter()
+                    state.sections_done += len(pending_sections)
+                    n, d = write_batch(conn, state.manifest, pending, pending_sections, embs,
+                                       state.sections_done + state.skipped)
+                    self.stats["write"].add(1, n, time.perf_counter() - t0)
+                    state.inserted += n
+                    state.deleted += d
+                    state.batches_written += 1
+                else:
+                    state, n_batches = item
+                    state.batches = n_batches
+                # 多个 embed 线程时批次可能乱序到达：最后一批和结束标记都到了才 finish
+                if state.batches is not None and state.batches_written == state.batches:
+                    state.deleted += finish_file(conn, state.manifest, state.seen, state.sections_total)
+                    self.files_done += 1
+                    self.inserted += state.inserted
+                    self.deleted += state.deleted
+                    print(f"[PIPE] ✅ {state.manifest.source} | bucket={state.bucket} | "
+                          f"inserted={state.inserted} removed={state.deleted} "
+                          f"unchanged sections={state.skipped}/{state.sections_total}")
+
+    # ---------- 进度 ----------
+    def progress_line(self) -> str:
+        elapsed = time.perf_counter() - self._t0
+        stages = " | ".join(s.line(elapsed) for s in self.stats.values())
+        return (f"[PIPE] {elapsed:.0f}s | files {self.files_done + self.files_skipped}/{len(self.jobs)} | "
+                f"{stages} | queues {self.q_sections.qsize()}/{self.q_batches.qsize()}/{self.q_write.qsize()}")
+
+    def _progress(self, stop: threading.Event):
+        while not stop.wait(self.progress_every):
+            print(self.progress_line())
+
+    def run(self):
+        ensure_table()
+        print(f"[PIPE] {len(self.jobs)} files | extract processes={self.file_workers} | "
+              f"embed workers={self.embed_workers} x concurrency {EMBED_CONCURRENCY} | "
+              f"batch={self.flush_size} chunks | queue size={self.q_sections.maxsize}")
+        self._t0 = time.perf_counter()
+        stop = threading.Event()
+        threading.Thread(target=self._progress, args=(stop,), daemon=True).start()
+
+        threads = [self._stage(self.extract_stage), self._stage(self.chunk_stage)]
+        threads += [self._stage(self.embed_stage) for _ in range(self.embed_workers)]
+        threads.append(self._stage(self.write_stage))
+        try:
+            for t in threads:
+                t.join()
+        except KeyboardInterrupt:
+            # 已提交的批次和清单都在库里，重跑会从断点继续
+            self._abort.set()
+            for t in threads:
+                t.join(timeout=5)
+            raise
+        finally:
+            stop.set()
+
+        print(self.progress_line())
+        if self._errors:
+            raise self._errors[0]
+
+        print(f"✅ Pipeline done: files ingested={self.files_done} skipped={self.files_skipped} "
+              f"failed={len(self.files_failed)} | chunks inserted={self.inserted} removed={self.deleted}")
+        for path, err in self.files_failed:
+            print(f"[PIPE][FAILED] {path}: {err}")
+        print(f"[INGEST] embeddings: {embed_stats.report()}")
+
+        if self.files_done:
+            create_index()
+
+
+def main(argv: list[str] | None = None):
+    ap = argparse.ArgumentParser(
+        description="Ingest PDFs into documents (pipelined: extract → chunk → embed → write)")
+    ap.add_argument("specs", nargs="+",
+                    help="BUCKET=PATH, PATH being a directory (recursive), a glob or a PDF file")
+    ap.add_argument("--bucket", default=None, help="bucket for specs given without BUCKET=")
+    ap.add_argument("--force", action="store_true", help="re-check files even if unchanged since last ingest")
+    ap.add_argument("--file-workers", type=int, default=INGEST_FILE_WORKERS,
+                    help="PDF extraction processes (0 = CPU count)")
+    ap.add_argument("--embed-workers", type=int, default=INGEST_EMBED_WORKERS)
+    ap.add_argument("--queue-size", type=int, default=INGEST_QUEUE_SIZE)
+    ap.add_argument("--progress", type=float, default=5.0, help="seconds between progress lines")
+    args = ap.parse_args(argv)
+
+    jobs = expand_specs(args.specs, args.bucket)
+    if not jobs:
+        raise SystemExit("nothing to ingest")
+    Pipeline(jobs, force=args.force, file_workers=args.file_workers,
+             embed_workers=args.embed_workers, queue_size=args.queue_size,
+             progress_every=args.progress).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# scripts/snapshot.py
+# 把 documents 的向量和元数据导出成只读快照，供 app 端内存映射后直接检索（SEARCH_BACKEND=snapshot）。
+#
+# 目录结构（SNAPSHOT_DIR 下每次导出一个子目录，CURRENT 文件指向当前版本）：
+#   snap-YYYYmmdd-HHMMSS/
+#     meta.json            行数、维度、dtype、bucket 名、导出时的 ingest 代数
+#     vectors.npy          (N, 1536) float16 / float32
+#     norms.npy            (N,) float32，每行向量（按存储精度）的平方范数，算 L2 距离用
+#     ids.npy / pages.npy  int64 / int32（NULL 页码为 -1）
+#     buckets.npy          int16，meta.json["buckets"] 的下标（NULL 为 -1）
+#     <列>.bin + <列>.idx.npy + <列>.null.npy   字符串列：UTF-8 拼接 + 偏移 + NULL 标记
+#   CURRENT                当前快照目录名；写临时文件再 os.replace，发布是原子的
+#
+# 用法（ingest 之后执行）：
+#   python -m scripts.snapshot export [--dtype float16] [--keep 2]
+#   python -m scripts.snapshot status
+import argparse
+import json
+import os
+import shutil
+import struct
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+from app.config import SNAPSHOT_DIR, SNAPSHOT_DTYPE
+from app.db import get_conn
+from app.snapshot import read_current
+from app.vector import PgCopyBinaryReader, from_binary
+
+FORMAT_VERSION = 1
+STRING_COLUMNS = ("content_hash", "content", "source", "section", "title")
+
+_COPY_SQL = """
+    COPY (
+        SELECT id, bucket, page, embedding, content_hash, content, source, section, title
+        FROM documents
+        WHERE embedding IS NOT NULL
+        ORDER BY id
+    ) TO STDOUT WITH (FORMAT binary)
+"""
+
+
+class _StringColumnWriter:
+    def __init__(self, base: Path, n: int):
+        self.f = open(f"{base}.bin", "wb")
+        self.offsets = np.zeros(n + 1, dtype=np.int64)
+        self.nulls = np.zeros(n, dtype=np.bool_)
+        self.base = base
+        self.pos = 0
+
+    def add(self, i: int, raw: bytes | None):
+        if raw is None:
+            self.nulls[i] = True
+        else:
+            self.f.write(raw)
+            self.pos += len(raw)
+        self.offsets[i + 1] = self.pos
+
+    def close(self):
+        self.f.close()
+        np.save(f"{self.base}.idx.npy", self.offsets)
+        np.save(f"{self.base}.null.npy", self.nulls)
+
+
+def export_snapshot(root: str = SNAPSHOT_DIR, dtype: str = SNAPSHOT_DTYPE, keep: int = 2) -> Path:
+    """导出并发布一个新快照，返回快照目录"""
+    root_path = Path(root)
+    root_path.mkdir(parents=True, exist_ok=True)
+    name = "snap-" + datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+    tmp = root_path / f".{name}.tmp"
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir()
+    t0 = time.perf_counter()
+
+    with get_conn() as conn:
+        cur = conn.cursor()
+        # 同一个快照事务里数行数 + COPY，保证两者一致
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        cur.execute("SELECT count(*), max(vector_dims(embedding)) FROM documents WHERE embedding IS NOT NULL")
+        n, dim = cur.fetchone()
+        dim = dim or 1536
+        cur.execute("SELECT bucket, generation FROM ingest_generations")
+        generations = dict(cur.fetchall())
+        print(f"[SNAPSHOT] exporting {n} rows x {dim} dims as {dtype} -> {tmp}")
+
+        vectors = np.lib.format.open_memmap(tmp / "vectors.npy", mode="w+", dtype=dtype, shape=(n, dim))
+        norms = np.zeros(n, dtype=np.float32)
+        ids = np.zeros(n, dtype=np.int64)
+        pages = np.full(n, -1, dtype=np.int32)
+        bucket_codes = np.full(n, -1, dtype=np.int16)
+        buckets: dict[str, int] = {}
+        strings = {c: _StringColumnWriter(tmp / c, n) for c in STRING_COLUMNS}
+        i = 0
+
+        def on_row(fields):
+            nonlocal i
+            if i >= n:
+                raise RuntimeError("documents changed during export")
+            doc_id, bucket, page, emb, *texts = fields
+            ids[i] = struct.unpack(">i", doc_id)[0]
+            if page is not None:
+                pages[i] = struct.unpack(">i", page)[0]
+            if bucket is not None:
+                b = bucket.decode("utf-8")
+                bucket_codes[i] = buckets.setdefault(b, len(buckets))
+            v = from_binary(emb).astype(dtype)
+            vectors[i] = v
+            v32 = v.astype(np.float32)
+            norms[i] = float(v32 @ v32)
+            for col, raw in zip(STRING_COLUMNS, texts):
+                strings[col].add(i, raw)
+            i += 1
+            if i % 50000 == 0:
+                print(f"[SNAPSHOT]   {i}/{n} rows...")
+
+        cur.copy_expert(_COPY_SQL, PgCopyBinaryReader(on_row))
+        conn.rollback()
+
+    if i != n:
+        raise RuntimeError(f"expected {n} rows, got {i}")
+    vectors.flush()
+    del vectors
+    np.save(tmp / "norms.npy", norms)
+    np.save(tmp / "ids.npy", ids)
+    np.save(tmp / "pages.npy", pages)
+    np.save(tmp / "buckets.npy", bucket_codes)
+    for w in strings.values():
+        w.close()
+    meta = {
+        "format": FORMAT_VERSION,
+        "count": n,
+        "dim": dim,
+        "dtype": dtype,
+        "buckets": sorted(buckets, key=buckets.get),
+        "generations": generations,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+    (tmp / "meta.json").write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    final = root_path / name
+    os.replace(tmp, final)
+    publish(root_path, name)
+    size_mb = sum(f.stat().st_size for f in final.iterdir()) / 1e6
+    print(f"[SNAPSHOT] ✅ published {name} | rows={n} | {size_mb:.1f} MB | {time.perf_counter() - t0:.1f}s")
+    prune(root_path, keep)
+    return final
+
+
+def publish(root: Path, name: str):
+    """原子地把 CURRENT 指向 name；app 端轮询到变化后热切换"""
+    tmp = root / "CURRENT.tmp"
+    tmp.write_text(name + "\n", encoding="utf-8")
+    os.replace(tmp, root / "CURRENT")
+
+
+def prune(root: Path, keep: int):
+    """保留最新的 keep 个快照（当前那个一定保留）。
+    已经映射了旧快照的进程不受影响：Linux 上删除文件后映射仍然有效，直到进程切到新快照。
+    """
+    cur_name = read_current(root)
+    snaps = sorted(p.name for p in root.iterdir() if p.is_dir() and p.name.startswith("snap-"))
+    for old in snaps[:-max(1, keep)]:
+        if old != cur_name:
+            shutil.rmtree(root / old, ignore_errors=True)
+            print(f"[SNAPSHOT] removed old snapshot {old}")
+
+
+def status(root: str = SNAPSHOT_DIR) -> dict:
+    root_path = Path(root)
+    name = read_current(root_path)
+    if name is None:
+        return {"current": None}
+    meta = json.loads((root_path / name / "meta.json").read_text(encoding="utf-8"))
+    return {"current": name, **meta}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Export documents to a memory-mappable snapshot")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("export")
+    p.add_argument("--dir", default=SNAPSHOT_DIR)
+    p.add_argument("--dtype", default=SNAPSHOT_DTYPE, choices=["float16", "float32"])
+    p.add_argument("--keep", type=int, default=2, help="snapshots to keep on disk")
+    p = sub.add_parser("status")
+    p.add_argument("--dir", default=SNAPSHOT_DIR)
+    args = ap.parse_args()
+
+    if args.cmd == "export":
+        export_snapshot(args.dir, args.dtype, args.keep)
+    else:
+        print(json.dumps(status(args.dir), ensure_ascii=False, indent=2))
@@ -0,0 +1,129 @@
+# tests/test_context.py
+import numpy as np
+import pytest
+
+import app.context as context
+from app.context import assemble_context, dedupe_chunks, fit_history, split_header
+from app.tokens import estimate_tokens
+
+# 三段 >= MIN_OVERLAP 的互不相同的文本，用来拼相邻 soft-chunk 的重叠部分
+O1 = "The retail electric provider shall notify the customer in writing."
+O2 = "Meter readings are taken monthly unless otherwise agreed upon."
+X = "Section intro text that only appears once in the first chunk."
+M = "Middle paragraph describing the distribution service charges."
+Y = "Closing remarks about the tariff schedule and its effective date."
+
+
+def chunk(body, source="tariff.pdf", section="6.1.1", h=None, emb=None, page=1):
+    return {
+        "content": f"[{source} | sec:{section} | Title | p.{page}-{page}]\n{body}",
+        "content_hash": h or str(hash(body)),
+        "source": source,
+        "section": section,
+        "page": page,
+        "embedding": emb,
+    }
+
+
+def bodies(chunks):
+    return [k["body"] for k in dedupe_chunks(chunks)]
+
+
+def test_split_header():
+    assert split_header("[a | sec:1 | t | p.1-1]\nbody") == ("[a | sec:1 | t | p.1-1]", "body")
+    assert split_header("no header") == ("", "no header")
+
+
+def test_same_hash_dropped():
+    assert bodies([chunk(X, h="h1"), chunk(M, h="h1")]) == [X]
+
+
+def test_contained_body_dropped():
+    assert bodies([chunk(X + " " + M), chunk(M, section="other")]) == [X + " " + M]
+
+
+def test_near_duplicate_embedding(monkeypatch):
+    monkeypatch.setattr(context, "CONTEXT_DEDUP_DISTANCE", 0.2)
+    a = np.ones(4, dtype=np.float32)
+    chunks = [chunk(X, emb=a), chunk(M, emb=a + 0.05, source="other.pdf"), chunk(Y, emb=a + 1)]
+    assert bodies(chunks) == [X, Y]
+
+
+def test_near_duplicate_disabled(monkeypatch):
+    monkeypatch.setattr(context, "CONTEXT_DEDUP_DISTANCE", 0)
+    a = np.ones(4, dtype=np.float32)
+    assert bodies([chunk(X, emb=a), chunk(M, emb=a, source="other.pdf")]) == [X, M]
+
+
+def test_overlap_trimmed_from_next_chunk():
+    assert bodies([chunk(X + " " + O1), chunk(O1 + " " + Y)]) == [X + " " + O1, Y]
+
+
+def test_overlap_trimmed_from_previous_chunk():
+    # 后一块先被选中：前一块结尾和它开头的重合从前一块里剪掉
+    assert bodies([chunk(O1 + " " + Y), chunk(X + " " + O1)]) == [O1 + " " + Y, X]
+
+
+def test_overlap_against_trimmed_chunk():
+    # B 的开头已经因为 A 被剪掉；C 和剪过的 B 结尾仍然重合
+    chunks = [chunk(X + " " + O1), chunk(O1 + " " + M + " " + O2), chunk(O2 + " " + Y)]
+    assert bodies(chunks) == [X + " " + O1, M + " " + O2, Y]
+
+
+def test_overlap_only_within_section():
+    chunks = [chunk(X + " " + O1), chunk(O1 + " " + Y, section="6.1.2")]
+    assert bodies(chunks) == [X + " " + O1, O1 + " " + Y]
+
+
+def test_short_overlap_ignored():
+    assert bodies([chunk(X + " tail"), chunk("tail " + Y)]) == [X + " tail", "tail " + Y]
+
+
+def test_fully_overlapped_chunk_dropped():
+    assert bodies([chunk(X + " " + O1), chunk(O1)]) == [X + " " + O1]
+
+
+def _turn(i, words=20):
+    return {"role": "user", "content": " ".join([f"w{i}"] * words)}
+
+
+def test_fit_history_keeps_newest_in_order():
+    history = [_turn(i) for i in range(10)]
+    per_turn = estimate_tokens(history[0]["content"]) + 2
+    kept = fit_history(history, budget=per_turn * 3 + 1)
+    assert kept == history[-3:]
+    assert fit_history(history, budget=per_turn - 1) == []
+    assert fit_history(None) == []
+
+
+def test_assemble_context_in_order_within_budget():
+    chunks = [chunk(X, section="1"), chunk(M, section="2"), chunk(Y, section="3")]
+    text, used = assemble_context(chunks, budget=10_000)
+    assert used == chunks
+    assert text.index(X) < text.index(M) < text.index(Y)
+    assert "[source: tariff.pdf, section: 1, page: 1]" in text
+
+
+def test_assemble_context_truncates_last_chunk():
+    long_body = "\n".join(f"Line {i} of a very long clause body." for i in range(400))
+    chunks = [chunk(X, section="1"), chunk(long_body, section="2"), chunk(Y, section="3")]
+    budget = 300
+    text, used = assemble_context(chunks, budget=budget)
+    assert used == chunks[:2]
+    assert text.endswith(" …")
+    assert Y not in text
+    assert estimate_tokens(text) <= budget + 10
+
+
+def test_assemble_context_stops_when_tail_too_small():
+    long_body = " ".join(["word"] * 2000)
+    chunks = [chunk(X, section="1"), chunk(long_body, section="2")]
+    first = estimate_tokens("[source: tariff.pdf, section: 1, page: 1]") + estimate_tokens(X) + 2
+    text, used = assemble_context(chunks, budget=first + context.MIN_TAIL_TOKENS - 1)
+    assert used == chunks[:1]
+    assert "word" not in text
+
+
+@pytest.mark.parametrize("budget", [0, 5])
+def test_assemble_context_tiny_budget(budget):
+    assert assemble_context([chunk(X)], budget=budget) == ("", [])
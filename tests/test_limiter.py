@@ -0,0 +1,282 @@
+# tests/test_limiter.py
+import asyncio
+import itertools
+import threading
+import time
+
+import httpx
+import openai
+import pytest
+
+from app.limiter import AdaptiveLimiter, Overloaded, SingleFlight
+
+_kinds = itertools.count()
+
+
+def limiter(**kw) -> AdaptiveLimiter:
+    # 每个测试一个新的 kind，免得 Prometheus gauge 的回调指向别的实例
+    kw.setdefault("initial", 1)
+    kw.setdefault("min_limit", 1)
+    kw.setdefault("max_limit", 4)
+    return AdaptiveLimiter(f"test{next(_kinds)}", **kw)
+
+
+async def _settle():
+    # wait_for 包了一层 task：多让出几轮事件循环，让被唤醒的等待者跑起来
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def _connection_error():
+    return openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/embeddings"))
+
+
+def test_release_hands_slot_to_queue_in_order():
+    async def main():
+        lim = limiter()
+        await lim.acquire(1)
+        order = []
+
+        async def waiter(name):
+            await lim.acquire(1)
+            order.append(name)
+
+        tasks = [asyncio.create_task(waiter(n)) for n in ("a", "b")]
+        await asyncio.sleep(0)
+        assert len(lim._waiters) == 2 and lim.in_flight == 1
+        lim.release()
+        await _settle()
+        # 名额直接转交给队首，in_flight 不会先掉到 0
+        assert order == ["a"] and lim.in_flight == 1
+        # 新来的不能插队
+        with pytest.raises(Overloaded):
+            await lim.acquire(0)
+        lim.release()
+        await asyncio.gather(*tasks)
+        assert order == ["a", "b"]
+        lim.release()
+        assert lim.in_flight == 0 and not lim._waiters
+
+    asyncio.run(main())
+
+
+def test_queue_timeout_sheds():
+    async def main():
+        lim = limiter()
+        await lim.acquire(1)
+        with pytest.raises(Overloaded) as e:
+            await lim.acquire(0.05)
+        assert e.value.reason == "timeout"
+        assert lim.shed_timeout == 1 and lim.in_flight == 1 and not lim._waiters
+        lim.release()
+        assert lim.in_flight == 0
+
+    asyncio.run(main())
+
+
+def test_queue_full_sheds():
+    async def main():
+        lim = limiter(max_queue=1)
+        await lim.acquire(1)
+        first = asyncio.create_task(lim.acquire(1))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as e:
+            await lim.acquire(1)
+        assert e.value.reason == "queue_full" and lim.shed_full == 1
+        lim.release()
+        await first
+        lim.release()
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    async def main():
+        lim = limiter()
+        await lim.acquire(1)
+        task = asyncio.create_task(lim.acquire(1))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        lim.release()
+        assert lim.in_flight == 0 and not lim._waiters
+
+    asyncio.run(main())
+
+
+def test_sync_timeout_sheds():
+    lim = limiter()
+    lim.acquire_sync(1)
+    with pytest.raises(Overloaded) as e:
+        lim.acquire_sync(0.05)
+    assert e.value.reason == "timeout" and lim.in_flight == 1 and not lim._waiters
+    lim.release()
+    assert lim.in_flight == 0
+
+
+def test_thread_release_hands_slot_to_coroutine():
+    async def main():
+        lim = limiter()
+        lim.acquire_sync(1)
+        waiter = asyncio.create_task(lim.acquire(2))
+        await asyncio.sleep(0)
+        threading.Thread(target=lim.release).start()
+        await asyncio.wait_for(waiter, 2)
+        assert lim.in_flight == 1
+        lim.release()
+
+    asyncio.run(main())
+
+
+def test_coroutine_release_hands_slot_to_thread():
+    async def main():
+        lim = limiter()
+        await lim.acquire(1)
+        got = threading.Event()
+
+        def worker():
+            lim.acquire_sync(2)
+            got.set()
+            lim.release()
+
+        t = threading.Thread(target=worker)
+        t.start()
+        while not lim._waiters:
+            await asyncio.sleep(0.01)
+        lim.release()
+        await asyncio.to_thread(t.join, 2)
+        assert got.is_set() and lim.in_flight == 0
+
+    asyncio.run(main())
+
+
+def test_threads_and_coroutines_share_limit():
+    lim = limiter(initial=2, max_limit=2)
+    running = peak = 0
+    lock = threading.Lock()
+
+    def enter():
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+
+    def leave():
+        nonlocal running
+        with lock:
+            running -= 1
+
+    def work():
+        enter()
+        time.sleep(0.02)
+        leave()
+        return 1
+
+    async def awork():
+        enter()
+        await asyncio.sleep(0.02)
+        leave()
+        return 1
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        threads = [loop.run_in_executor(None, lim.call_sync, work) for _ in range(4)]
+        return await asyncio.gather(*threads, *[lim.call(awork) for _ in range(4)])
+
+    assert sum(asyncio.run(main())) == 8
+    assert peak == 2 and lim.in_flight == 0 and not lim._waiters
+
+
+def test_success_increases_limit_additively():
+    lim = limiter(initial=2, max_limit=3)
+    lim.acquire_sync(1)
+    lim.release(ok=True)
+    assert lim.limit == pytest.approx(2.5)
+    for _ in range(10):
+        lim.acquire_sync(1)
+        lim.release(ok=True)
+    assert lim.limit == 3
+
+
+def test_rate_limit_halves_once_per_cooldown():
+    lim = limiter(initial=4, max_limit=8)
+    lim._on_rate_limited(5.0)
+    assert lim.limit == 2 and lim.decreases == 1
+    # 同一波 429 在冷却期内不再减
+    lim._on_rate_limited(5.0)
+    assert lim.limit == 2 and lim.decreases == 1 and lim.rate_limited == 2
+    lim._cooldown_until = 0.0
+    lim._on_rate_limited(1.0)
+    lim._cooldown_until = 0.0
+    lim._on_rate_limited(1.0)
+    assert lim.limit == 1     # 不低于 min_limit
+
+
+def test_call_retries_transient_errors():
+    lim = limiter(queue_timeout=5, max_retries=2)
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) == 1:
+            raise _connection_error()
+        return "ok"
+
+    assert asyncio.run(lim.call(flaky)) == "ok"
+    assert len(calls) == 2 and lim.retries == 1 and lim.in_flight == 0
+
+
+def test_call_gives_up_after_max_retries():
+    lim = limiter(queue_timeout=5, max_retries=0)
+
+    def broken():
+        raise _connection_error()
+
+    with pytest.raises(openai.APIConnectionError):
+        lim.call_sync(broken)
+    assert lim.retries == 0 and lim.in_flight == 0
+
+
+def test_ado_many_shares_calls_with_ado():
+    async def main():
+        flight = SingleFlight("test_many", enabled=True)
+        calls = []
+
+        async def one():
+            calls.append(["a"])
+            await asyncio.sleep(0.02)
+            return "A"
+
+        async def many(keys):
+            calls.append(list(keys))
+            await asyncio.sleep(0.02)
+            return {k: k.upper() for k in keys}
+
+        single = asyncio.create_task(flight.ado("a", one))
+        await asyncio.sleep(0)
+        batch = asyncio.create_task(flight.ado_many(["a", "b", "c", "b"], many))
+        await asyncio.sleep(0)
+        # 批量调用在途时，单条的 "c" 搭车
+        late = await flight.ado("c", one)
+        assert await single == ("A", False)
+        assert await batch == {"a": "A", "b": "B", "c": "C"}
+        assert late == ("C", True)
+        assert calls == [["a"], ["b", "c"]]
+        assert not flight._tasks
+
+    asyncio.run(main())
+
+
+def test_ado_many_propagates_errors():
+    async def main():
+        flight = SingleFlight("test_many_err", enabled=True)
+
+        async def many(keys):
+            raise RuntimeError("upstream down")
+
+        with pytest.raises(RuntimeError):
+            await flight.ado_many(["x", "y"], many)
+        assert not flight._tasks
+
+    asyncio.run(main())
@@ -0,0 +1,30 @@
+# tests/test_sections.py
+import pytest
+
+from app.sections import find_section_label
+
+
+@pytest.mark.parametrize("query, label", [
+    ("Section 3.3.1", "3.3.1"),
+    ("What does sec. 3.3 say about outages?", "3.3"),
+    ("§6.1.1 的适用范围", "6.1.1"),
+    ("第 6.1.1 条是什么", "6.1.1"),
+    ("6.1.1.1.5 Distribution System Charge (DSC)", "6.1.1.1.5"),
+    ("what is in 3.3.1?", "3.3.1"),
+])
+def test_labels(query, label):
+    assert find_section_label(query) == label
+
+
+@pytest.mark.parametrize("query", [
+    # 整句像 "3.3 Title" 的标题，但只有两级、没有前缀：是小数
+    "2.5 MW is the limit?",
+    "3.5 Percent reserve margin",
+    # 日期
+    "In 2024.01.05 what changed",
+    "2024.01.05 Tariff update",
+    "changes since 5.1.2024",
+    "How are transmission facilities approved?",
+])
+def test_not_labels(query):
+    assert find_section_label(query) is None
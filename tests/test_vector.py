@@ -0,0 +1,50 @@
+# tests/test_vector.py
+import struct
+
+import numpy as np
+import pytest
+
+from app.vector import PgCopyBinaryReader, from_binary, pgcopy_binary, to_array, to_binary
+
+ROWS = [
+    ("第 6.1.1 条 content", to_array([0.5, -1.25, 3.0]), 7, None),
+    ("", to_array([0.0] * 1536), -1, "oncor"),
+    (None, None, None, None),
+]
+
+
+def _read(stream: bytes, chunk: int) -> list:
+    rows = []
+    reader = PgCopyBinaryReader(rows.append)
+    for i in range(0, len(stream), chunk):
+        reader.write(stream[i:i + chunk])
+    assert reader.rows == len(rows)
+    return rows
+
+
+@pytest.mark.parametrize("chunk", [1, 7, 1 << 20])
+def test_copy_binary_round_trip(chunk):
+    # chunk=1 / 7：头、字段长度、字段内容都会被切在半截
+    rows = _read(pgcopy_binary(ROWS), chunk)
+    assert len(rows) == len(ROWS)
+    for fields, (text, vec, n, bucket) in zip(rows, ROWS):
+        assert len(fields) == 4
+        assert (fields[0].decode("utf-8") if fields[0] is not None else None) == text
+        if vec is None:
+            assert fields[1] is None
+        else:
+            assert fields[1] == to_binary(vec)
+            np.testing.assert_array_equal(from_binary(fields[1]), vec)
+        assert (struct.unpack(">i", fields[2])[0] if fields[2] is not None else None) == n
+        assert (fields[3].decode("utf-8") if fields[3] is not None else None) == bucket
+
+
+def test_empty_stream():
+    assert _read(pgcopy_binary([]), 3) == []
+
+
+def test_vector_binary_round_trip():
+    vec = np.random.default_rng(0).standard_normal(1536).astype(np.float32)
+    out = from_binary(to_binary(vec))
+    assert out.dtype == np.float32
+    np.testing.assert_array_equal(out, vec)